@@ -7,35 +7,238 @@ Noms et numéros étudiants:
 """
 
 import argparse
+import collections
 import getpass
 import json
+import os
+import pathlib
 import socket
 import sys
 import re
+from typing import Iterator, Optional
 
+import glocodec
 import glosocket
 import gloutils
 
+# Nombre de courriels demandés par page lors de la consultation.
+_PAGE_SIZE = 20
+# Mode non interactif: courriels par page de la liste, et requêtes envoyées
+# sans attendre leur réponse.
+_BATCH_PAGE_SIZE = 1000
+_BATCH_WINDOW = 64
+# Variables d'environnement des identifiants du mode non interactif.
+USER_ENV = "GLO_USER"
+PASSWORD_ENV = "GLO_PASSWORD"
+
+# Codes de sortie du mode non interactif.
+_EXIT_OK = 0
+# Au moins une opération a échoué.
+_EXIT_FAILURE = 1
+# Arguments ou identifiants manquants, comme argparse.
+_EXIT_USAGE = 2
+# Identifiants refusés par le serveur.
+_EXIT_AUTH = 3
+# Connexion impossible ou rompue.
+_EXIT_CONNECTION = 4
+
+# Élément de la liste des courriels (gabarit SUBJECT_DISPLAY), dont la date
+# est celle de get_current_utc_time.
+_SUBJECT_RE = re.compile(r"#(?P<number>[0-9]+) (?P<sender>\S*) - (?P<subject>.*?)"
+                         r"(?: (?P<date>[A-Z][a-z]{2}, [0-9]{2} [A-Z][a-z]{2}"
+                         r" [0-9]{4} [0-9:]{8} [+-][0-9]{4}))?", re.DOTALL)
+
 
 class Client:
     """Client pour le serveur mail @glo2000.ca."""
 
-    def __init__(self, destination: str) -> None:
+    def __init__(self, destination: str,
+                 wire_format: str = glocodec.BINARY,
+                 compression: bool = True) -> None:
         """
         Prépare et connecte le socket du client `_socket`.
 
         Prépare un attribut `_username` pour stocker le nom d'utilisateur
         courant. Laissé vide quand l'utilisateur n'est pas connecté.
+
+        Négocie ensuite avec le serveur le format des messages, en
+        proposant `wire_format` puis JSON; l'attribut `_format` contient le
+        format retenu. Si `compression` est vrai, la compression des gros
+        messages est aussi proposée; `_compression` indique si le serveur
+        l'a acceptée. Les longs corps de courriels en plusieurs trames sont
+        toujours proposés; `_streaming` indique si le serveur les accepte.
         """
         # Préparation du socket
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._socket.connect((destination, gloutils.APP_PORT))
-        except glosocket.GLOSocketError as e:
-            sys.exit(-1)
+        except OSError:
+            print("Erreur, connexion au serveur impossible!", file=sys.stderr)
+            sys.exit(_EXIT_CONNECTION)
         
         #Préparation des membres
         self._username = None
+        # Requêtes en vol: prochain identifiant, et réponses reçues avant
+        # que leur requête ne soit attendue.
+        self._next_request_id = 1
+        self._responses: dict[int, collections.deque] = {}
+        self._format = glocodec.JSON
+        self._compression = False
+        self._streaming = False
+        try:
+            self._negotiate(wire_format, compression)
+        except glosocket.GLOSocketError:
+            print("Erreur, la connexion avec le serveur est rompue!:",
+                  file=sys.stderr)
+            sys.exit(_EXIT_CONNECTION)
+
+    def _send(self, message: gloutils.GloMessage) -> None:
+        """
+        Encode le message dans le format négocié et le transmet.
+
+        Le corps d'un courriel de plus de STREAM_THRESHOLD caractères est
+        envoyé en plusieurs trames si le serveur les accepte.
+        """
+        payload = message.get("payload")
+        if (self._streaming
+                and message["header"] == gloutils.Headers.EMAIL_SENDING
+                and len(payload["content"]) > gloutils.STREAM_THRESHOLD):
+            self._send_chunked(message)
+            return
+        glosocket.send_frame(self._socket, glocodec.encode(message, self._format),
+                             compress=self._compression)
+
+    def _send_chunked(self, message: gloutils.GloMessage) -> None:
+        """
+        Transmet le courriel sans son corps, marqué `chunked`, puis le corps
+        par morceaux de STREAM_CHUNK_SIZE caractères avec l'entête
+        `EMAIL_CHUNK`. Le `request_id` éventuel accompagne le dernier
+        morceau, auquel le serveur répond.
+        """
+        contenu = message["payload"]["content"]
+        entete = gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_SENDING,
+            payload=dict(message["payload"], content="", chunked=True))
+        self._send(entete)
+        taille = gloutils.STREAM_CHUNK_SIZE
+        for debut in range(0, len(contenu), taille):
+            dernier = debut + taille >= len(contenu)
+            morceau = gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_CHUNK,
+                payload=gloutils.ChunkPayload(data=contenu[debut:debut + taille],
+                                              last=dernier))
+            if dernier and "request_id" in message:
+                morceau["request_id"] = message["request_id"]
+            self._send(morceau)
+
+    def _recv(self) -> gloutils.GloMessage:
+        """
+        Reçoit et décode un message du serveur, quel que soit son format.
+
+        Lève une exception GLOSocketError si le message est invalide.
+        """
+        try:
+            return glocodec.decode(glosocket.recv_frame(self._socket))
+        except glocodec.CodecError as ex:
+            raise glosocket.GLOSocketError("Message du serveur invalide") from ex
+
+    def _submit(self, message: gloutils.GloMessage) -> int:
+        """
+        Transmet le message avec un nouvel identifiant de requête, sans
+        attendre la réponse, et retourne cet identifiant.
+        """
+        request_id = self._next_request_id
+        self._next_request_id = request_id % 0xFFFFFFFF + 1
+        message["request_id"] = request_id
+        self._send(message)
+        return request_id
+
+    def _wait(self, request_id: int) -> gloutils.GloMessage:
+        """
+        Retourne la réponse à la requête `request_id`, en mettant de côté
+        les réponses aux autres requêtes reçues entre-temps.
+
+        Lève une exception GLOSocketError si la connexion est rompue.
+        """
+        if self._responses.get(request_id):
+            reponse = self._responses[request_id].popleft()
+            if not self._responses[request_id]:
+                del self._responses[request_id]
+            return reponse
+        while True:
+            reponse = self._recv()
+            if reponse.get("request_id") == request_id:
+                return reponse
+            if "request_id" in reponse:
+                self._responses.setdefault(reponse["request_id"],
+                                           collections.deque()).append(reponse)
+
+    def _chunks(self, request_id: Optional[int] = None) -> Iterator[str]:
+        """
+        Reçoit les morceaux du corps d'un courriel transféré en plusieurs
+        trames (EMAIL_CHUNK), jusqu'au dernier.
+
+        Lève une exception GLOSocketError si la connexion est rompue ou si
+        le serveur envoie autre chose.
+        """
+        while True:
+            if request_id is None:
+                message = self._recv()
+            else:
+                message = self._wait(request_id)
+            match message:
+                case {"header": gloutils.Headers.EMAIL_CHUNK,
+                      "payload": {"data": str(data), "last": bool(last)}}:
+                    yield data
+                    if last:
+                        return
+                case _:
+                    raise glosocket.GLOSocketError("Morceau de courriel attendu")
+
+    def _fetch_emails(self, choices: list[int]) -> list[gloutils.GloMessage]:
+        """
+        Demande plusieurs courriels d'un coup avec l'entête
+        `INBOX_READING_CHOICE` et retourne les réponses dans l'ordre de
+        `choices`.
+
+        Toutes les requêtes sont envoyées avant de lire la première
+        réponse: un seul aller-retour pour l'ensemble. Les corps reçus en
+        plusieurs trames sont reconstitués.
+        """
+        request_ids = [self._submit(gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_READING_CHOICE,
+            payload=gloutils.EmailChoicePayload(choice=choice)))
+            for choice in choices]
+        reponses = []
+        for request_id in request_ids:
+            reponse = self._wait(request_id)
+            if reponse.get("payload", {}).get("chunked") is True:
+                del reponse["payload"]["chunked"]
+                reponse["payload"]["content"] = "".join(self._chunks(request_id))
+            reponses.append(reponse)
+        return reponses
+
+    def _negotiate(self, wire_format: str, compression: bool) -> None:
+        """
+        Propose `wire_format` puis JSON au serveur avec l'entête
+        `NEGOTIATE` et adopte le format qu'il retient, ainsi que la
+        compression si elle est proposée et acceptée, et les corps en
+        plusieurs trames s'ils sont acceptés.
+
+        La demande est toujours envoyée en JSON; JSON est conservé si le
+        serveur refuse la négociation.
+        """
+        self._send(gloutils.GloMessage(
+            header=gloutils.Headers.NEGOTIATE,
+            payload=gloutils.NegotiationPayload(formats=[wire_format, glocodec.JSON],
+                                                compression=compression,
+                                                streaming=True)))
+        match self._recv():
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"formats": [choix]} as payload} if choix in glocodec.ENCODERS:
+                self._format = choix
+                self._compression = compression and payload.get("compression") is True
+                self._streaming = payload.get("streaming") is True
 
     def _register(self) -> None:
         """
@@ -50,14 +253,14 @@ class Client:
         messageAuth = gloutils.GloMessage(header=gloutils.Headers.AUTH_REGISTER,
                                           payload= gloutils.AuthPayload(username=userNom, password=motDePasse))
         try:
-            glosocket.send_mesg(self._socket, json.dumps(messageAuth))
+            self._send(messageAuth)
         except glosocket.GLOSocketError:
             print("Erreur, la connexion avec le serveur est rompue!:")
             self._quit()
 
         # Recevoir la réponse du serveur
         try:
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
+            reponse = self._recv()
         except glosocket.GLOSocketError:
             print("Erreur, la connexion avec le serveur est rompue!:")
             self._quit()
@@ -89,14 +292,14 @@ class Client:
                                          password=motDePasse)
         )
         try:
-            glosocket.send_mesg(self._socket, json.dumps(authLogMessage))
+            self._send(authLogMessage)
         except glosocket.GLOSocketError:
             print("Erreur, la connexion avec le serveur est rompue!:")
             self._quit()
 
         # Recevoir la réponse du serveur
         try:
-            reponse = json.loads(glosocket.recv_mesg(self._socket))
+            reponse = self._recv()
         except glosocket.GLOSocketError:
             print("Erreur, la connexion avec le serveur est rompue!:")
             self._quit()
@@ -114,10 +317,10 @@ class Client:
         """
         # Envoyer l'entête BYE au serveur
         try:
-            glosocket.send_mesg(self._socket, json.dumps(gloutils.GloMessage(
+            self._send(gloutils.GloMessage(
                 header=gloutils.Headers.BYE,
                 payload=None
-            )))
+            ))
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\n")
             self._socket.close()
@@ -128,68 +331,111 @@ class Client:
     def _read_email(self) -> None:
         """
         Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        `INBOX_READING_REQUEST`, une page de `_PAGE_SIZE` courriels à la fois.
 
-        Affiche la liste des courriels puis transmet le choix de l'utilisateur
-        avec l'entête `INBOX_READING_CHOICE`.
+        Affiche la page puis transmet le choix de l'utilisateur avec
+        l'entête `INBOX_READING_CHOICE`; l'utilisateur peut aussi afficher
+        la page suivante ou précédente.
 
         Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
-        # Demander la liste des courriels au serveur
-        demandeEmailList = gloutils.GloMessage(
-            header=gloutils.Headers.INBOX_READING_REQUEST
+        offset = 0
+        while True:
+            # Demander une page de la liste des courriels au serveur
+            demandeEmailList = gloutils.GloMessage(
+                header=gloutils.Headers.INBOX_READING_REQUEST,
+                payload=gloutils.InboxPagePayload(offset=offset,
+                                                  limit=_PAGE_SIZE)
+            )
+            try:
+                self._send(demandeEmailList)
+            except glosocket.GLOSocketError:
+                print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
+                self._logout()
+
+            # Recevoir la réponse du serveur
+            try:
+                reponseEmailList = self._recv()
+            except glosocket.GLOSocketError:
+                print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
+                self._logout()
+
+            emailList: list = reponseEmailList['payload']['email_list']
+            # Un serveur sans pagination retourne la liste entière.
+            total = reponseEmailList['payload'].get('total', len(emailList))
+            if total < 1:
+                return
+            for courriel in emailList:
+                print(courriel)
+            # Demander le choix de l'utilisateur
+            invite = "Entrez votre choix [1-" + str(total) + "]"
+            suivante = offset + len(emailList) < total
+            if suivante:
+                invite += ", s pour la page suivante"
+            if offset > 0:
+                invite += ", p pour la page précédente"
+            choixCourriel = input(invite + ":")
+            if choixCourriel == "s" and suivante:
+                offset += _PAGE_SIZE
+            elif choixCourriel == "p" and offset > 0:
+                offset = max(0, offset - _PAGE_SIZE)
+            else:
+                break
+
+        if not ((re.fullmatch(r"[0-9]+", choixCourriel) is not None) and (0 < int(choixCourriel) <= total)):
+            print("Erreur, choix de courriel invalide!\n Veuillez recommencer.")
+        else:
+            self._display_email(int(choixCourriel))
+
+    def _display_email(self, numero: int) -> None:
+        """
+        Transmet le numéro du courriel choisi avec l'entête
+        `INBOX_READING_CHOICE` et l'affiche à l'aide du gabarit
+        `EMAIL_DISPLAY`.
+        """
+        #Envoi du numéro du courriel choisi
+        envoiChoix = gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_READING_CHOICE,
+            payload=gloutils.EmailChoicePayload(choice=numero)
         )
         try:
-            glosocket.send_mesg(self._socket, json.dumps(demandeEmailList))
+            self._send(envoiChoix)
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
             self._logout()
 
-        # Recevoir la réponse du serveur
+        #Reception du courriel choisi
         try:
-            reponseEmailList = json.loads(glosocket.recv_mesg(self._socket))
+            receptionEmail = self._recv()
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
             self._logout()
-
-        emailList: list = reponseEmailList['payload']['email_list']
-        if len(emailList) < 1:
+        
+        if receptionEmail["payload"].get('chunked') is not True:
+            print(gloutils.EMAIL_DISPLAY.format(
+                sender=receptionEmail["payload"]['sender'],
+                to=_format_destination(receptionEmail["payload"]['destination']),
+                subject=receptionEmail["payload"]['subject'],
+                date=receptionEmail["payload"]['date'],
+                body=receptionEmail["payload"]['content']))
             return
-        else:
-            for courriel in emailList:
-                print(courriel)
-            # Demander le choix de l'utilisateur
-            choixCourriel = input("Entrez votre choix [1-" + str(len(emailList)) + "]:")
-            if not ((re.search(r"[0-9]+", choixCourriel) is not None) and (not int(choixCourriel)>len(emailList))):
-                print("Erreur, choix de courriel invalide!\n Veuillez recommencer.")
-            else:
-                #Envoi du numéro du courriel choisi
-                envoiChoix = gloutils.GloMessage(
-                    header=gloutils.Headers.INBOX_READING_CHOICE,
-                    payload=gloutils.EmailChoicePayload(choice=choixCourriel)
-                )
-                try:
-                    glosocket.send_mesg(self._socket, json.dumps(envoiChoix))
-                except glosocket.GLOSocketError:
-                    print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
-                    self._logout()
-
-                #Reception du courriel choisi
-                try:
-                    receptionEmail = json.loads(glosocket.recv_mesg(self._socket))
-                except glosocket.GLOSocketError:
-                    print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
-                    self._logout()
-                
-                print(gloutils.EMAIL_DISPLAY.format(
-                    sender=receptionEmail["payload"]['sender'],
-                    to=receptionEmail["payload"]['destination'],
-                    subject=receptionEmail["payload"]['subject'],
-                    date=receptionEmail["payload"]['date'],
-                    body=receptionEmail["payload"]['content']))
+        # Corps en plusieurs trames: affiché au fur et à mesure.
+        avant, apres = gloutils.EMAIL_DISPLAY.split("{body}")
+        print(avant.format(
+            sender=receptionEmail["payload"]['sender'],
+            to=_format_destination(receptionEmail["payload"]['destination']),
+            subject=receptionEmail["payload"]['subject'],
+            date=receptionEmail["payload"]['date']), end="")
+        try:
+            for morceau in self._chunks():
+                print(morceau, end="")
+        except glosocket.GLOSocketError:
+            print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
+            self._logout()
+        print(apres)
 
     def _send_email(self) -> None:
         """
@@ -199,11 +445,14 @@ class Client:
         - le corps du message.
 
         La saisie du corps se termine par un point seul sur une ligne.
+        Plusieurs destinataires peuvent être séparés par des virgules.
 
         Transmet ces informations avec l'entête `EMAIL_SENDING`.
         """
         #Récupération du contenu du courriel.
         destEmail = input("Entrez l'adresse du destinataire:")
+        destinataires = [adresse.strip() for adresse in destEmail.split(",")
+                         if adresse.strip()]
         sujEmail = input("Entrez le sujet:")
         # Boucle d'entrée du contenu du email.
         print("Entrez le contenu du courriel, terminez la saisie avec un '.' seul sur une ligne:")
@@ -220,7 +469,8 @@ class Client:
         # Préparation du courriel.
         emailContenu = gloutils.EmailContentPayload(
             sender=self._username + '@' + gloutils.SERVER_DOMAIN,
-            destination=destEmail,
+            destination=(destinataires if len(destinataires) > 1
+                         else destEmail),
             subject=sujEmail,
             date=gloutils.get_current_utc_time(),
             content=messageEmail)
@@ -229,19 +479,29 @@ class Client:
             header=gloutils.Headers.EMAIL_SENDING,
             payload=emailContenu)
         try:
-            glosocket.send_mesg(self._socket, json.dumps(emailSent))
+            self._send(emailSent)
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
             self._logout()
 
         # Confirmation de l'envoi.
         try:
-            reponseServeur = json.loads(glosocket.recv_mesg(self._socket))
+            reponseServeur = self._recv()
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
             self._logout()
         
         match reponseServeur:
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"recipients": list(), "errors": list()}}:
+                # Résultat de chaque destinataire.
+                resultat = reponseServeur['payload']
+                for adresse, erreur in zip(resultat['recipients'],
+                                           resultat['errors']):
+                    if erreur:
+                        print(f"{adresse}: {erreur}")
+                    else:
+                        print(f"{adresse}: Courriel envoyé avec succès")
             case {"header": gloutils.Headers.OK}:
                 print("Courriel envoyé avec succès")
             case {"header": gloutils.Headers.ERROR}:
@@ -260,14 +520,14 @@ class Client:
             header=gloutils.Headers.STATS_REQUEST
         )
         try:
-            glosocket.send_mesg(self._socket, json.dumps(demandeStats))
+            self._send(demandeStats)
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
             self._logout()
         
         #Réception des statistiques et affichage.
         try:
-            stats =json.loads(glosocket.recv_mesg(self._socket))
+            stats = self._recv()
         except glosocket.GLOSocketError:
             print("Erreur, de communication avec le serveur!\nVeuillez vous reconnecter:")
             self._logout()
@@ -284,6 +544,46 @@ class Client:
             case _:
                 print("Erreur lors l'accès aux statistiques.")
 
+    def _search(self) -> None:
+        """
+        Demande à l'utilisateur les mots à rechercher, puis un expéditeur et
+        des dates facultatifs, et transmet la recherche avec l'entête
+        `SEARCH`.
+
+        Affiche les courriels trouvés comme la liste des courriels, puis
+        celui que l'utilisateur choisit, s'il en choisit un.
+        """
+        termes = input("Entrez les mots à rechercher:")
+        recherche = gloutils.SearchPayload(terms=termes)
+        expediteur = input("Expéditeur (facultatif):").strip()
+        if expediteur:
+            recherche['sender'] = expediteur
+        debut = input("Depuis le (AAAA-MM-JJ, facultatif):").strip()
+        if debut:
+            recherche['since'] = debut
+        fin = input("Jusqu'au (AAAA-MM-JJ, facultatif):").strip()
+        if fin:
+            recherche['until'] = fin
+        self._send(gloutils.GloMessage(header=gloutils.Headers.SEARCH,
+                                       payload=recherche))
+        reponse = self._recv()
+        match reponse:
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"email_list": list() as emailList}}:
+                if not emailList:
+                    print("Aucun courriel ne correspond à la recherche.")
+                    return
+                for courriel in emailList:
+                    print(courriel)
+                choixCourriel = input("Entrez le numéro du courriel à lire"
+                                      " (vide pour revenir au menu):")
+                if re.fullmatch(r"[0-9]+", choixCourriel) is not None:
+                    self._display_email(int(choixCourriel))
+            case {"header": gloutils.Headers.ERROR}:
+                print(reponse['payload']['error_message'])
+            case _:
+                print("Erreur lors de la recherche.")
+
     def _logout(self) -> None:
         """
         Préviens le serveur avec l'entête `AUTH_LOGOUT`.
@@ -293,7 +593,7 @@ class Client:
         logOutMessage = gloutils.GloMessage(
             header=gloutils.Headers.AUTH_LOGOUT)
         try:
-            glosocket.send_mesg(self._socket, json.dumps(logOutMessage))
+            self._send(logOutMessage)
         except glosocket.GLOSocketError as e:
             print("Erreur, la connexion avec le serveur est rompue!:", e)
             self._username = None
@@ -338,7 +638,7 @@ class Client:
             else:
                 # Main menu
                 print(gloutils.CLIENT_USE_CHOICE)
-                choixMenuEmail = input("Entrez votre choix [1-4]: ")
+                choixMenuEmail = input("Entrez votre choix [1-5]: ")
                 match choixMenuEmail:
                     case "1":
                         try:
@@ -368,6 +668,15 @@ class Client:
                             should_quit = True
                             continue
                     case "4":
+                        try:
+                            self._search()
+                        except glosocket.GLOSocketError as e:
+                            print("Erreur, la connexion avec le serveur est rompue!:", e)
+                            self._username = None
+                            self._quit()
+                            should_quit = True
+                            continue
+                    case "5":
                         try:
                             self._logout()
                         except glosocket.GLOSocketError as e:
@@ -381,14 +690,380 @@ class Client:
                         print("Choix invalide. Veuillez réessayer.")
                         pass
 
+    def run_batch(self, args: argparse.Namespace, username: str,
+                  password: str) -> int:
+        """
+        Point d'entrée du mode non interactif: se connecte au compte une
+        seule fois, exécute la sous-commande `args.command` sur la même
+        connexion, puis se déconnecte.
+
+        Les résultats sont écrits sur la sortie standard ou dans des
+        fichiers, les erreurs sur la sortie d'erreur. Retourne le code de
+        sortie du programme.
+        """
+        try:
+            erreur = self._authenticate(username, password)
+            if erreur is not None:
+                print(erreur, file=sys.stderr)
+                return _EXIT_AUTH
+            match args.command:
+                case "send":
+                    code = self._batch_send(args.from_file)
+                case "list":
+                    code = self._batch_list(args.json)
+                case "export":
+                    code = self._batch_export(pathlib.Path(args.directory))
+                case _:
+                    code = self._batch_stats(args.json)
+        except glosocket.GLOSocketError as e:
+            print("Erreur, la connexion avec le serveur est rompue!:", e,
+                  file=sys.stderr)
+            self._socket.close()
+            return _EXIT_CONNECTION
+        self._quit()
+        return code
+
+    def _authenticate(self, username: str, password: str) -> Optional[str]:
+        """
+        Se connecte au compte avec l'entête `AUTH_LOGIN` et met à jour
+        `_username`. Retourne le message d'erreur du serveur, ou None.
+        """
+        self._send(gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username=username, password=password)))
+        match self._recv():
+            case {"header": gloutils.Headers.OK}:
+                self._username = username
+                return None
+            case {"header": gloutils.Headers.ERROR, "payload": {"error_message": str(erreur)}}:
+                return erreur
+        return "Erreur lors de la connexion au compte."
+
+    def _batch_send(self, source: str) -> int:
+        """
+        Envoie chaque courriel du fichier `source` ("-" pour l'entrée
+        standard), un objet JSON par ligne avec `destination` (une adresse
+        ou une liste), `subject` et `content`.
+
+        Jusqu'à _BATCH_WINDOW courriels sont envoyés avant d'attendre la
+        réponse du plus ancien. Chaque courriel livré est affiché, et
+        chaque échec sur la sortie d'erreur avec son numéro de ligne.
+        """
+        try:
+            fichier = (sys.stdin if source == "-"
+                       else open(source, encoding="utf-8"))
+        except OSError as ex:
+            print(f"Erreur, lecture impossible de {source}: {ex}",
+                  file=sys.stderr)
+            return _EXIT_USAGE
+        en_vol: collections.deque[tuple[int, int]] = collections.deque()
+        envoyes = echecs = 0
+        with fichier:
+            for numero, ligne in enumerate(fichier, start=1):
+                if not ligne.strip():
+                    continue
+                try:
+                    courriel = self._batch_email(ligne)
+                except ValueError:
+                    print(f"ligne {numero}: courriel invalide", file=sys.stderr)
+                    echecs += 1
+                    continue
+                en_vol.append((numero, self._submit(gloutils.GloMessage(
+                    header=gloutils.Headers.EMAIL_SENDING, payload=courriel))))
+                if len(en_vol) >= _BATCH_WINDOW:
+                    if self._send_result(*en_vol.popleft()):
+                        envoyes += 1
+                    else:
+                        echecs += 1
+        while en_vol:
+            if self._send_result(*en_vol.popleft()):
+                envoyes += 1
+            else:
+                echecs += 1
+        print(f"{envoyes} courriel(s) envoyé(s), {echecs} échec(s).")
+        return _EXIT_FAILURE if echecs else _EXIT_OK
+
+    def _batch_email(self, ligne: str) -> gloutils.EmailContentPayload:
+        """
+        Construit le courriel décrit par une ligne JSON de `send`.
+
+        Lève ValueError si la ligne n'est pas un courriel valide.
+        """
+        match json.loads(ligne):
+            case {"destination": str() | [str(), *_] as destination,
+                  "subject": str(sujet), "content": str(contenu)
+                  } if all(isinstance(adresse, str) for adresse in destination):
+                return gloutils.EmailContentPayload(
+                    sender=self._username + '@' + gloutils.SERVER_DOMAIN,
+                    destination=destination,
+                    subject=sujet,
+                    date=gloutils.get_current_utc_time(),
+                    content=contenu)
+        raise ValueError("Courriel invalide")
+
+    def _send_result(self, numero: int, request_id: int) -> bool:
+        """
+        Attend la réponse à l'envoi de la ligne `numero` et l'affiche.
+        Retourne vrai si le courriel a été livré à tous ses destinataires.
+        """
+        reponse = self._wait(request_id)
+        match reponse:
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"recipients": list(), "errors": list()}}:
+                resultat = reponse['payload']
+                for adresse, erreur in zip(resultat['recipients'],
+                                           resultat['errors']):
+                    if erreur:
+                        print(f"ligne {numero}: {adresse}: {erreur}",
+                              file=sys.stderr)
+                if any(resultat['errors']):
+                    return False
+            case {"header": gloutils.Headers.OK}:
+                pass
+            case {"header": gloutils.Headers.ERROR}:
+                print(f"ligne {numero}: {reponse['payload']['error_message']}",
+                      file=sys.stderr)
+                return False
+            case _:
+                print(f"ligne {numero}: Erreur lors de la confirmation de l'envoi.",
+                      file=sys.stderr)
+                return False
+        print(f"ligne {numero}: Courriel envoyé avec succès")
+        return True
+
+    def _inbox_pages(self) -> Iterator[list[str]]:
+        """
+        Parcourt la liste des courriels par pages de _BATCH_PAGE_SIZE, la
+        page suivante étant demandée avant de traiter la courante.
+
+        Lève une exception GLOSocketError si la connexion est rompue ou si
+        le serveur refuse la liste.
+        """
+        offset = 0
+        request_id = self._submit(gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_READING_REQUEST,
+            payload=gloutils.InboxPagePayload(offset=0, limit=_BATCH_PAGE_SIZE)))
+        while True:
+            match self._wait(request_id):
+                case {"header": gloutils.Headers.OK,
+                      "payload": {"email_list": list() as emailList} as payload}:
+                    total = payload.get('total', len(emailList))
+                case _:
+                    raise glosocket.GLOSocketError("Liste des courriels refusée")
+            offset += len(emailList)
+            suivante = bool(emailList) and offset < total
+            if suivante:
+                request_id = self._submit(gloutils.GloMessage(
+                    header=gloutils.Headers.INBOX_READING_REQUEST,
+                    payload=gloutils.InboxPagePayload(offset=offset,
+                                                      limit=_BATCH_PAGE_SIZE)))
+            yield emailList
+            if not suivante:
+                return
+
+    def _batch_list(self, as_json: bool) -> int:
+        """
+        Affiche la liste des courriels, du plus récent au plus ancien, avec
+        le gabarit SUBJECT_DISPLAY ou un objet JSON par ligne.
+        """
+        for page in self._inbox_pages():
+            for courriel in page:
+                if as_json:
+                    print(json.dumps(_parse_subject(courriel), ensure_ascii=False))
+                else:
+                    print(courriel)
+        return _EXIT_OK
+
+    def _inbox_total(self) -> int:
+        """
+        Retourne le nombre de courriels de la boîte, avec une page vide de
+        la liste.
+
+        Lève une exception GLOSocketError si la connexion est rompue ou si
+        le serveur refuse la liste.
+        """
+        match self._wait(self._submit(gloutils.GloMessage(
+                header=gloutils.Headers.INBOX_READING_REQUEST,
+                payload=gloutils.InboxPagePayload(offset=0, limit=0)))):
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"email_list": list() as emailList} as payload}:
+                return payload.get('total', len(emailList))
+        raise glosocket.GLOSocketError("Liste des courriels refusée")
+
+    def _batch_export(self, directory: pathlib.Path) -> int:
+        """
+        Écrit chaque courriel de la boîte dans `directory`, un fichier JSON
+        par courriel, les courriels étant demandés par lots de
+        _BATCH_WINDOW (`_fetch_emails`).
+
+        Les fichiers sont numérotés à partir du plus ancien courriel
+        (`000001.json`): une boîte ne fait que grandir, ce numéro ne change
+        donc pas, et une nouvelle exportation dans le même dossier ne fait
+        qu'ajouter les courriels reçus depuis.
+
+        Les courriels reçus pendant l'exportation n'en font pas partie. Ils
+        décalent cependant les numéros du serveur, comptés à partir du plus
+        récent: le nombre de courriels est redemandé après chaque lot, et
+        un lot pendant lequel il a changé est redemandé.
+        """
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+        except OSError as ex:
+            print(f"Erreur, création impossible de {directory}: {ex}",
+                  file=sys.stderr)
+            return _EXIT_FAILURE
+        exportes = echecs = 0
+        total = actuel = self._inbox_total()
+        for debut in range(1, total + 1, _BATCH_WINDOW):
+            lot = list(range(debut, min(debut + _BATCH_WINDOW, total + 1)))
+            while True:
+                reponses = self._fetch_emails([actuel - position + 1
+                                               for position in lot])
+                avant, actuel = actuel, self._inbox_total()
+                if actuel == avant:
+                    break
+            for position, reponse in zip(lot, reponses):
+                match reponse:
+                    case {"header": gloutils.Headers.OK, "payload": dict() as courriel}:
+                        try:
+                            (directory / f"{position:06d}.json").write_text(
+                                json.dumps(courriel, ensure_ascii=False),
+                                encoding="utf-8")
+                        except OSError as ex:
+                            print(f"{position:06d}: {ex}", file=sys.stderr)
+                            echecs += 1
+                            continue
+                        exportes += 1
+                    case {"header": gloutils.Headers.ERROR,
+                          "payload": {"error_message": str(erreur)}}:
+                        print(f"{position:06d}: {erreur}", file=sys.stderr)
+                        echecs += 1
+                    case _:
+                        print(f"{position:06d}: Réponse inattendue du serveur.",
+                              file=sys.stderr)
+                        echecs += 1
+        print(f"{exportes} courriel(s) exporté(s) dans {directory}.")
+        return _EXIT_FAILURE if echecs else _EXIT_OK
+
+    def _batch_stats(self, as_json: bool) -> int:
+        """Affiche les statistiques avec STATS_DISPLAY ou en JSON."""
+        self._send(gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST))
+        match self._recv():
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"count": int(), "size": int()} as stats}:
+                if as_json:
+                    print(json.dumps({"count": stats["count"],
+                                      "size": stats["size"]}))
+                else:
+                    print(gloutils.STATS_DISPLAY.format(count=stats["count"],
+                                                        size=stats["size"]))
+                return _EXIT_OK
+        print("Erreur lors l'accès aux statistiques.", file=sys.stderr)
+        return _EXIT_FAILURE
+
+
+def _format_destination(destination) -> str:
+    """Affiche une adresse ou une liste d'adresses de destination."""
+    if isinstance(destination, list):
+        return ", ".join(destination)
+    return destination
+
+
+def _parse_subject(line: str) -> dict:
+    """
+    Décompose un élément de la liste des courriels (SUBJECT_DISPLAY). La
+    date est vide si elle n'a pas le format de get_current_utc_time.
+    """
+    correspondance = _SUBJECT_RE.fullmatch(line)
+    if correspondance is None:
+        return {"number": 0, "sender": "", "subject": line, "date": ""}
+    return {"number": int(correspondance.group("number")),
+            "sender": correspondance.group("sender"),
+            "subject": correspondance.group("subject"),
+            "date": correspondance.group("date") or ""}
+
+
+def _credentials(args: argparse.Namespace) -> tuple[str, str]:
+    """
+    Retourne le nom d'utilisateur (`--user` ou USER_ENV) et le mot de passe
+    (première ligne de `--password-file`, ou PASSWORD_ENV) du mode non
+    interactif.
+
+    Lève ValueError s'il en manque un, et OSError si le fichier ne peut pas
+    être lu.
+    """
+    username = args.user or os.environ.get(USER_ENV)
+    if not username:
+        raise ValueError(f"Nom d'utilisateur manquant (--user ou {USER_ENV}).")
+    if args.password_file is not None:
+        lignes = pathlib.Path(args.password_file).read_text(
+            encoding="utf-8").splitlines()
+        password = lignes[0] if lignes else ""
+    else:
+        password = os.environ.get(PASSWORD_ENV, "")
+    if not password:
+        raise ValueError("Mot de passe manquant (--password-file ou"
+                         f" {PASSWORD_ENV}).")
+    return username, password
+
 
 def _main() -> int:
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog="Sans sous-commande, le client est interactif. Codes de sortie"
+               " des sous-commandes: 0 succès, 1 échec d'au moins une"
+               " opération, 2 arguments ou identifiants manquants, 3"
+               " identifiants refusés, 4 connexion impossible ou rompue.")
     parser.add_argument("-d", "--destination", action="store",
                         dest="dest", required=True,
                         help="Adresse IP/URL du serveur.")
+    parser.add_argument("-f", "--format", action="store",
+                        dest="wire_format", choices=glocodec.FORMATS,
+                        default=glocodec.BINARY,
+                        help="Format des messages à proposer au serveur.")
+    parser.add_argument("--no-compression", action="store_true",
+                        dest="no_compression",
+                        help="Ne propose pas la compression des messages.")
+    parser.add_argument("-u", "--user", action="store",
+                        dest="user", default=None,
+                        help="Nom d'utilisateur des sous-commandes (par"
+                             f" défaut la variable {USER_ENV}).")
+    parser.add_argument("--password-file", action="store",
+                        dest="password_file", default=None,
+                        help="Fichier dont la première ligne est le mot de"
+                             " passe des sous-commandes (par défaut la"
+                             f" variable {PASSWORD_ENV}).")
+    commandes = parser.add_subparsers(dest="command", metavar="COMMANDE")
+    envoi = commandes.add_parser(
+        "send", help="Envoie les courriels d'un fichier JSON Lines.")
+    envoi.add_argument("--from-file", action="store",
+                       dest="from_file", required=True,
+                       help="Fichier des courriels, un objet JSON par ligne"
+                            " avec destination, subject et content (- pour"
+                            " l'entrée standard).")
+    liste = commandes.add_parser(
+        "list", help="Affiche la liste des courriels.")
+    liste.add_argument("--json", action="store_true", dest="json",
+                       help="Un objet JSON par courriel.")
+    export = commandes.add_parser(
+        "export", help="Écrit chaque courriel dans un fichier JSON, numéroté"
+                       " à partir du plus ancien.")
+    export.add_argument("directory", help="Dossier des courriels exportés.")
+    stats = commandes.add_parser(
+        "stats", help="Affiche les statistiques de la boîte.")
+    stats.add_argument("--json", action="store_true", dest="json",
+                       help="Statistiques en JSON.")
     args = parser.parse_args(sys.argv[1:])
-    client = Client(args.dest)
+    if args.command is not None:
+        try:
+            username, password = _credentials(args)
+        except (ValueError, OSError) as ex:
+            print(ex, file=sys.stderr)
+            return _EXIT_USAGE
+        client = Client(args.dest, args.wire_format,
+                        compression=not args.no_compression)
+        return client.run_batch(args, username, password)
+    client = Client(args.dest, args.wire_format,
+                    compression=not args.no_compression)
     client.run()
     return 0
 
@@ -6,34 +6,122 @@ Noms et numéros étudiants:
 - Pengdwindé Alex Auguste Ouedraogo 111 250 058
 """
 
-import hashlib
-import hmac
-import json
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import multiprocessing
 import os
 import pathlib
-import select
+import selectors
+import signal
 import socket
 import sys
 import re
+import time
+import traceback
+from typing import Iterator, Optional, Union
 
+import gloauth
+import glocodec
+import glometrics
+import gloprofile
 import glosocket
+import glosearch
+import glosqlite
+import glostorage
 import gloutils
 
+# Adresse courriel: nom d'utilisateur et domaine. Le nom a les caractères
+# permis à la création d'un compte.
+_ADDRESS_RE = re.compile(r"^([a-zA-Z0-9_.-]+)@([a-zA-Z0-9]+\.[a-zA-Z]+)$")
+_INVALID_ADDRESS = ("Une erreur est survenue lors de l'envoi du message!\n"
+                    "L'addresse de destination est invalide")
+_INVALID_EMAIL = "Le courriel est invalide"
+_REGISTER_ERROR = """La création à échouée:
+        - Le nom d'utilisateur est invalide.
+        - Le mot de passe n'est pas assez sûr."""
+_INVALID_CHOICE = "Le choix de courriel est invalide"
+_INVALID_PAGE = "La page demandée est invalide"
+
+
+class _Connection:
+    """État d'une connexion du moteur selectors."""
+
+    def __init__(self, client_soc: socket.socket) -> None:
+        self.soc = client_soc
+        self.reader = glosocket.FrameReader()
+        self.writer = glosocket.FrameWriter()
+        # Événements actuellement surveillés pour ce socket.
+        self.events = selectors.EVENT_READ
+        # Messages reçus pas encore traités, et vrai pendant qu'un message
+        # est traité par le pool, pour garder l'ordre des réponses.
+        self.pending: collections.deque[gloutils.GloMessage] = collections.deque()
+        self.busy = False
+        # Réponse en plusieurs trames en cours d'envoi, lue au rythme où le
+        # client la reçoit.
+        self.stream: Optional[Iterator[gloutils.GloMessage]] = None
+
 
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, storage: Optional[glostorage.Storage] = None,
+                 io_threads: int = 4, reuse_port: bool = False,
+                 wire_formats: tuple[str, ...] = glocodec.FORMATS,
+                 compression: bool = True,
+                 kdf_workers: Optional[int] = None,
+                 metrics_socket: Optional[pathlib.Path] = None,
+                 profiler: Optional[gloprofile.Profiler] = None) -> None:
         """
         Prépare le socket du serveur `_server_socket`
         et le met en mode écoute.
 
+        `storage` est le stockage des comptes et des courriels, par défaut
+        le dossier SERVER_DATA_DIR (`glostorage.DirectoryStorage`).
+        `io_threads` est le nombre de fils du pool qui exécute les
+        traitements (et donc les accès disque); 0 les exécute directement
+        dans la boucle du serveur.
+        `reuse_port` active SO_REUSEPORT pour que plusieurs processus
+        écoutent sur le même port.
+        `wire_formats` sont les formats de messages que le serveur accepte
+        de négocier, JSON restant toujours possible.
+        `compression` permet de compresser les messages des clients qui
+        l'acceptent.
+        `kdf_workers` est le nombre de processus qui hachent et vérifient
+        les mots de passe (un par cœur par défaut); 0 les hache dans le fil
+        qui traite le message.
+        `metrics_socket` est le chemin du socket Unix local qui expose les
+        métriques du serveur, s'il y en a un.
+        `profiler` profile les traitements des messages quand il est actif
+        (`gloprofile.Profiler`).
+
         Prépare les attributs suivants:
-        - `_client_socs` une liste des sockets clients.
+        - `_client_socs` un dictionnaire associant chaque socket client
+            à l'état de sa connexion (moteur selectors).
+        - `_selector` le sélecteur (epoll sous Linux) du moteur selectors.
+        - `_io_pool` le pool de fils des traitements, ou None.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
-
-        S'assure que les dossiers de données du serveur existent.
+        - `_formats` un dictionnaire associant chaque socket client au
+            format de messages négocié, JSON par défaut.
+        - `_compressed` l'ensemble des sockets clients dont les messages
+            sont compressés.
+        - `_streaming` l'ensemble des sockets clients qui acceptent les
+            corps de courriels en plusieurs trames (EMAIL_CHUNK).
+        - `_uploads` un dictionnaire associant chaque socket client au
+            courriel qu'il transmet en plusieurs trames et au BlobWriter
+            qui reçoit son corps.
+        - `_storage` le stockage des comptes, des boîtes et des corps de
+            courriels.
+        - `_kdf_pool` le pool de processus du hachage des mots de passe, ou
+            None.
+        - `_metrics` les métriques du serveur (`glometrics.Metrics`); les
+            appels au stockage y sont chronométrés.
+        - `_metrics_endpoint` le socket Unix des métriques, ou None.
+        - `_profiler` le profilage des traitements, ou None.
         """
         # self._server_socket
         try:
@@ -43,6 +131,8 @@ class Server:
             sys.exit(-1)
         try:
             self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         except OSError:
             print("Erreur lors de la création du socket_serveur")
             sys.exit(-1)
@@ -57,118 +147,287 @@ class Server:
             print("Erreur lors de la création du socket_serveur")
             sys.exit(-1)
         # self._client_socs
-        self._client_socs: list[socket.socket] = []
+        self._client_socs: dict[socket.socket, _Connection] = {}
+        self._selector = selectors.DefaultSelector()
+
+        # self._io_pool
+        self._io_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if io_threads > 0:
+            self._io_pool = concurrent.futures.ThreadPoolExecutor(
+                io_threads, thread_name_prefix="glo-io")
+        # Traitements terminés par le pool, et le socket qui réveille la
+        # boucle selectors pour qu'elle envoie leurs réponses.
+        self._completed: collections.deque = collections.deque()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        # Échéance de la fermeture progressive demandée par drain().
+        self._drain_deadline: Optional[float] = None
+        self._drain_requested: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_clients: set[asyncio.Task] = set()
 
         # self._logged_users
         self._logged_users: dict = {}
-        # ...
-        try:
-            pathlib.Path(gloutils.SERVER_DATA_DIR).mkdir()
-        except FileExistsError:
-            pass
-        try:
-            (pathlib.Path(gloutils.SERVER_DATA_DIR)/gloutils.SERVER_LOST_DIR).mkdir()
-        except FileExistsError:
-            pass
+
+        # self._formats
+        self._formats: dict = {}
+        self._wire_formats = wire_formats
+
+        # self._compressed
+        self._compressed: set = set()
+        self._compression = compression
+
+        # self._streaming
+        self._streaming: set = set()
+        self._uploads: dict = {}
+
+        # self._metrics
+        self._metrics = glometrics.Metrics()
+        self._profiler = profiler
+
+        # self._storage
+        if storage is None:
+            storage = glostorage.DirectoryStorage(
+                pathlib.Path(gloutils.SERVER_DATA_DIR))
+        self._storage = glometrics.TimedStorage(storage, self._metrics)
+
+        # self._kdf_pool
+        self._kdf_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if kdf_workers is None:
+            kdf_workers = os.cpu_count() or 1
+        if kdf_workers > 0:
+            # "spawn": les processus du pool ne doivent pas hériter des fils
+            # et des sockets du serveur.
+            self._kdf_pool = concurrent.futures.ProcessPoolExecutor(
+                kdf_workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=gloauth.watch_parent, initargs=(os.getpid(),))
+
+        # self._metrics_endpoint
+        self._metrics_endpoint: Optional[glometrics.MetricsEndpoint] = None
+        if metrics_socket is not None:
+            try:
+                self._metrics_endpoint = glometrics.MetricsEndpoint(
+                    metrics_socket, self._render_metrics)
+            except OSError:
+                print("Erreur lors de la création du socket des métriques")
+                sys.exit(-1)
 
     def cleanup(self) -> None:
-        """Ferme toutes les connexions résiduelles."""
-        for client_soc in self._client_socs:
+        """
+        Ferme toutes les connexions résiduelles et affiche les compteurs
+        du cache des courriels.
+        """
+        if self._storage.cache is not None:
+            stats = self._storage.cache.stats()
+            if stats["hits"] or stats["misses"]:
+                print(f"Cache des courriels: {stats['hits']} succès,"
+                      f" {stats['misses']} échecs, {stats['evictions']}"
+                      f" évictions, {stats['size']} octets"
+                      f" ({stats['entries']} courriels).")
+        for client_soc in list(self._client_socs):
             client_soc.close()
+        if self._metrics_endpoint is not None:
+            self._metrics_endpoint.close()
+        if self._io_pool is not None:
+            self._io_pool.shutdown(wait=False, cancel_futures=True)
+        if self._kdf_pool is not None:
+            self._kdf_pool.shutdown(cancel_futures=True)
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
         self._server_socket.close()
+        self._storage.close()
 
     def _accept_client(self) -> None:
-        """Accepte un nouveau client."""
-        client_socket, socket_addr = self._server_socket.accept()
-        self._client_socs.append(client_socket)
+        """Accepte les nouveaux clients en attente, en mode non bloquant."""
+        while True:
+            try:
+                client_socket, socket_addr = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client_socket.setblocking(False)
+            self._metrics.connection_opened()
+            connexion = _Connection(client_socket)
+            self._client_socs[client_socket] = connexion
+            self._selector.register(client_socket, connexion.events, connexion)
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
         if client_soc in self._logged_users:
             self._logged_users.pop(client_soc)
+        self._formats.pop(client_soc, None)
+        self._compressed.discard(client_soc)
+        self._streaming.discard(client_soc)
+        self._abort_upload(client_soc)
         if client_soc in self._client_socs:
-            self._client_socs.remove(client_soc)
+            connexion = self._client_socs.pop(client_soc)
+            self._metrics.connection_closed()
+            self._selector.unregister(client_soc)
+            if connexion.stream is not None:
+                connexion.stream.close()
         client_soc.close()
 
+    def _abort_upload(self, client_soc: socket.socket) -> None:
+        """Abandonne le courriel que le client transmettait en plusieurs trames."""
+        envoi = self._uploads.pop(client_soc, None)
+        if envoi is not None:
+            envoi[1].abort()
+
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
-                        ) -> gloutils.GloMessage:
+                        ) -> Union[gloutils.GloMessage,
+                                   concurrent.futures.Future]:
         """
         Crée un compte à partir des données du payload.
 
-        Si les identifiants sont valides, créee le dossier de l'utilisateur,
+        Si les identifiants sont valides, crée le compte dans le stockage,
         associe le socket au nouvel l'utilisateur et retourne un succès,
         sinon retourne un message d'erreur.
-        """
-        #Message d'erreur.
-        errMessage = """La création à échouée:
-        - Le nom d'utilisateur est invalide.
-        - Le mot de passe n'est pas assez sûr."""
 
+        Le mot de passe est haché par le pool de processus (`_run_kdf`):
+        la réponse est alors une Future.
+        """
         #Validation des informations fournis pas le client.
-        if ((re.search(r"[a-zA-Z0-9_.-]+", payload['username']) is not None) 
+        if ((re.fullmatch(r"[a-zA-Z0-9_.-]+", payload['username']) is not None)
             and (re.search(r"^(?=.*[A-Z])(?=.*\d).{10,}$", payload['password']) is not None)):
 
-            # Création du dossier d'utilisateur
-            userDossier = (pathlib.Path(gloutils.SERVER_DATA_DIR))/payload['username']
-            try:
-                userDossier.mkdir()
-            except FileExistsError:
-                # Nom d'utilisateur déjà utilisé, Envoyer un messege ERROR
-                errPayload = gloutils.ErrorPayload(error_message=errMessage)
+            # Nom d'utilisateur déjà utilisé, Envoyer un messege ERROR
+            if self._storage.get_password(payload['username']) is not None:
+                errPayload = gloutils.ErrorPayload(error_message=_REGISTER_ERROR)
                 return gloutils.GloMessage(header=gloutils.Headers.ERROR,payload=errPayload)
-            
-            # Hachage du mot de passe.
-            hasherPass = hashlib.sha3_512()
-            hasherPass.update(payload['password'].encode('utf-8'))
-            try:
-                (pathlib.Path(gloutils.SERVER_DATA_DIR)/payload['username']/gloutils.PASSWORD_FILENAME).write_text(hasherPass.hexdigest())
-            except FileExistsError:
-                #Suppression du dossier utilisateur crée
-                (pathlib.Path(gloutils.SERVER_DATA_DIR)/payload['username']).rmdir()
-                return gloutils.GloMessage(header=gloutils.Headers.ERROR,
-                                           payload=gloutils.ErrorPayload(error_message="Erreur lors de la création du compte d'utilisateur"))
-            # Envoyer un message OK et association du socket
-            self._logged_users[client_soc] = payload['username']
-            reponse = gloutils.GloMessage(header=gloutils.Headers.OK)
-            
-        else:
-            # Envoyer un message ERROR
-            reponse = gloutils.GloMessage(header=gloutils.Headers.ERROR,
-                                      payload=gloutils.ErrorPayload(error_message=errMessage))
-        return reponse
+
+            # Hachage du mot de passe, puis création du compte
+            return self._run_kdf(
+                functools.partial(self._add_account, client_soc,
+                                  payload['username']),
+                gloauth.hash_password, payload['password'])
+
+        # Envoyer un message ERROR
+        return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                   payload=gloutils.ErrorPayload(error_message=_REGISTER_ERROR))
+
+    def _add_account(self, client_soc: socket.socket, username: str,
+                     empreinte: str) -> gloutils.GloMessage:
+        """
+        Suite de `_create_account` une fois le mot de passe haché: crée le
+        compte et associe le socket à l'utilisateur.
+        """
+        try:
+            if not self._storage.add_user(username, empreinte):
+                errPayload = gloutils.ErrorPayload(error_message=_REGISTER_ERROR)
+                return gloutils.GloMessage(header=gloutils.Headers.ERROR,payload=errPayload)
+        except OSError:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(error_message="Erreur lors de la création du compte d'utilisateur"))
+        # Envoyer un message OK et association du socket
+        self._logged_users[client_soc] = username
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
-               ) -> gloutils.GloMessage:
+               ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
         """
         Vérifie que les données fournies correspondent à un compte existant.
 
         Si les identifiants sont valides, associe le socket à l'utilisateur et
         retourne un succès, sinon retourne un message d'erreur.
+
+        L'empreinte vient du stockage et la vérification est faite par le
+        pool de processus (`_run_kdf`): la réponse est alors une Future.
+        Une ancienne empreinte est remplacée par une empreinte scrypt après
+        une connexion réussie.
         """
-        chemin = pathlib.Path(gloutils.SERVER_DATA_DIR)
-        if (chemin/payload['username']).exists():
-            # Vérifier le mdp
-            hasherPass = hashlib.sha3_512()
-            hasherPass.update(payload['password'].encode('utf-8'))
-            if hmac.compare_digest(hasherPass.hexdigest(),(chemin/payload['username']/gloutils.PASSWORD_FILENAME).read_text()):
-                self._logged_users[client_soc] = payload['username']
-                reponse = gloutils.GloMessage(header=gloutils.Headers.OK)
-            else:
-                # Mot de passe invalide, envoi d'un message d'erreur.
-                reponse = gloutils.GloMessage(header=gloutils.Headers.ERROR,
-                                               payload=gloutils.ErrorPayload(error_message="Le mot de passe est invalide"))
-        else:
+        empreinte = self._storage.get_password(payload['username'])
+        if empreinte is None:
             # Le nom d'utilisateur est invalide, envoi d'un message d'erreur.
-            reponse = gloutils.GloMessage(header=gloutils.Headers.ERROR,
-                                           payload=gloutils.ErrorPayload(error_message="Le nom d'utilisateur est invalide"))
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(error_message="Le nom d'utilisateur est invalide"))
+        # Vérifier le mdp
+        return self._run_kdf(
+            functools.partial(self._check_login, client_soc,
+                              payload['username'], payload['password'],
+                              empreinte),
+            gloauth.verify_password, payload['password'], empreinte)
+
+    def _check_login(self, client_soc: socket.socket, username: str,
+                     password: str, empreinte: Optional[str],
+                     resultat: tuple[bool, Optional[str]]
+                     ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Suite de `_login` une fois le mot de passe vérifié contre
+        `empreinte`. Si la vérification échoue, l'empreinte a pu être
+        changée par un autre processus: elle est relue et vérifiée une
+        seconde fois (`empreinte` vaut alors None).
+        """
+        valide, nouvelle = resultat
+        if not valide and empreinte is not None:
+            fraiche = self._storage.reload_password(username)
+            if fraiche is not None and fraiche != empreinte:
+                return self._run_kdf(
+                    functools.partial(self._check_login, client_soc,
+                                      username, password, None),
+                    gloauth.verify_password, password, fraiche)
+        if not valide:
+            # Mot de passe invalide, envoi d'un message d'erreur.
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR,
+                                       payload=gloutils.ErrorPayload(error_message="Le mot de passe est invalide"))
+        if nouvelle is not None:
+            self._storage.set_password(username, nouvelle)
+        self._logged_users[client_soc] = username
+        self._storage.load_mailbox(username)
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _run_kdf(self, continuation, fonction, *args
+                 ) -> Union[gloutils.GloMessage, concurrent.futures.Future]:
+        """
+        Exécute une fonction de hachage de gloauth dans le pool de
+        processus sans l'attendre, et retourne une Future de la réponse:
+        `continuation(resultat)`, exécutée par le pool de fils quand le
+        hachage est terminé (par le fil du pool de processus qui reçoit
+        le résultat s'il n'y a pas de pool de fils). Une continuation peut
+        elle-même retourner une Future.
+
+        Ni les fils du pool ni la boucle du serveur n'attendent donc le
+        hachage: les moteurs envoient la réponse quand la Future est
+        terminée, et continuent entre-temps de servir les autres clients.
+
+        Sans pool de processus, le hachage est fait dans le fil courant et
+        la réponse est retournée directement.
+        """
+        if self._kdf_pool is None:
+            return continuation(fonction(*args))
+        reponse: concurrent.futures.Future = concurrent.futures.Future()
+
+        def executer(hachage: concurrent.futures.Future) -> None:
+            try:
+                suite = continuation(hachage.result())
+            except BaseException as ex:
+                reponse.set_exception(ex)
+                return
+            if isinstance(suite, concurrent.futures.Future):
+                _chain(suite, reponse)
+            else:
+                reponse.set_result(suite)
+
+        def termine(hachage: concurrent.futures.Future) -> None:
+            if self._io_pool is None:
+                executer(hachage)
+                return
+            try:
+                self._io_pool.submit(executer, hachage)
+            except RuntimeError as ex:
+                # Le serveur s'arrête.
+                reponse.set_exception(ex)
+
+        self._kdf_pool.submit(fonction, *args).add_done_callback(termine)
         return reponse
 
     def _logout(self, client_soc: socket.socket) -> None:
         """Déconnecte un utilisateur."""
         self._logged_users.pop(client_soc)
 
-    def _get_email_list(self, client_soc: socket.socket
+    def _get_email_list(self, client_soc: socket.socket,
+                        payload: Optional[gloutils.InboxPagePayload] = None
                         ) -> gloutils.GloMessage:
         """
         Récupère la liste des courriels de l'utilisateur associé au socket.
@@ -176,39 +435,60 @@ class Server:
         SUBJECT_DISPLAY et sont ordonnés du plus récent au plus ancien.
 
         Une absence de courriel n'est pas une erreur, mais une liste vide.
+
+        La liste est construite à partir des résumés du stockage, sans lire
+        les courriels eux-mêmes. Si le payload demande une page, seuls ses
+        éléments sont construits; leurs numéros restent ceux de la boîte
+        entière, et `total` donne le nombre de courriels.
         """
-        cheminUser = pathlib.Path(gloutils.SERVER_DATA_DIR, self._logged_users[client_soc])
+        offset, limit = 0, sys.maxsize
+        if payload is not None:
+            offset, limit = payload['offset'], payload['limit']
+            if offset < 0 or limit < 0:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(error_message=_INVALID_PAGE))
+        entrees, total = self._storage.page(self._logged_users[client_soc],
+                                            offset, limit)
         emailList: list = []
-        emailCompte = 0
-        for email in sorted(cheminUser.iterdir(), key=os.path.getmtime, reverse=True):
-            if not email.samefile(cheminUser/gloutils.PASSWORD_FILENAME):
-                emailCompte += 1
-                emailJson = (json.loads(email.read_text()))
-                emailList.append(gloutils.SUBJECT_DISPLAY.format(
-                    number=emailCompte,
-                    sender=emailJson['sender'],
-                    subject=emailJson['subject'],
-                    date=emailJson['date']))
+        for emailCompte, entree in enumerate(entrees, start=offset + 1):
+            emailList.append(gloutils.SUBJECT_DISPLAY.format(
+                number=emailCompte,
+                sender=entree['sender'],
+                subject=entree['subject'],
+                date=entree['date']))
         repEmailList = gloutils.GloMessage(
             header=gloutils.Headers.OK,
-            payload=gloutils.EmailListPayload(email_list=emailList)
+            payload=gloutils.EmailListPayload(email_list=emailList,
+                                              total=total)
         )
 
         return repEmailList
 
     def _get_email(self, client_soc: socket.socket,
                    payload: gloutils.EmailChoicePayload
-                   ) -> gloutils.GloMessage:
+                   ) -> Union[gloutils.GloMessage, Iterator[gloutils.GloMessage]]:
         """
         Récupère le contenu de l'email dans le dossier de l'utilisateur associé
         au socket.
+
+        Le courriel est retrouvé directement par son numéro. Un
+        corps de plus de STREAM_THRESHOLD octets est lu et envoyé par
+        morceaux aux clients qui l'acceptent (`_stream_email`).
         """
-        cheminUser = pathlib.Path(gloutils.SERVER_DATA_DIR, self._logged_users[client_soc])
-        emailList: list = []
-        for email in sorted(cheminUser.iterdir(), key=os.path.getmtime, reverse=True):
-            if not email.samefile(cheminUser/gloutils.PASSWORD_FILENAME):
-                emailList.append(email)
-        emailReq = json.loads(emailList[int(payload["choice"]) - 1].read_text())
+        utilisateur = self._logged_users[client_soc]
+        try:
+            numero = payload["choice"]
+            if (client_soc in self._streaming
+                    and self._storage.get(utilisateur, numero)["size"]
+                    > gloutils.STREAM_THRESHOLD):
+                return _stream_email(*self._storage.stream(
+                    utilisateur, numero, gloutils.STREAM_CHUNK_SIZE))
+            emailReq = self._storage.read(utilisateur, numero)
+        except (IndexError, ValueError):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(error_message=_INVALID_CHOICE))
         return gloutils.GloMessage(
             header=gloutils.Headers.OK,
             payload=emailReq
@@ -218,31 +498,69 @@ class Server:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
         de l'utilisateur associé au socket.
-        """
-        cheminUser = (pathlib.Path(gloutils.SERVER_DATA_DIR))/self._logged_users[client_soc]
-
-        #Nombre de courriel.
-        countStats = 0
-        sizeStats = 0
-        for fichier in cheminUser.iterdir():
-            if fichier == cheminUser/gloutils.PASSWORD_FILENAME:
-                pass
-            else:
-                countStats += 1
-                sizeStats += fichier.stat().st_size
 
+        Les compteurs sont tenus à jour à chaque livraison par le stockage,
+        les courriels ne sont donc pas parcourus.
+        """
         #Création du message d'envoi des statistiques au client.
         reponseStats = gloutils.GloMessage(
             header=gloutils.Headers.OK,
-            payload=gloutils.StatsPayload(
-                count=countStats,
-                size=sizeStats
-            )
+            payload=self._storage.stats(self._logged_users[client_soc])
         )
         return reponseStats
 
-    def _send_email(self, payload: gloutils.EmailContentPayload
-                    ) -> gloutils.GloMessage:
+    def _search(self, client_soc: socket.socket,
+                payload: gloutils.SearchPayload) -> gloutils.GloMessage:
+        """
+        Recherche les courriels de l'utilisateur associé au socket qui
+        contiennent tous les mots demandés, dans le sujet ou le corps, et
+        respectent les filtres sur l'expéditeur et la date.
+
+        La réponse est construite comme la liste des courriels, avec le
+        gabarit SUBJECT_DISPLAY et les numéros des courriels dans la boîte,
+        à partir de l'index de recherche du stockage, sans lire les
+        courriels.
+        """
+        try:
+            requete = glosearch.Query(payload)
+        except (ValueError, TypeError, AttributeError):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(error_message="La recherche est invalide"))
+        resultats = self._storage.search(self._logged_users[client_soc],
+                                         requete)
+        emailList = [gloutils.SUBJECT_DISPLAY.format(number=numero,
+                                                     sender=entree['sender'],
+                                                     subject=entree['subject'],
+                                                     date=entree['date'])
+                     for numero, entree in resultats]
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailListPayload(email_list=emailList,
+                                              total=len(emailList)))
+
+    def _get_metrics(self) -> gloutils.GloMessage:
+        """Retourne les métriques du processus serveur."""
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.MetricsPayload(metrics=self._render_metrics()))
+
+    def _render_metrics(self) -> str:
+        """
+        Rend les métriques du serveur, avec le nombre d'utilisateurs
+        connectés et les compteurs du cache des courriels.
+
+        Appelée depuis les fils du pool et celui du socket des métriques.
+        """
+        jauges: dict[str, float] = {"glo_logged_users": len(self._logged_users)}
+        if self._storage.cache is not None:
+            for nom, valeur in self._storage.cache.stats().items():
+                jauges[f"glo_cache_{nom}"] = valeur
+        return self._metrics.render(jauges)
+
+    def _send_email(self, client_soc: socket.socket,
+                    payload: gloutils.EmailContentPayload
+                    ) -> Optional[gloutils.GloMessage]:
         """
         Détermine si l'envoi est interne ou externe et:
         - Si l'envoi est interne, écris le message tel quel dans le dossier
@@ -250,131 +568,958 @@ class Server:
         - Si le destinataire n'existe pas, place le message dans le dossier
         SERVER_LOST_DIR et considère l'envoi comme un échec.
         - Si le destinataire est externe, considère l'envoi comme un échec.
+        - Si la boîte du destinataire est pleine, refuse le message sans
+        l'écrire.
+
+        `destination` peut aussi être une liste d'adresses: le message n'est
+        alors écrit qu'une fois et lié dans chaque boîte, et la réponse
+        donne le résultat de chaque destinataire (DeliveryPayload).
+
+        Si `chunked` est vrai, le corps suit dans des messages EMAIL_CHUNK
+        (`_receive_chunk`) et la réponse n'est envoyée qu'après le dernier.
 
         Retourne un messange indiquant le succès ou l'échec de l'opération.
         """
-        if re.search(r"(@[a-zA-Z0-9]+\.[a-zA-Z]+)$", payload['destination']) is not None:
-            if re.search(r"(@"+gloutils.SERVER_DOMAIN+")$", payload['destination']) is not None:
-                if ((pathlib.Path(gloutils.SERVER_DATA_DIR))/(re.split(r"(@[a-zA-Z0-9]+\.[a-zA-Z]+)$", payload["destination"])[0])).exists():
-                    #Destination interne
-                    cheminUtilisateur = (pathlib.Path(gloutils.SERVER_DATA_DIR))/(re.split(r"(@[a-zA-Z0-9]+\.[a-zA-Z]+)$", payload["destination"])[0])
-                    try:
-                        (cheminUtilisateur/(payload["date"]+payload["sender"])).write_text(json.dumps(payload))
-                    except FileExistsError:
-                        print("erreur, le fichier existe déjà!")
-                    emailConfirmation = gloutils.GloMessage(
-                        header=gloutils.Headers.OK
-                    )
-                else:
+        destinations = payload['destination']
+        if isinstance(destinations, list) and (
+                not destinations
+                or not all(isinstance(adresse, str) for adresse in destinations)):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(error_message=_INVALID_EMAIL))
+        if payload.get('chunked') is True:
+            # Un envoi précédent inachevé est abandonné.
+            self._abort_upload(client_soc)
+            self._uploads[client_soc] = (payload, self._storage.body_writer())
+            return None
+        return self._deliver_all(self._storage.store_email(payload),
+                                 payload['content'])
+
+    def _receive_chunk(self, client_soc: socket.socket,
+                       payload: gloutils.ChunkPayload
+                       ) -> Optional[gloutils.GloMessage]:
+        """
+        Ajoute un morceau au corps du courriel que le client transmet en
+        plusieurs trames, sans le garder en mémoire (BodyWriter).
+
+        Après le dernier morceau, le corps est rangé dans le stockage et le
+        courriel est livré comme par `_send_email`, dont la réponse est
+        retournée.
+        """
+        envoi = self._uploads.get(client_soc)
+        if envoi is None:
+            raise ValueError("Aucun courriel n'est en cours d'envoi")
+        entete, redacteur = envoi
+        try:
+            redacteur.write(payload['data'].encode('utf-8'))
+            if not payload['last']:
+                return None
+            del self._uploads[client_soc]
+            cle = redacteur.commit()
+        except OSError:
+            self._uploads.pop(client_soc, None)
+            redacteur.abort()
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(error_message="Erreur lors de l'écriture du courriel"))
+        return self._deliver_all(
+            glostorage.make_stored_email(entete, cle, redacteur.size))
+
+    def _deliver_all(self, fiche: glostorage.StoredEmail,
+                     contenu: Optional[str] = None) -> gloutils.GloMessage:
+        """
+        Livre le courriel à tous ses destinataires et retourne la réponse:
+        OK ou l'erreur pour une seule adresse, le résultat de chaque
+        destinataire (DeliveryPayload) pour une liste.
+
+        `contenu` est le corps reçu en une fois, indexé pour la recherche
+        sans être relu du stockage.
+        """
+        destinations = fiche['destination']
+        if isinstance(destinations, str):
+            erreur = self._deliver(fiche, [destinations], contenu)[0]
+            if erreur:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(error_message=erreur))
+            return gloutils.GloMessage(header=gloutils.Headers.OK)
+        # Un destinataire présent plusieurs fois ne reçoit qu'une copie.
+        destinataires = list(dict.fromkeys(destinations))
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.DeliveryPayload(
+                recipients=destinataires,
+                errors=self._deliver(fiche, destinataires, contenu)))
+
+    def _deliver(self, fiche: glostorage.StoredEmail,
+                 destinataires: list[str],
+                 contenu: Optional[str] = None) -> list[str]:
+        """
+        Livre le courriel à chaque destinataire et retourne, dans le même
+        ordre, le message d'erreur de chacun ou une chaîne vide.
+
+        Le corps est déjà rangé dans le stockage, qui livre le courriel en
+        une fois à tous les destinataires internes.
+        """
+        erreurs: list[str] = []
+        internes: list[tuple[int, str]] = []
+        for adresse in destinataires:
+            correspondance = _ADDRESS_RE.match(adresse)
+            if (correspondance is None
+                    or correspondance.group(2) != gloutils.SERVER_DOMAIN):
+                #Destination externe
+                erreurs.append(_INVALID_ADDRESS)
+                continue
+            internes.append((len(erreurs), correspondance.group(1)))
+            erreurs.append("")
+        if internes:
+            resultats = self._storage.deliver(
+                fiche, [utilisateur for _, utilisateur in internes], contenu)
+            for (position, _), resultat in zip(internes, resultats):
+                if resultat == glostorage.Delivery.UNKNOWN:
                     # Destinataire interne inconnu
-                    cheminPerdu = (pathlib.Path(gloutils.SERVER_DATA_DIR))/gloutils.SERVER_LOST_DIR
-                    try:
-                        (cheminPerdu/(payload["date"]+payload["destination"])).write_text(json.dumps(payload))
-                    except FileExistsError:
-                        print("Erreur, le fichier existe déjà!")
-                    emailConfirmation = gloutils.GloMessage(
-                        header=gloutils.Headers.ERROR,
-                        payload=gloutils.ErrorPayload(error_message="""Une erreur est survenue lors de l'envoi du message!\nL'addresse de destination est invalide"""))
+                    erreurs[position] = _INVALID_ADDRESS
+                elif resultat == glostorage.Delivery.FULL:
+                    erreurs[position] = "La boîte du destinataire est pleine"
+        return erreurs
+
+    def _negotiate(self, client_soc: socket.socket,
+                   payload: gloutils.NegotiationPayload
+                   ) -> gloutils.GloMessage:
+        """
+        Retient le premier format de messages proposé par le client que le
+        serveur accepte, JSON à défaut, et le retourne au client.
+
+        La réponse et tous les messages suivants du serveur utilisent ce
+        format. La compression des messages du serveur est activée si le
+        client la propose et que le serveur la permet, et les corps en
+        plusieurs trames si le client les accepte.
+        """
+        choix = glocodec.choose_format(payload['formats'], self._wire_formats)
+        self._formats[client_soc] = choix
+        compression = self._compression and payload.get('compression') is True
+        if compression:
+            self._compressed.add(client_soc)
         else:
-            #Destination externe
-            emailConfirmation = gloutils.GloMessage(
-                header=gloutils.Headers.ERROR,
-                payload=gloutils.ErrorPayload(error_message="""Une erreur est survenue lors de l'envoi du message!
-                                                L'addresse de destination est invalide"""))
+            self._compressed.discard(client_soc)
+        streaming = payload.get('streaming') is True
+        if streaming:
+            self._streaming.add(client_soc)
+        else:
+            self._streaming.discard(client_soc)
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.NegotiationPayload(formats=[choix],
+                                                compression=compression,
+                                                streaming=streaming))
+
+    def _encode(self, client_soc: socket.socket,
+                message: gloutils.GloMessage) -> bytes:
+        """Encode un message dans le format négocié avec le client."""
+        return glocodec.encode(message,
+                               self._formats.get(client_soc, glocodec.JSON))
+
+    def _handle_message(self, client_soc: socket.socket,
+                        message: gloutils.GloMessage
+                        ) -> Union[gloutils.GloMessage,
+                                   Iterator[gloutils.GloMessage],
+                                   concurrent.futures.Future, None]:
+        """
+        Traite un message reçu d'un client et retourne la réponse à lui
+        envoyer, ou None si l'entête n'appelle pas de réponse. Une réponse
+        en plusieurs trames est un itérateur de messages, à envoyer au fur
+        et à mesure. Une réponse qui attend le hachage d'un mot de passe
+        (`_run_kdf`) est une Future de la réponse, que le moteur envoie
+        quand elle est terminée sans bloquer les autres clients.
 
-        return emailConfirmation
+        Utilisé par tous les moteurs du serveur. L'entête BYE est géré par
+        le moteur, puisqu'il ferme la connexion.
+
+        Le `request_id` du message, s'il y en a un, est recopié dans la
+        réponse. Les réponses sont envoyées dans l'ordre des messages reçus
+        sur chaque connexion.
+
+        Lève ValueError si le message est mal formé.
+
+        La durée du traitement, attente du hachage comprise, est comptée
+        dans les métriques sous le nom de l'entête, en erreur si la réponse
+        est ERROR ou si le message est mal formé. Pendant un profilage, le
+        traitement est profilé sous le même nom.
+        """
+        entete = _header_name(message)
+        debut = time.perf_counter()
+        try:
+            if self._profiler is not None and self._profiler.active:
+                reponse = self._profiler.call(entete, self._dispatch,
+                                              client_soc, message)
+            else:
+                reponse = self._dispatch(client_soc, message)
+        except BaseException:
+            self._metrics.request(entete, time.perf_counter() - debut, True)
+            raise
+        if not isinstance(reponse, concurrent.futures.Future):
+            return self._finish_reply(entete, debut, message, reponse)
+        finale: concurrent.futures.Future = concurrent.futures.Future()
+
+        def terminer(attente: concurrent.futures.Future) -> None:
+            try:
+                resultat = attente.result()
+            except BaseException as ex:
+                self._metrics.request(entete, time.perf_counter() - debut, True)
+                finale.set_exception(ex)
+                return
+            finale.set_result(self._finish_reply(entete, debut, message,
+                                                 resultat))
+
+        reponse.add_done_callback(terminer)
+        return finale
+
+    def _finish_reply(self, entete: str, debut: float,
+                      message: gloutils.GloMessage,
+                      reponse: Union[gloutils.GloMessage,
+                                     Iterator[gloutils.GloMessage], None]
+                      ) -> Union[gloutils.GloMessage,
+                                 Iterator[gloutils.GloMessage], None]:
+        """
+        Compte la durée du traitement dans les métriques et recopie le
+        `request_id` du message dans la réponse.
+        """
+        erreur = (isinstance(reponse, dict)
+                  and reponse.get("header") == gloutils.Headers.ERROR)
+        self._metrics.request(entete, time.perf_counter() - debut, erreur)
+        if reponse is not None and "request_id" in message:
+            if isinstance(reponse, dict):
+                reponse["request_id"] = message["request_id"]
+            else:
+                reponse = _with_request_id(reponse, message["request_id"])
+        return reponse
+
+    def _dispatch(self, client_soc: socket.socket,
+                  message: gloutils.GloMessage
+                  ) -> Union[gloutils.GloMessage,
+                             Iterator[gloutils.GloMessage], None]:
+        """Appelle le traitement correspondant à l'entête du message."""
+        match message:
+            #AUTH_REGISTER
+            case {"header": gloutils.Headers.AUTH_REGISTER,
+                  "payload": {"username": str(), "password": str()}}:
+                return self._create_account(client_soc, message['payload'])
+            #AUTH_LOGIN
+            case {"header": gloutils.Headers.AUTH_LOGIN,
+                  "payload": {"username": str(), "password": str()}}:
+                return self._login(client_soc, message['payload'])
+            case {"header": gloutils.Headers.AUTH_REGISTER
+                  | gloutils.Headers.AUTH_LOGIN}:
+                raise ValueError("Le message ne contient pas le bon payload")
+            #NEGOTIATE
+            case {"header": gloutils.Headers.NEGOTIATE,
+                  "payload": {"formats": list()}}:
+                return self._negotiate(client_soc, message['payload'])
+            case {"header": int()} if client_soc not in self._logged_users:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(error_message="Vous devez être connecté"))
+            #AUTH_LOGOUT
+            case {"header": gloutils.Headers.AUTH_LOGOUT}:
+                self._logout(client_soc)
+                return None
+            #STATS_REQUEST
+            case {"header": gloutils.Headers.STATS_REQUEST}:
+                return self._get_stats(client_soc)
+            #EMAIL_SENDING
+            case {"header": gloutils.Headers.EMAIL_SENDING,
+                  "payload": {"sender": str(), "destination": str() | list(),
+                              "subject": str(), "date": str(),
+                              "content": str()}}:
+                return self._send_email(client_soc, message["payload"])
+            case {"header": gloutils.Headers.EMAIL_SENDING}:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(error_message=_INVALID_EMAIL))
+            case {"header": gloutils.Headers.EMAIL_CHUNK,
+                  "payload": {"data": str(), "last": bool()}}:
+                return self._receive_chunk(client_soc, message["payload"])
+            case {"header": gloutils.Headers.INBOX_READING_REQUEST,
+                  "payload": {"offset": int(offset), "limit": int(limit)}} if (
+                      not isinstance(offset, bool)
+                      and not isinstance(limit, bool)):
+                return self._get_email_list(client_soc, message['payload'])
+            case {"header": gloutils.Headers.INBOX_READING_REQUEST,
+                  "payload": {"offset": _} | {"limit": _}}:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(error_message=_INVALID_PAGE))
+            case {"header": gloutils.Headers.INBOX_READING_REQUEST}:
+                return self._get_email_list(client_soc)
+            case {"header": gloutils.Headers.INBOX_READING_CHOICE,
+                  "payload": {"choice": int(choice)}} if not isinstance(choice, bool):
+                return self._get_email(client_soc, message['payload'])
+            case {"header": gloutils.Headers.INBOX_READING_CHOICE}:
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.ERROR,
+                    payload=gloutils.ErrorPayload(error_message=_INVALID_CHOICE))
+            #SEARCH
+            case {"header": gloutils.Headers.SEARCH,
+                  "payload": {"terms": str()}}:
+                return self._search(client_soc, message['payload'])
+            #METRICS
+            case {"header": gloutils.Headers.METRICS}:
+                return self._get_metrics()
+        raise ValueError("Le message ne contient pas d'entête valide")
+
+    def _queue_reply(self, connexion: _Connection,
+                     reponse: Union[gloutils.GloMessage,
+                                    Iterator[gloutils.GloMessage]]) -> None:
+        """
+        Ajoute la réponse au tampon d'envoi du client. Une réponse en
+        plusieurs trames est transmise par `_pump_stream` au fur et à
+        mesure que le tampon se vide.
+        """
+        if isinstance(reponse, dict):
+            donnees = self._encode(connexion.soc, reponse)
+            self._metrics.transferred(sent=len(donnees))
+            connexion.writer.write(donnees,
+                                   compress=connexion.soc in self._compressed)
+        else:
+            connexion.stream = reponse
+
+    def _pump_stream(self, connexion: _Connection) -> bool:
+        """
+        Ajoute au tampon d'envoi vide la trame suivante de la réponse en
+        plusieurs trames. Retourne faux si le client a été retiré.
+        """
+        while connexion.stream is not None and not connexion.writer:
+            try:
+                message = next(connexion.stream)
+            except StopIteration:
+                connexion.stream = None
+                break
+            except OSError:
+                print("Erreur lors de la lecture d'un courriel.")
+                self._remove_client(connexion.soc)
+                return False
+            self._queue_reply(connexion, message)
+        return True
+
+    def _flush_client(self, connexion: _Connection) -> None:
+        """
+        Transmet les réponses en attente du client sans bloquer et ne
+        surveille l'écriture que s'il en reste.
+
+        Une réponse en plusieurs trames n'est lue qu'au rythme où le client
+        la reçoit; à sa fin, les messages suivants du client sont traités.
+        """
+        while True:
+            debut = time.perf_counter()
+            try:
+                vide = connexion.writer.flush_to(connexion.soc)
+            except glosocket.GLOSocketError:
+                print("Erreur lors de l'envoi d'une réponse.")
+                self._remove_client(connexion.soc)
+                return
+            finally:
+                self._metrics.network("send", time.perf_counter() - debut)
+            if not vide or connexion.stream is None:
+                break
+            if not self._pump_stream(connexion):
+                return
+            if connexion.stream is None and not self._process_pending(connexion):
+                return
+        events = selectors.EVENT_READ
+        if not vide:
+            events |= selectors.EVENT_WRITE
+        if events != connexion.events:
+            connexion.events = events
+            self._selector.modify(connexion.soc, events, connexion)
+
+    def _read_client(self, connexion: _Connection) -> None:
+        """
+        Accumule les données reçues du client et traite chaque message
+        complet, dans l'ordre de réception.
+        """
+        waiter = connexion.soc
+        debut = time.perf_counter()
+        try:
+            messages = connexion.reader.feed_from(waiter)
+        except glosocket.GLOSocketError:
+            self._remove_client(waiter)
+            print("Erreur lors de la réception d'un message")
+            return
+        self._metrics.network("recv", time.perf_counter() - debut,
+                              sum(map(len, messages)))
+        for trame in messages:
+            try:
+                connexion.pending.append(glocodec.decode(trame))
+            except ValueError:
+                self._remove_client(waiter)
+                print("Erreur lors de la réception d'un message")
+                return
+        if not self._process_pending(connexion):
+            return
+        if connexion.reader.closed:
+            self._remove_client(waiter)
+            return
+        self._flush_client(connexion)
+
+    def _process_pending(self, connexion: _Connection) -> bool:
+        """
+        Traite les messages en attente du client dans l'ordre de réception.
+
+        Avec un pool, un seul message du client est confié au pool à la
+        fois; les suivants attendent sa réponse, comme ils attendent celle
+        d'un message qui attend le hachage d'un mot de passe. Retourne faux
+        si le client a été retiré.
+        """
+        waiter = connexion.soc
+        while (connexion.pending and not connexion.busy
+               and connexion.stream is None):
+            message = connexion.pending.popleft()
+            if _is_bye(message):
+                self._flush_client(connexion)
+                self._remove_client(waiter)
+                return False
+            if self._io_pool is not None:
+                self._wait_reply(connexion, self._io_pool.submit(
+                    self._handle_message, waiter, message))
+                break
+            try:
+                reponse = self._handle_message(waiter, message)
+            except Exception as ex:
+                _report_failure(ex)
+                self._remove_client(waiter)
+                return False
+            if isinstance(reponse, concurrent.futures.Future):
+                # Réponse qui attend le hachage d'un mot de passe.
+                self._wait_reply(connexion, reponse)
+                break
+            if reponse is not None:
+                self._queue_reply(connexion, reponse)
+        return True
+
+    def _wait_reply(self, connexion: _Connection,
+                    future: concurrent.futures.Future) -> None:
+        """
+        Envoie la réponse du client quand `future` sera terminée, par
+        `_finish_jobs`; ses messages suivants attendent jusque-là.
+        """
+        connexion.busy = True
+        future.add_done_callback(functools.partial(self._job_done, connexion))
+
+    def _job_done(self, connexion: _Connection,
+                  future: concurrent.futures.Future) -> None:
+        """
+        Appelé par le fil qui termine un traitement ou un hachage: confie
+        la réponse à la boucle selectors et la réveille.
+        """
+        self._completed.append((connexion, future))
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            # La boucle a déjà un réveil en attente, ou le serveur s'arrête.
+            pass
+
+    def _finish_jobs(self) -> None:
+        """
+        Envoie les réponses des traitements terminés par le pool et de
+        ceux qui attendaient le hachage d'un mot de passe.
+        """
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._completed:
+            connexion, future = self._completed.popleft()
+            connexion.busy = False
+            waiter = connexion.soc
+            if waiter not in self._client_socs:
+                # Le client est parti pendant le traitement, qui a pu le
+                # connecter après son départ.
+                self._logged_users.pop(waiter, None)
+                continue
+            try:
+                reponse = future.result()
+            except Exception as ex:
+                _report_failure(ex)
+                self._remove_client(waiter)
+                continue
+            if isinstance(reponse, concurrent.futures.Future):
+                self._wait_reply(connexion, reponse)
+                continue
+            if reponse is not None:
+                self._queue_reply(connexion, reponse)
+            if self._process_pending(connexion):
+                self._flush_client(connexion)
+
+    def drain(self, timeout: float) -> None:
+        """
+        Arrête d'accepter de nouveaux clients et fait revenir le moteur
+        quand les clients connectés sont partis, ou au plus tard après
+        `timeout` secondes.
+
+        Peut être appelée depuis un gestionnaire de signal.
+        """
+        self._drain_deadline = time.monotonic() + timeout
+        if self._loop is not None and self._drain_requested is not None:
+            self._loop.call_soon_threadsafe(self._drain_requested.set)
+            return
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
 
     def run(self):
-        """Point d'entrée du serveur."""
-        waiters = []
+        """
+        Point d'entrée du serveur, moteur selectors.
+
+        Les sockets sont non bloquants et surveillés par un sélecteur
+        (epoll sous Linux); un client qui n'envoie qu'une partie d'un
+        message ne bloque donc pas les autres. Les traitements sont confiés
+        au pool `_io_pool`, la boucle continuant de servir les autres
+        sockets en attendant leurs réponses.
+
+        Revient après une fermeture progressive demandée par drain().
+        """
+        self._server_socket.setblocking(False)
+        self._selector.register(self._server_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
         while True:
-            # Select readable sockets
-            # try:
-            #     result = select.select([self._server_socket] + self._client_socs, [], [])
-            # except TypeError:
-            #     print("Erreur lors de la selection.")
-            #     sys.exit(-1)
-            result = select.select([self._server_socket] + self._client_socs, [], [])
-            waiters: list[socket.socket] = result[0]
-            for waiter in waiters:
+            timeout = None
+            if self._drain_deadline is not None:
+                if self._server_socket.fileno() != -1:
+                    self._selector.unregister(self._server_socket)
+                    self._server_socket.close()
+                if (not self._client_socs
+                        or time.monotonic() >= self._drain_deadline):
+                    return
+                timeout = 1.0
+            for key, events in self._selector.select(timeout):
                 # Handle sockets
-                if waiter == self._server_socket:
+                if key.fileobj is self._server_socket:
                     self._accept_client()
-                else:
-                    try:
-                        message = json.loads(glosocket.recv_mesg(waiter))
-                    except json.JSONDecodeError:
-                        self._remove_client(waiter)
-                        print("Erreur lors de l'authentification du socket")
-                        # print("Erreur lors de l'extraction des infos du messages.")
-                        continue
-                    except glosocket.GLOSocketError:
-                        self._remove_client(waiter)
-                        print("Erreur lors de l'authentification du socket")
-                        continue
-                    # if headers et payload present.
-                    #
-                    if message['header'] is not None:
-                        match message:
-                            case {"header": gloutils.Headers.BYE}:
-                                self._remove_client(waiter)
-                            #AUTH_REGISTER
-                            case {"header": gloutils.Headers.AUTH_REGISTER}:
-                                if ("username" in message['payload'] and "password" in message['payload']):
-                                    regReponse = self._create_account(waiter, message['payload'])
-                                    glosocket.send_mesg(waiter, json.dumps(regReponse))
-                                    continue
-                                else:
-                                    print("Erreur le message ne contient pas et/ou pas le bon gloutils.payload")
-                                    self._remove_client(waiter)
-                                    continue
-                            #AUTH_LOGIN
-                            case {"header": gloutils.Headers.AUTH_LOGIN}:
-                                authLogReponse = self._login(waiter, message['payload'])
-                                try:
-                                    glosocket.send_mesg(waiter, json.dumps(authLogReponse))
-                                except glosocket.GLOSocketError:
-                                    print("Erreur lors de l'envoi de la confirmation de connextion par le serveur.")
-                                continue
-                            #AUTH_LOGOUT
-                            case {"header": gloutils.Headers.AUTH_LOGOUT}:
-                                self._logout(waiter)
-                                continue
-                            #STATS_REQUEST
-                            case {"header": gloutils.Headers.STATS_REQUEST}:
-                                try:
-                                    demandeStats = self._get_stats(waiter)
-                                except OSError:
-                                    print("Erreur la demande de statistique.")
-                                    pass
-                                try:
-                                    glosocket.send_mesg(waiter, json.dumps(demandeStats))
-                                except glosocket.GLOSocketError:
-                                    print("Erreur lors de l'envoi d'une demande de statistiques.")
-                                    self._remove_client(waiter)
-                                    continue
-                            #EMAIL_SENDING
-                            case {"header": gloutils.Headers.EMAIL_SENDING}:
-                                glosocket.send_mesg(waiter, json.dumps(self._send_email(message["payload"])))
-                            case {"header": gloutils.Headers.INBOX_READING_REQUEST}:
-                                glosocket.send_mesg(waiter, json.dumps(self._get_email_list(waiter)))
-                            case {"header": gloutils.Headers.INBOX_READING_CHOICE}:
-                                glosocket.send_mesg(waiter, json.dumps(self._get_email(waiter, message['payload'])))
+                    continue
+                if key.fileobj is self._wakeup_r:
+                    self._finish_jobs()
+                    continue
+                connexion: _Connection = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._flush_client(connexion)
+                if (events & selectors.EVENT_READ
+                        and connexion.soc in self._client_socs):
+                    self._read_client(connexion)
+
+    async def _serve_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        """
+        Coroutine servant un client du moteur asyncio jusqu'à sa
+        déconnexion.
 
+        Le socket du transport sert de clé dans `_logged_users`, comme le
+        socket client du moteur selectors.
+        """
+        client_soc = writer.get_extra_info("socket")
+        task = asyncio.current_task()
+        self._async_clients.add(task)
+        self._metrics.connection_opened()
+        try:
+            while True:
+                try:
+                    trame = await glosocket.recv_frame_async(reader)
+                    self._metrics.transferred(received=len(trame))
+                    message = glocodec.decode(trame)
+                except (ValueError, glosocket.GLOSocketError):
+                    break
+                if _is_bye(message):
+                    break
+                try:
+                    if self._io_pool is None:
+                        reponse = self._handle_message(client_soc, message)
                     else:
-                        print("Error le message ne contient pas de gloutils.Headers")
-                        self._remove_client(waiter)
-                        continue
+                        reponse = await asyncio.get_running_loop().run_in_executor(
+                            self._io_pool, self._handle_message,
+                            client_soc, message)
+                    if isinstance(reponse, concurrent.futures.Future):
+                        # Hachage d'un mot de passe: la boucle sert les
+                        # autres clients en attendant.
+                        reponse = await asyncio.wrap_future(reponse)
+                except Exception as ex:
+                    _report_failure(ex)
+                    break
+                if isinstance(reponse, dict):
+                    await self._send_async(writer, client_soc, reponse)
+                elif reponse is not None:
+                    # Réponse en plusieurs trames: chacune est lue quand la
+                    # précédente est transmise.
+                    with contextlib.closing(reponse):
+                        for trame in reponse:
+                            await self._send_async(writer, client_soc, trame)
+        except glosocket.GLOSocketError:
+            print("Erreur lors de l'envoi d'une réponse.")
+        except OSError:
+            print("Erreur lors de la lecture d'un courriel.")
+        except asyncio.CancelledError:
+            # Fin du délai de fermeture progressive: on ferme simplement.
+            pass
+        finally:
+            self._async_clients.discard(task)
+            self._metrics.connection_closed()
+            self._logged_users.pop(client_soc, None)
+            self._formats.pop(client_soc, None)
+            self._compressed.discard(client_soc)
+            self._streaming.discard(client_soc)
+            self._abort_upload(client_soc)
+            writer.close()
 
+    async def _send_async(self, writer: asyncio.StreamWriter,
+                          client_soc: socket.socket,
+                          message: gloutils.GloMessage) -> None:
+        """
+        Envoie un message au client du moteur asyncio. L'attente que le
+        client reçoive les données compte dans le temps réseau.
+        """
+        donnees = self._encode(client_soc, message)
+        debut = time.perf_counter()
+        try:
+            await glosocket.send_frame_async(
+                writer, donnees, compress=client_soc in self._compressed)
+        finally:
+            self._metrics.network("send", time.perf_counter() - debut,
+                                  len(donnees))
 
-def _main() -> int:
-    server = Server()
+    async def _run_asyncio(self) -> None:
+        """
+        Sert les clients avec asyncio sur le socket déjà en écoute,
+        jusqu'à une fermeture progressive demandée par drain().
+        """
+        self._loop = asyncio.get_running_loop()
+        self._drain_requested = asyncio.Event()
+        server = await asyncio.start_server(self._serve_client,
+                                            sock=self._server_socket)
+        await self._drain_requested.wait()
+        server.close()
+        if self._async_clients:
+            await asyncio.wait(set(self._async_clients),
+                               timeout=max(0.0, self._drain_deadline - time.monotonic()))
+
+    def run_asyncio(self) -> None:
+        """Point d'entrée du serveur, moteur asyncio."""
+        asyncio.run(self._run_asyncio())
+
+
+def _stream_email(entete: gloutils.EmailContentPayload,
+                  morceaux: Iterator[str]) -> Iterator[gloutils.GloMessage]:
+    """
+    Réponse en plusieurs trames d'un courriel: le courriel sans son corps,
+    marqué `chunked`, puis chaque morceau du corps dans un message
+    EMAIL_CHUNK, le dernier étant vide et marqué `last`.
+    """
+    entete['chunked'] = True
+    with contextlib.closing(morceaux):
+        yield gloutils.GloMessage(header=gloutils.Headers.OK, payload=entete)
+        for morceau in morceaux:
+            yield gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_CHUNK,
+                payload=gloutils.ChunkPayload(data=morceau, last=False))
+        yield gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_CHUNK,
+            payload=gloutils.ChunkPayload(data="", last=True))
+
+
+def _with_request_id(messages: Iterator[gloutils.GloMessage],
+                     request_id: int) -> Iterator[gloutils.GloMessage]:
+    """Recopie `request_id` dans chaque trame d'une réponse en plusieurs trames."""
+    with contextlib.closing(messages):
+        for message in messages:
+            message["request_id"] = request_id
+            yield message
+
+
+def _header_name(message: gloutils.GloMessage) -> str:
+    """Nom de l'entête d'un message reçu, pour les métriques."""
+    header = message.get("header") if isinstance(message, dict) else None
     try:
-        server.run()
+        return gloutils.Headers(header).name
+    except ValueError:
+        return "INVALID"
+
+
+def _chain(source: concurrent.futures.Future,
+           destination: concurrent.futures.Future) -> None:
+    """Termine `destination` avec le résultat ou l'erreur de `source`."""
+    def recopier(future: concurrent.futures.Future) -> None:
+        try:
+            destination.set_result(future.result())
+        except BaseException as ex:
+            destination.set_exception(ex)
+    source.add_done_callback(recopier)
+
+
+def _report_failure(ex: Exception) -> None:
+    """
+    Affiche l'erreur d'un traitement de message. Le client qui l'a causée
+    est retiré, les autres continuent d'être servis; une erreur autre
+    qu'un message mal formé (ValueError) est affichée avec sa trace.
+    """
+    if isinstance(ex, ValueError):
+        print("Erreur:", ex)
+    else:
+        print("Erreur inattendue lors du traitement d'un message:")
+        traceback.print_exception(ex)
+
+
+def _is_bye(message: gloutils.GloMessage) -> bool:
+    """Indique si le message annonce la déconnexion du client."""
+    return isinstance(message, dict) and message.get("header") == gloutils.Headers.BYE
+
+
+def _open_storage(args: argparse.Namespace) -> glostorage.Storage:
+    """Ouvre le stockage choisi par `--storage` dans SERVER_DATA_DIR."""
+    data_dir = pathlib.Path(gloutils.SERVER_DATA_DIR)
+    quota = glostorage.Quota(count=args.quota_count, size=args.quota_size)
+    cache = glostorage.MessageCache(args.cache_size)
+    if args.storage == "sqlite":
+        return glosqlite.SQLiteStorage(data_dir/gloutils.SQLITE_FILENAME,
+                                       quota, cache)
+    return glostorage.DirectoryStorage(data_dir, quota, cache, args.segments)
+
+
+def _serve(args: argparse.Namespace, reuse_port: bool = False) -> int:
+    """
+    Sert les clients dans le processus courant jusqu'à SIGTERM (fermeture
+    progressive) ou Ctrl-C.
+
+    Avec plusieurs processus serveurs, chacun expose ses métriques sur son
+    propre socket, suffixé de son pid.
+
+    SIGUSR1 démarre le profilage des traitements et SIGUSR2 l'arrête et
+    écrit son rapport dans `--profile-dir`, sans interrompre le service.
+    Un profilage encore actif à l'arrêt du serveur est aussi écrit.
+    """
+    metrics_socket = None
+    if args.metrics_socket is not None:
+        metrics_socket = pathlib.Path(args.metrics_socket)
+        if reuse_port:
+            metrics_socket = metrics_socket.with_name(
+                f"{metrics_socket.name}.{os.getpid()}")
+    profiler = gloprofile.Profiler(pathlib.Path(args.profile_dir))
+    server = Server(_open_storage(args),
+                    io_threads=args.io_threads, reuse_port=reuse_port,
+                    wire_formats=((glocodec.JSON,) if args.json_only
+                                  else glocodec.FORMATS),
+                    compression=not args.no_compression,
+                    kdf_workers=(args.kdf_workers
+                                 if args.kdf_workers is not None
+                                 else max(1, (os.cpu_count() or 1)
+                                          // max(1, args.workers))),
+                    metrics_socket=metrics_socket,
+                    profiler=profiler)
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: server.drain(args.drain_timeout))
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: profiler.request_start())
+        signal.signal(signal.SIGUSR2,
+                      lambda signum, frame: profiler.request_stop())
+    try:
+        if args.engine == "asyncio":
+            server.run_asyncio()
+        else:
+            server.run()
     except KeyboardInterrupt:
+        pass
+    finally:
         server.cleanup()
+        try:
+            chemin = profiler.stop()
+        except OSError as ex:
+            print("Erreur lors de l'écriture du profil:", ex)
+        else:
+            if chemin is not None:
+                print(f"Profil écrit dans {chemin}.")
     return 0
 
 
+def _supervise(args: argparse.Namespace) -> int:
+    """
+    Lance `args.workers` processus serveurs qui écoutent tous sur le port
+    du serveur grâce à SO_REUSEPORT.
+
+    Un processus qui meurt est relancé. SIGTERM ou Ctrl-C demande à chaque
+    processus une fermeture progressive, puis attend leur fin. SIGUSR1 et
+    SIGUSR2 (profilage) sont relayés à chaque processus.
+    """
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        print("Le mode multiprocessus n'est pas disponible sur ce système.")
+        return -1
+    workers: dict[int, float] = {}
+    arret = False
+
+    def demarrer() -> None:
+        pid = os.fork()
+        if pid == 0:
+            # Processus serveur: seul le superviseur réagit à Ctrl-C.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if hasattr(signal, "SIGUSR1"):
+                # Jusqu'à ce que _serve installe les siens.
+                signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+                signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+            code = 1
+            try:
+                code = _serve(args, reuse_port=True)
+            finally:
+                os._exit(code)
+        workers[pid] = time.monotonic()
+
+    def arreter(signum, frame) -> None:
+        nonlocal arret
+        arret = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def relayer(signum, frame) -> None:
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, arreter)
+    signal.signal(signal.SIGINT, arreter)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, relayer)
+        signal.signal(signal.SIGUSR2, relayer)
+    for _ in range(args.workers):
+        demarrer()
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        debut = workers.pop(pid, None)
+        if arret or debut is None:
+            continue
+        print(f"Le processus {pid} s'est arrêté"
+              f" (code {os.waitstatus_to_exitcode(status)}), relance.")
+        if time.monotonic() - debut < 1.0:
+            # Évite de relancer en boucle un processus qui échoue au démarrage.
+            time.sleep(1.0)
+        if not arret:
+            demarrer()
+    return 0
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild-index", action="store_true",
+                        dest="rebuild_index",
+                        help="Reconstruit l'index de chaque boîte existante"
+                             " puis quitte.")
+    parser.add_argument("--gc", action="store_true",
+                        dest="gc",
+                        help="Supprime les corps de courriels qui ne sont"
+                             " plus référencés puis quitte.")
+    parser.add_argument("--gc-grace", action="store", type=float,
+                        dest="gc_grace", default=3600.0,
+                        help="Âge minimal en secondes d'un corps non"
+                             " référencé avant sa suppression.")
+    parser.add_argument("--storage", action="store",
+                        dest="storage", choices=("directory", "sqlite"),
+                        default="directory",
+                        help="Stockage des comptes et des courriels: un"
+                             " dossier par utilisateur ou une base SQLite.")
+    parser.add_argument("--segments", action="store_true",
+                        dest="segments",
+                        help="Crée les nouvelles boîtes avec un journal de"
+                             " segments.")
+    parser.add_argument("--convert-segments", action="store_true",
+                        dest="convert_segments",
+                        help="Convertit chaque boîte existante au journal de"
+                             " segments (possible pendant que le serveur"
+                             " fonctionne) puis quitte.")
+    parser.add_argument("--compact", action="store_true",
+                        dest="compact",
+                        help="Compacte le journal de segments de chaque"
+                             " boîte puis quitte.")
+    parser.add_argument("--quota-count", action="store", type=int,
+                        dest="quota_count", default=0,
+                        help="Nombre maximal de courriels par boîte"
+                             " (0 = illimité).")
+    parser.add_argument("--quota-size", action="store", type=int,
+                        dest="quota_size", default=0,
+                        help="Taille maximale d'une boîte en octets"
+                             " (0 = illimité).")
+    parser.add_argument("--engine", action="store",
+                        dest="engine", choices=("selectors", "asyncio"),
+                        default="selectors",
+                        help="Moteur de gestion des connexions.")
+    parser.add_argument("--workers", action="store", type=int,
+                        dest="workers", default=1,
+                        help="Nombre de processus serveurs (SO_REUSEPORT).")
+    parser.add_argument("--drain-timeout", action="store", type=float,
+                        dest="drain_timeout", default=10.0,
+                        help="Délai maximal en secondes accordé aux clients"
+                             " connectés lors d'un arrêt par SIGTERM.")
+    parser.add_argument("--json-only", action="store_true",
+                        dest="json_only",
+                        help="Refuse le format binaire lors de la"
+                             " négociation.")
+    parser.add_argument("--no-compression", action="store_true",
+                        dest="no_compression",
+                        help="Refuse la compression des messages lors de"
+                             " la négociation.")
+    parser.add_argument("--io-threads", action="store", type=int,
+                        dest="io_threads", default=4,
+                        help="Nombre de fils pour les accès disque"
+                             " (0 = dans la boucle du serveur).")
+    parser.add_argument("--kdf-workers", action="store", type=int,
+                        dest="kdf_workers", default=None,
+                        help="Nombre de processus pour le hachage des mots"
+                             " de passe, par processus serveur (par défaut les"
+                             " cœurs sont répartis entre les processus"
+                             " serveurs, 0 = dans le fil du traitement).")
+    parser.add_argument("--cache-size", action="store", type=int,
+                        dest="cache_size", default=64 * 1024 * 1024,
+                        help="Taille maximale en octets du cache des"
+                             " courriels lus, par processus serveur"
+                             " (0 = pas de cache).")
+    parser.add_argument("--metrics-socket", action="store",
+                        dest="metrics_socket", default=None,
+                        help="Chemin d'un socket Unix local qui expose les"
+                             " métriques du serveur en texte (une lecture par"
+                             " connexion).")
+    parser.add_argument("--profile-dir", action="store",
+                        dest="profile_dir", default=".",
+                        help="Dossier des rapports de profilage (SIGUSR1"
+                             " démarre le profilage, SIGUSR2 l'arrête).")
+    args = parser.parse_args(sys.argv[1:])
+    if args.rebuild_index:
+        count = glostorage.rebuild_all(pathlib.Path(gloutils.SERVER_DATA_DIR))
+        print(f"{count} index reconstruit(s).")
+        return 0
+    if args.convert_segments:
+        count = glostorage.convert_all(pathlib.Path(gloutils.SERVER_DATA_DIR))
+        print(f"{count} boîte(s) convertie(s).")
+        return 0
+    if args.compact:
+        freed = glostorage.compact_all(pathlib.Path(gloutils.SERVER_DATA_DIR))
+        print(f"{freed} octet(s) libéré(s).")
+        return 0
+    if args.gc:
+        storage = _open_storage(args)
+        try:
+            count = storage.collect_garbage(args.gc_grace)
+        finally:
+            storage.close()
+        print(f"{count} corps de courriel supprimé(s).")
+        return 0
+    if args.workers > 1:
+        return _supervise(args)
+    return _serve(args)
+
+
 if __name__ == '__main__':
     sys.exit(_main())
@@ -0,0 +1,78 @@
+"""\
+Module fournissant le hachage des mots de passe des utilisateurs du
+serveur.
+
+Les mots de passe sont hachés avec scrypt (`hashlib.scrypt`), salés et
+coûteux en mémoire. Le stockage conserve pour chaque utilisateur
+`scrypt$n$r$p$sel$empreinte` (sel et empreinte en hexadécimal), ou
+l'ancienne empreinte SHA3-512 en hexadécimal, remplacée à la connexion
+suivante.
+
+Les fonctions de hachage sont autonomes pour pouvoir être exécutées dans
+un ProcessPoolExecutor.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import Optional
+
+# Paramètres scrypt: environ 16 Mio de mémoire par hachage.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+KEY_SIZE = 64
+
+_SCHEME = "scrypt"
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=KEY_SIZE)
+
+
+def hash_password(password: str) -> str:
+    """Retourne l'empreinte scrypt salée du mot de passe."""
+    salt = os.urandom(SALT_SIZE)
+    key = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{_SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${key.hex()}"
+
+
+def verify_password(password: str, stored: str) -> tuple[bool, Optional[str]]:
+    """
+    Vérifie le mot de passe contre l'empreinte `stored`.
+
+    Retourne le résultat et, si le mot de passe est valide mais que
+    l'empreinte est ancienne (SHA3-512 ou paramètres scrypt différents),
+    la nouvelle empreinte à enregistrer à sa place.
+    """
+    parts = stored.split("$")
+    if len(parts) == 6 and parts[0] == _SCHEME:
+        try:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            salt, key = bytes.fromhex(parts[4]), bytes.fromhex(parts[5])
+            valide = hmac.compare_digest(_scrypt(password, salt, n, r, p), key)
+        except ValueError:
+            return False, None
+        if valide and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P):
+            return True, hash_password(password)
+        return valide, None
+    # Ancienne empreinte SHA3-512 non salée.
+    valide = hmac.compare_digest(
+        hashlib.sha3_512(password.encode("utf-8")).hexdigest(), stored.strip())
+    return valide, hash_password(password) if valide else None
+
+
+def watch_parent(parent_pid: int) -> None:
+    """
+    Initialisation des processus de hachage: termine le processus si le
+    serveur qui l'a lancé meurt sans l'arrêter (SIGKILL, plantage).
+    """
+    def surveiller() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(1)
+
+    threading.Thread(target=surveiller, daemon=True).start()
@@ -0,0 +1,350 @@
+"""\
+Microbancs d'essai des chemins critiques du serveur.
+
+Chaque banc appelle directement le code mesuré, sans client ni serveur en
+marche:
+- `glosocket.send_mesg` et `recv_mesg` sur une paire de sockets, pour des
+  messages de 100 octets à 10 Mo (un fil lit ou écrit en face pendant la
+  mesure);
+- `json.dumps`/`json.loads` de GloMessage typiques, et `glocodec` en
+  binaire pour comparaison;
+- `Server._get_email_list`, `_get_email`, `_get_stats`, `_send_email` et
+  `_search` sur des boîtes synthétiques de 10 à 100 000 courriels.
+
+Chaque banc est répété (`timeit.Timer.autorange`, puis `--repeat` séries)
+et sa médiane par appel est retenue. `--save` enregistre les résultats
+dans un fichier JSON de référence; `--compare` signale, et fait échouer
+le programme (code 1), chaque banc plus lent que la référence de plus de
+`--threshold`.
+
+Les boîtes synthétiques sont créées dans un dossier temporaire. Le
+serveur est construit sans pool de processus ni de fils, mais ouvre son
+socket d'écoute: le port APP_PORT doit être libre.
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import timeit
+from typing import Callable, Iterator
+
+import glocodec
+import glosocket
+import glosqlite
+import glostorage
+import gloutils
+import TP4_server
+
+MESSAGE_SIZES = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+DEFAULT_MAILBOX_SIZES = "10,1000,100000"
+DEFAULT_THRESHOLD = 0.10
+
+# Taille des corps des courriels synthétiques.
+_BODY_SIZE = 2048
+_DATE_ORIGIN = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+Benchmark = tuple[str, Callable[[], object]]
+
+
+def measure(fonction: Callable[[], object],
+            repeat: int) -> dict[str, float]:
+    """
+    Mesure `fonction`: le nombre d'appels par série est choisi pour durer
+    au moins 0,2 s, puis `repeat` séries sont chronométrées.
+
+    Retourne la médiane et le minimum par appel, en microsecondes.
+    """
+    timer = timeit.Timer(fonction)
+    number, _ = timer.autorange()
+    series = [duree / number * 1e6 for duree in timer.repeat(repeat, number)]
+    return {"median_us": statistics.median(series),
+            "best_us": min(series),
+            "number": number}
+
+
+def _drain(soc: socket.socket) -> None:
+    """Lit des messages jusqu'à la fermeture de l'autre extrémité."""
+    try:
+        while True:
+            glosocket.recv_frame(soc)
+    except glosocket.GLOSocketError:
+        pass
+
+
+def _feed(soc: socket.socket, message: str) -> None:
+    """Envoie le même message jusqu'à la fermeture de l'autre extrémité."""
+    try:
+        while True:
+            glosocket.send_mesg(soc, message)
+    except glosocket.GLOSocketError:
+        pass
+
+
+def _framing_benchmarks(repeat: int, selected: Callable[[str], bool]
+                        ) -> Iterator[tuple[str, dict[str, float]]]:
+    """Envoi et réception de messages de chaque taille de MESSAGE_SIZES."""
+    for taille in MESSAGE_SIZES:
+        message = "x" * taille
+        nom = f"glosocket.send_mesg[{taille}]"
+        if selected(nom):
+            envoi, reception = socket.socketpair()
+            lecteur = threading.Thread(target=_drain, args=(reception,),
+                                       daemon=True)
+            lecteur.start()
+            try:
+                yield nom, measure(lambda: glosocket.send_mesg(envoi, message),
+                                   repeat)
+            finally:
+                envoi.close()
+                lecteur.join()
+                reception.close()
+        nom = f"glosocket.recv_mesg[{taille}]"
+        if selected(nom):
+            envoi, reception = socket.socketpair()
+            redacteur = threading.Thread(target=_feed, args=(envoi, message),
+                                         daemon=True)
+            redacteur.start()
+            try:
+                yield nom, measure(lambda: glosocket.recv_mesg(reception),
+                                   repeat)
+            finally:
+                reception.close()
+                redacteur.join()
+                envoi.close()
+
+
+def _sample_messages() -> dict[str, gloutils.GloMessage]:
+    """GloMessage typiques du protocole."""
+    courriel = gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+        subject="Réunion de suivi", date=gloutils.get_current_utc_time(),
+        content="")
+    return {
+        "auth": gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username="alice",
+                                         password="Motdepasse123")),
+        "email-1k": gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_SENDING,
+            payload=dict(courriel, content="é" * 512)),
+        "email-100k": gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_SENDING,
+            payload=dict(courriel, content="é" * 51_200)),
+        "list-1000": gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.EmailListPayload(
+                email_list=[gloutils.SUBJECT_DISPLAY.format(
+                    number=numero, sender=courriel["sender"],
+                    subject=courriel["subject"], date=courriel["date"])
+                    for numero in range(1, 1001)],
+                total=1000)),
+    }
+
+
+def _serialization_benchmarks() -> Iterator[Benchmark]:
+    """JSON, le format d'origine, puis le format binaire de glocodec."""
+    for nom, message in _sample_messages().items():
+        texte = json.dumps(message)
+        binaire = glocodec.encode_binary(message)
+        yield f"json.dumps[{nom}]", lambda message=message: json.dumps(message)
+        yield f"json.loads[{nom}]", lambda texte=texte: json.loads(texte)
+        yield (f"glocodec.encode_binary[{nom}]",
+               lambda message=message: glocodec.encode_binary(message))
+        yield (f"glocodec.decode[{nom}]",
+               lambda binaire=binaire: glocodec.decode(binaire))
+
+
+def _open_storage(args: argparse.Namespace,
+                  data_dir: pathlib.Path) -> glostorage.Storage:
+    cache = glostorage.MessageCache(args.cache_size) if args.cache_size else None
+    if args.storage == "sqlite":
+        return glosqlite.SQLiteStorage(data_dir / gloutils.SQLITE_FILENAME,
+                                       cache=cache)
+    return glostorage.DirectoryStorage(data_dir, cache=cache,
+                                       segmented=args.segments)
+
+
+def _fill(storage: glostorage.Storage, username: str, count: int) -> None:
+    """
+    Livre `count` courriels synthétiques dans la boîte de `username`, par
+    l'interface du stockage. Ils ont tous le même corps, rangé une fois,
+    mais des sujets et des dates différents.
+    """
+    contenu = ("Bonjour, voici le rapport de la semaine. " * 64)[:_BODY_SIZE]
+    fiche = storage.store_email(gloutils.EmailContentPayload(
+        sender=f"expediteur@{gloutils.SERVER_DOMAIN}",
+        destination=f"{username}@{gloutils.SERVER_DOMAIN}",
+        subject="", date="", content=contenu))
+    for numero in range(count):
+        date = _DATE_ORIGIN + datetime.timedelta(minutes=numero)
+        storage.deliver(
+            dict(fiche, subject=f"Rapport {numero} projet{numero % 97}",
+                 date=date.strftime("%a, %d %b %Y %H:%M:%S %z")),
+            [username], contenu)
+
+
+def _server_benchmarks(server: TP4_server.Server, client_soc: socket.socket,
+                       username: str, count: int) -> Iterator[Benchmark]:
+    """Traitements du serveur pour un client connecté à une boîte de `count` courriels."""
+    numeros = iter(range(10**12))
+    courriel = gloutils.EmailContentPayload(
+        sender=f"{username}@{gloutils.SERVER_DOMAIN}",
+        destination=f"{username}@{gloutils.SERVER_DOMAIN}",
+        subject="Banc d'essai", date=gloutils.get_current_utc_time(),
+        content="Corps du courriel du banc d'essai. " * 30)
+    yield (f"Server._get_email_list[{count}]",
+           lambda: server._get_email_list(client_soc))
+    yield (f"Server._get_email_list.page[{count}]",
+           lambda: server._get_email_list(
+               client_soc, gloutils.InboxPagePayload(offset=count // 2,
+                                                     limit=20)))
+    # Les courriels lus changent à chaque appel.
+    yield (f"Server._get_email[{count}]",
+           lambda: server._get_email(client_soc, gloutils.EmailChoicePayload(
+               choice=next(numeros) % count + 1)))
+    yield f"Server._get_stats[{count}]", lambda: server._get_stats(client_soc)
+    yield (f"Server._search[{count}]",
+           lambda: server._search(client_soc, gloutils.SearchPayload(
+               terms="projet42")))
+    # Chaque envoi agrandit la boîte de la mesure d'un courriel.
+    yield (f"Server._send_email[{count}]",
+           lambda: server._send_email(client_soc, dict(
+               courriel, date=f"{courriel['date']} {next(numeros)}")))
+
+
+def run(args: argparse.Namespace) -> dict[str, dict[str, float]]:
+    """Exécute les bancs retenus par `-k` et retourne leurs résultats."""
+    def selected(nom: str) -> bool:
+        return not args.keywords or any(mot in nom for mot in args.keywords)
+
+    resultats: dict[str, dict[str, float]] = {}
+
+    def executer(nom: str, fonction: Callable[[], object]) -> None:
+        if selected(nom):
+            resultats[nom] = measure(fonction, args.repeat)
+            print(f"{nom:<48}{resultats[nom]['median_us']:>14.2f} µs",
+                  flush=True)
+
+    for nom, resultat in _framing_benchmarks(args.repeat, selected):
+        resultats[nom] = resultat
+        print(f"{nom:<48}{resultat['median_us']:>14.2f} µs", flush=True)
+    for nom, fonction in _serialization_benchmarks():
+        executer(nom, fonction)
+    tailles = [int(taille) for taille in args.mailbox_sizes.split(",") if taille]
+    if not any(selected(f"Server.{suffixe}[{taille}]")
+               for taille in tailles
+               for suffixe in ("_get_email_list", "_get_email_list.page",
+                               "_get_email", "_get_stats", "_search",
+                               "_send_email")):
+        return resultats
+    with tempfile.TemporaryDirectory(prefix="globench-") as dossier:
+        storage = _open_storage(args, pathlib.Path(dossier))
+        server = TP4_server.Server(storage, io_threads=0, kdf_workers=0)
+        client_soc, autre = socket.socketpair()
+        try:
+            for taille in tailles:
+                username = f"banc{taille}"
+                storage.add_user(username, "")
+                _fill(storage, username, taille)
+                server._logged_users[client_soc] = username
+                for nom, fonction in _server_benchmarks(server, client_soc,
+                                                        username, taille):
+                    executer(nom, fonction)
+        finally:
+            client_soc.close()
+            autre.close()
+            server.cleanup()
+    return resultats
+
+
+def compare(resultats: dict[str, dict[str, float]],
+            reference: dict[str, dict[str, float]],
+            threshold: float) -> list[str]:
+    """
+    Affiche l'écart de chaque banc avec la référence et retourne les noms
+    de ceux qui ont ralenti de plus de `threshold`.
+    """
+    regressions = []
+    print(f"\n{'Banc':<48}{'Réf. µs':>14}{'Mesure µs':>14}{'Écart':>9}")
+    for nom, resultat in resultats.items():
+        if nom not in reference:
+            continue
+        avant = reference[nom]["median_us"]
+        apres = resultat["median_us"]
+        ecart = apres / avant - 1 if avant else 0.0
+        marque = ""
+        if ecart > threshold:
+            regressions.append(nom)
+            marque = "  RÉGRESSION"
+        print(f"{nom:<48}{avant:>14.2f}{apres:>14.2f}{ecart:>+9.1%}{marque}")
+    return regressions
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", action="append",
+                        dest="keywords", default=[],
+                        help="Ne lance que les bancs dont le nom contient ce"
+                             " texte (peut être répété).")
+    parser.add_argument("--repeat", action="store", type=int,
+                        dest="repeat", default=5,
+                        help="Nombre de séries chronométrées par banc.")
+    parser.add_argument("--mailbox-sizes", action="store",
+                        dest="mailbox_sizes", default=DEFAULT_MAILBOX_SIZES,
+                        help="Tailles des boîtes synthétiques, séparées par"
+                             " des virgules.")
+    parser.add_argument("--storage", action="store",
+                        dest="storage", choices=("directory", "sqlite"),
+                        default="directory",
+                        help="Stockage des boîtes synthétiques.")
+    parser.add_argument("--segments", action="store_true",
+                        dest="segments",
+                        help="Boîtes synthétiques avec un journal de"
+                             " segments.")
+    parser.add_argument("--cache-size", action="store", type=int,
+                        dest="cache_size", default=0,
+                        help="Taille du cache des courriels lus (0 = mesure"
+                             " le stockage lui-même).")
+    parser.add_argument("--save", action="store",
+                        dest="save", default=None,
+                        help="Enregistre les résultats dans ce fichier JSON"
+                             " de référence.")
+    parser.add_argument("--compare", action="store",
+                        dest="compare", default=None,
+                        help="Compare les résultats à ce fichier de"
+                             " référence.")
+    parser.add_argument("--threshold", action="store", type=float,
+                        dest="threshold", default=DEFAULT_THRESHOLD,
+                        help="Ralentissement relatif signalé comme"
+                             " régression (0.10 = 10 %%).")
+    args = parser.parse_args(sys.argv[1:])
+    reference = None
+    if args.compare is not None:
+        # Lue avant les mesures: une référence invalide échoue tout de suite.
+        reference = json.loads(pathlib.Path(args.compare).read_text(
+            encoding="utf-8"))["results"]
+    resultats = run(args)
+    if args.save is not None:
+        pathlib.Path(args.save).write_text(json.dumps({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": gloutils.get_current_utc_time(),
+            "storage": args.storage,
+            "results": resultats}, indent=2), encoding="utf-8")
+    if reference is not None:
+        regressions = compare(resultats, reference, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} régression(s) au-delà de"
+                  f" {args.threshold:.0%}.")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
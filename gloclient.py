@@ -0,0 +1,700 @@
+"""\
+Bibliothèque cliente du serveur, sans interface.
+
+`AsyncClient` est une connexion au serveur (asyncio). Ses méthodes
+(`login`, `send`, `list_inbox`, `fetch`, `stats`, `search`, ...) retournent
+les payloads de `gloutils`, et lèvent GLOClientError quand le serveur
+répond par une erreur. Plusieurs requêtes peuvent être en cours en même
+temps sur une connexion: chacune porte un `request_id`.
+
+`AsyncPool` garde des connexions déjà connectées au compte de chaque
+utilisateur, avec un nombre maximal de connexions ouvertes. Les méthodes
+de `AsyncPool.user` prennent une connexion au pool pour chaque requête, et
+rouvrent la connexion après une GLOSocketError: une requête qui a pu
+atteindre le serveur n'est rejouée que si elle ne modifie rien (un envoi
+n'est donc jamais fait deux fois).
+
+`Client` et `Pool` sont les façades synchrones des mêmes classes: leurs
+appels sont exécutés par une boucle asyncio dans un fil dédié, et peuvent
+venir de plusieurs fils.
+
+    with Pool("127.0.0.1") as pool:
+        boite = pool.user("alice", "Motdepasse123")
+        boite.send("bob@glo2000.ca", "Sujet", "Corps")
+        print(boite.stats()["count"])
+"""
+import asyncio
+import collections
+import contextlib
+import threading
+from typing import AsyncIterator, Optional, Union
+
+import glocodec
+import glosocket
+import gloutils
+
+
+class GLOClientError(Exception):
+    """Erreur retournée par le serveur (entête ERROR)."""
+
+
+class _RequestNotSent(glosocket.GLOSocketError):
+    """
+    La requête n'a pas atteint le serveur: la rejouer sur une nouvelle
+    connexion ne la répète pas.
+    """
+
+
+def _payload(reponse: gloutils.GloMessage) -> dict:
+    """
+    Retourne le payload d'une réponse OK, éventuellement vide.
+
+    Lève GLOClientError si le serveur a répondu par une erreur.
+    """
+    match reponse:
+        case {"header": gloutils.Headers.OK}:
+            return reponse.get("payload") or {}
+        case {"header": gloutils.Headers.ERROR,
+              "payload": {"error_message": str(erreur)}}:
+            raise GLOClientError(erreur)
+    raise GLOClientError("Réponse inattendue du serveur")
+
+
+class AsyncClient:
+    """
+    Connexion au serveur, ouverte par `AsyncClient.connect`.
+
+    Un fil asyncio lit les réponses et les remet à la requête dont elles
+    portent le `request_id`.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._format = glocodec.JSON
+        self._compression = False
+        self._streaming = False
+        self._next_request_id = 1
+        # Réponses reçues de chaque requête en cours, ou l'erreur qui a
+        # rompu la connexion.
+        self._pending: dict[int, asyncio.Queue] = {}
+        # Les trames d'un courriel en plusieurs trames ne doivent pas être
+        # entrecoupées d'autres requêtes.
+        self._write_lock = asyncio.Lock()
+        self._reader_task: Optional[asyncio.Task] = None
+        self._error: Optional[glosocket.GLOSocketError] = None
+        # Utilisateur connecté, ou None.
+        self.username: Optional[str] = None
+
+    @classmethod
+    async def connect(cls, host: str, port: int = gloutils.APP_PORT,
+                      wire_format: str = glocodec.BINARY,
+                      compression: bool = True) -> "AsyncClient":
+        """
+        Ouvre une connexion au serveur et négocie le format des messages,
+        comme TP4_client.
+
+        Lève GLOSocketError si la connexion est impossible.
+        """
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError as ex:
+            raise glosocket.GLOSocketError("Connexion au serveur impossible") from ex
+        client = cls(reader, writer)
+        try:
+            await client._negotiate(wire_format, compression)
+        except BaseException:
+            writer.close()
+            raise
+        client._reader_task = asyncio.create_task(client._read_responses())
+        return client
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    @property
+    def is_open(self) -> bool:
+        """Vrai tant que la connexion n'est ni fermée ni rompue."""
+        return self._error is None and not self._writer.is_closing()
+
+    async def _negotiate(self, wire_format: str, compression: bool) -> None:
+        """Négocie le format, la compression et les corps en plusieurs trames."""
+        await glosocket.send_frame_async(self._writer, glocodec.encode(
+            gloutils.GloMessage(
+                header=gloutils.Headers.NEGOTIATE,
+                payload=gloutils.NegotiationPayload(
+                    formats=[wire_format, glocodec.JSON],
+                    compression=compression, streaming=True)),
+            glocodec.JSON))
+        try:
+            reponse = glocodec.decode(await glosocket.recv_frame_async(self._reader))
+        except glocodec.CodecError as ex:
+            raise glosocket.GLOSocketError("Message du serveur invalide") from ex
+        match reponse:
+            case {"header": gloutils.Headers.OK,
+                  "payload": {"formats": [choix]} as payload} if choix in glocodec.ENCODERS:
+                self._format = choix
+                self._compression = compression and payload.get("compression") is True
+                self._streaming = payload.get("streaming") is True
+
+    async def _read_responses(self) -> None:
+        """Remet chaque réponse reçue à sa requête, jusqu'à la fermeture."""
+        try:
+            while True:
+                trame = await glosocket.recv_frame_async(self._reader)
+                try:
+                    reponse = glocodec.decode(trame)
+                except glocodec.CodecError as ex:
+                    raise glosocket.GLOSocketError("Message du serveur invalide") from ex
+                file = self._pending.get(reponse.get("request_id"))
+                if file is not None:
+                    file.put_nowait(reponse)
+        except glosocket.GLOSocketError as ex:
+            self._fail(ex)
+        finally:
+            self._fail(glosocket.GLOSocketError("La connexion est fermée"))
+
+    def _fail(self, erreur: glosocket.GLOSocketError) -> None:
+        """Retient la première erreur de la connexion et la remet aux requêtes."""
+        if self._error is not None:
+            return
+        self._error = erreur
+        for file in self._pending.values():
+            file.put_nowait(erreur)
+
+    async def _send(self, message: gloutils.GloMessage) -> None:
+        """
+        Envoie un message, le corps d'un long courriel en plusieurs trames;
+        le `request_id` accompagne alors le dernier morceau.
+        """
+        payload = message.get("payload")
+        if (self._streaming
+                and message["header"] == gloutils.Headers.EMAIL_SENDING
+                and len(payload["content"]) > gloutils.STREAM_THRESHOLD):
+            contenu = payload["content"]
+            await self._send(gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_SENDING,
+                payload=dict(payload, content="", chunked=True)))
+            taille = gloutils.STREAM_CHUNK_SIZE
+            for debut in range(0, len(contenu), taille):
+                dernier = debut + taille >= len(contenu)
+                morceau = gloutils.GloMessage(
+                    header=gloutils.Headers.EMAIL_CHUNK,
+                    payload=gloutils.ChunkPayload(
+                        data=contenu[debut:debut + taille], last=dernier))
+                if dernier and "request_id" in message:
+                    morceau["request_id"] = message["request_id"]
+                await self._send(morceau)
+            return
+        await glosocket.send_frame_async(
+            self._writer, glocodec.encode(message, self._format),
+            compress=self._compression)
+
+    async def _notify(self, message: gloutils.GloMessage) -> None:
+        """Envoie un message auquel le serveur ne répond pas."""
+        if self._error is not None:
+            raise glosocket.GLOSocketError(str(self._error))
+        async with self._write_lock:
+            await self._send(message)
+
+    async def _exchange(self, message: gloutils.GloMessage
+                        ) -> gloutils.GloMessage:
+        """
+        Envoie une requête et retourne sa réponse; un corps reçu en
+        plusieurs trames est reconstitué.
+
+        Lève GLOSocketError si la connexion est rompue, _RequestNotSent si
+        la requête n'a pas pu être transmise.
+        """
+        if self._error is not None:
+            raise _RequestNotSent(str(self._error))
+        request_id = self._next_request_id
+        self._next_request_id = request_id % 0xFFFFFFFF + 1
+        message["request_id"] = request_id
+        file: asyncio.Queue = asyncio.Queue()
+        self._pending[request_id] = file
+        try:
+            try:
+                async with self._write_lock:
+                    await self._send(message)
+            except glosocket.GLOSocketError as ex:
+                raise _RequestNotSent(str(ex)) from ex
+            reponse = await self._next(file)
+            payload = reponse.get("payload")
+            if isinstance(payload, dict) and payload.get("chunked") is True:
+                morceaux = []
+                while True:
+                    match await self._next(file):
+                        case {"header": gloutils.Headers.EMAIL_CHUNK,
+                              "payload": {"data": str(data), "last": bool(last)}}:
+                            morceaux.append(data)
+                            if last:
+                                break
+                        case _:
+                            raise glosocket.GLOSocketError("Morceau de courriel attendu")
+                del payload["chunked"]
+                payload["content"] = "".join(morceaux)
+            return reponse
+        finally:
+            del self._pending[request_id]
+
+    @staticmethod
+    async def _next(file: asyncio.Queue) -> gloutils.GloMessage:
+        reponse = await file.get()
+        if isinstance(reponse, glosocket.GLOSocketError):
+            raise glosocket.GLOSocketError(str(reponse))
+        return reponse
+
+    async def register(self, username: str, password: str) -> None:
+        """Crée un compte et s'y connecte. Lève GLOClientError s'il est refusé."""
+        _payload(await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_REGISTER,
+            payload=gloutils.AuthPayload(username=username, password=password))))
+        self.username = username
+
+    async def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte. Lève GLOClientError si c'est refusé."""
+        _payload(await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN,
+            payload=gloutils.AuthPayload(username=username, password=password))))
+        self.username = username
+
+    async def logout(self) -> None:
+        """Se déconnecte du compte, en gardant la connexion ouverte."""
+        await self._notify(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
+        self.username = None
+
+    async def send(self, destination: Union[str, list[str]], subject: str,
+                   content: str) -> gloutils.DeliveryPayload:
+        """
+        Envoie un courriel à une adresse ou à une liste d'adresses et
+        retourne le résultat de chaque destinataire.
+
+        Lève GLOClientError si le courriel est refusé pour une seule
+        adresse, et ValueError si les destinataires sont invalides.
+        """
+        if self.username is None:
+            raise GLOClientError("Vous devez être connecté")
+        if not isinstance(destination, str) and (
+                not isinstance(destination, list) or not destination
+                or not all(isinstance(adresse, str) for adresse in destination)):
+            raise ValueError("La liste de destinataires est invalide")
+        payload = _payload(await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_SENDING,
+            payload=gloutils.EmailContentPayload(
+                sender=self.username + '@' + gloutils.SERVER_DOMAIN,
+                destination=destination,
+                subject=subject,
+                date=gloutils.get_current_utc_time(),
+                content=content))))
+        if "recipients" in payload:
+            return gloutils.DeliveryPayload(recipients=payload["recipients"],
+                                            errors=payload["errors"])
+        return gloutils.DeliveryPayload(recipients=[destination], errors=[""])
+
+    async def list_inbox(self, offset: int = 0, limit: Optional[int] = None
+                         ) -> gloutils.EmailListPayload:
+        """
+        Retourne la liste des courriels (gabarit SUBJECT_DISPLAY), du plus
+        récent au plus ancien, ou une page de `limit` courriels à partir
+        de `offset`, avec leur nombre total.
+        """
+        message = gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST)
+        if offset or limit is not None:
+            message["payload"] = gloutils.InboxPagePayload(
+                offset=offset, limit=0xFFFFFFFF if limit is None else limit)
+        payload = _payload(await self._exchange(message))
+        return gloutils.EmailListPayload(
+            email_list=payload["email_list"],
+            total=payload.get("total", len(payload["email_list"])))
+
+    async def fetch(self, number: int) -> gloutils.EmailContentPayload:
+        """Retourne le courriel `number` de la boîte (1 = le plus récent)."""
+        return _payload(await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_READING_CHOICE,
+            payload=gloutils.EmailChoicePayload(choice=number))))
+
+    async def stats(self) -> gloutils.StatsPayload:
+        """Retourne le nombre de courriels et la taille de la boîte."""
+        return _payload(await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.STATS_REQUEST)))
+
+    async def search(self, terms: str, sender: Optional[str] = None,
+                     since: Optional[str] = None, until: Optional[str] = None
+                     ) -> gloutils.EmailListPayload:
+        """
+        Retourne les courriels qui contiennent tous les mots de `terms`,
+        filtrés par expéditeur et par date (AAAA-MM-JJ).
+        """
+        recherche = gloutils.SearchPayload(terms=terms)
+        if sender is not None:
+            recherche["sender"] = sender
+        if since is not None:
+            recherche["since"] = since
+        if until is not None:
+            recherche["until"] = until
+        return _payload(await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.SEARCH, payload=recherche)))
+
+    async def close(self) -> None:
+        """Prévient le serveur avec l'entête BYE et ferme la connexion."""
+        if self.is_open:
+            try:
+                await self._notify(gloutils.GloMessage(header=gloutils.Headers.BYE))
+            except glosocket.GLOSocketError:
+                pass
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._reader_task
+        self._writer.close()
+        with contextlib.suppress(OSError):
+            await self._writer.wait_closed()
+
+
+class AsyncPool:
+    """
+    Connexions au serveur gardées connectées au compte de chaque
+    utilisateur.
+
+    Au plus `max_connections` connexions sont ouvertes, en service ou au
+    repos; au-delà, une connexion au repos d'un autre utilisateur est
+    fermée, ou la requête attend qu'une connexion soit rendue. Au plus
+    `max_idle` connexions au repos sont gardées par utilisateur.
+    """
+
+    def __init__(self, host: str, port: int = gloutils.APP_PORT,
+                 max_connections: int = 10, max_idle: int = 2,
+                 wire_format: str = glocodec.BINARY,
+                 compression: bool = True) -> None:
+        self._host = host
+        self._port = port
+        self._max_connections = max_connections
+        self._max_idle = max_idle
+        self._wire_format = wire_format
+        self._compression = compression
+        # Connexions au repos de chaque utilisateur, la plus récente à la
+        # fin. La clé contient le mot de passe: une session n'est prêtée
+        # qu'avec celui qui l'a ouverte.
+        self._idle: dict[tuple[str, str], collections.deque[AsyncClient]] = {}
+        # Connexions ouvertes ou en cours d'ouverture.
+        self._count = 0
+        self._condition = asyncio.Condition()
+        self._closed = False
+
+    async def __aenter__(self) -> "AsyncPool":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def _evict(self) -> Optional[AsyncClient]:
+        """Retire la connexion au repos qui l'est depuis le plus longtemps."""
+        for cle, connexions in self._idle.items():
+            if connexions:
+                client = connexions.popleft()
+                if not connexions:
+                    del self._idle[cle]
+                return client
+        return None
+
+    async def _acquire(self, username: str, password: str) -> AsyncClient:
+        """
+        Retourne une connexion au repos de l'utilisateur, ou en ouvre une
+        nouvelle et la connecte à son compte.
+        """
+        fermees: list[AsyncClient] = []
+        async with self._condition:
+            while True:
+                if self._closed:
+                    raise glosocket.GLOSocketError("Le pool est fermé")
+                connexions = self._idle.get((username, password))
+                while connexions:
+                    client = connexions.pop()
+                    if client.is_open:
+                        break
+                    # Connexion fermée par le serveur pendant son repos.
+                    self._count -= 1
+                    fermees.append(client)
+                else:
+                    client = None
+                if client is not None:
+                    break
+                if self._count < self._max_connections:
+                    self._count += 1
+                    break
+                victime = self._evict()
+                if victime is not None:
+                    fermees.append(victime)
+                    break
+                await self._condition.wait()
+        for fermee in fermees:
+            await fermee.close()
+        if client is not None:
+            return client
+        try:
+            client = await AsyncClient.connect(self._host, self._port,
+                                               self._wire_format,
+                                               self._compression)
+        except BaseException as ex:
+            await self._forget()
+            if isinstance(ex, glosocket.GLOSocketError):
+                raise _RequestNotSent(str(ex)) from ex
+            raise
+        try:
+            await client.login(username, password)
+        except BaseException as ex:
+            await self._forget()
+            await client.close()
+            if isinstance(ex, glosocket.GLOSocketError):
+                raise _RequestNotSent(str(ex)) from ex
+            raise
+        return client
+
+    async def _forget(self) -> None:
+        """Retire du compte une connexion fermée."""
+        async with self._condition:
+            self._count -= 1
+            self._condition.notify()
+
+    async def _release(self, username: str, password: str,
+                       client: AsyncClient, reuse: bool) -> None:
+        """Rend la connexion au pool, ou la ferme."""
+        cle = (username, password)
+        async with self._condition:
+            connexions = self._idle.setdefault(cle, collections.deque())
+            if (reuse and client.is_open and not self._closed
+                    and len(connexions) < self._max_idle):
+                connexions.append(client)
+                self._condition.notify()
+                return
+            if not connexions:
+                del self._idle[cle]
+            self._count -= 1
+            self._condition.notify()
+        await client.close()
+
+    @contextlib.asynccontextmanager
+    async def session(self, username: str, password: str
+                      ) -> AsyncIterator[AsyncClient]:
+        """
+        Prête une connexion connectée au compte de l'utilisateur, rendue au
+        pool à la fin du bloc; elle est fermée après une GLOSocketError.
+        """
+        client = await self._acquire(username, password)
+        reutiliser = False
+        try:
+            yield client
+            reutiliser = True
+        except GLOClientError:
+            # Erreur du serveur: la connexion reste utilisable.
+            reutiliser = True
+            raise
+        finally:
+            await self._release(username, password, client, reutiliser)
+
+    async def _call(self, username: str, password: str, methode: str,
+                    *args, idempotent: bool = True):
+        """
+        Appelle `methode` d'une connexion de l'utilisateur, avec une
+        nouvelle connexion si la première est rompue.
+        """
+        for essai in range(2):
+            try:
+                async with self.session(username, password) as client:
+                    return await getattr(client, methode)(*args)
+            except _RequestNotSent:
+                if essai:
+                    raise
+            except glosocket.GLOSocketError:
+                if essai or not idempotent:
+                    raise
+
+    def user(self, username: str, password: str) -> "AsyncUser":
+        """Retourne les opérations sur la boîte de l'utilisateur."""
+        return AsyncUser(self, username, password)
+
+    async def close(self) -> None:
+        """Ferme les connexions au repos; les autres le sont à leur retour."""
+        async with self._condition:
+            self._closed = True
+            connexions = [client for clients in self._idle.values()
+                          for client in clients]
+            self._idle.clear()
+            self._count -= len(connexions)
+            self._condition.notify_all()
+        for client in connexions:
+            await client.close()
+
+
+class AsyncUser:
+    """Opérations sur la boîte d'un utilisateur, à travers un AsyncPool."""
+
+    def __init__(self, pool: AsyncPool, username: str, password: str) -> None:
+        self._pool = pool
+        self.username = username
+        self._password = password
+
+    async def send(self, destination: Union[str, list[str]], subject: str,
+                   content: str) -> gloutils.DeliveryPayload:
+        """Voir AsyncClient.send; n'est rejoué que s'il n'a pas été transmis."""
+        return await self._pool._call(self.username, self._password, "send",
+                                      destination, subject, content,
+                                      idempotent=False)
+
+    async def list_inbox(self, offset: int = 0, limit: Optional[int] = None
+                         ) -> gloutils.EmailListPayload:
+        return await self._pool._call(self.username, self._password,
+                                      "list_inbox", offset, limit)
+
+    async def fetch(self, number: int) -> gloutils.EmailContentPayload:
+        return await self._pool._call(self.username, self._password,
+                                      "fetch", number)
+
+    async def stats(self) -> gloutils.StatsPayload:
+        return await self._pool._call(self.username, self._password, "stats")
+
+    async def search(self, terms: str, sender: Optional[str] = None,
+                     since: Optional[str] = None, until: Optional[str] = None
+                     ) -> gloutils.EmailListPayload:
+        return await self._pool._call(self.username, self._password,
+                                      "search", terms, sender, since, until)
+
+
+class _LoopThread:
+    """Boucle asyncio exécutée par un fil dédié, pour les façades synchrones."""
+
+    def __init__(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True, name="glo-client")
+        self._thread.start()
+
+    def run(self, coroutine):
+        """Exécute la coroutine dans la boucle et retourne son résultat."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def stop(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class Client:
+    """Façade synchrone d'AsyncClient, avec les mêmes méthodes."""
+
+    def __init__(self, host: str, port: int = gloutils.APP_PORT,
+                 wire_format: str = glocodec.BINARY,
+                 compression: bool = True) -> None:
+        """Lève GLOSocketError si la connexion est impossible."""
+        self._loop = _LoopThread()
+        try:
+            self._client = self._loop.run(AsyncClient.connect(
+                host, port, wire_format, compression))
+        except BaseException:
+            self._loop.stop()
+            raise
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def username(self) -> Optional[str]:
+        return self._client.username
+
+    def register(self, username: str, password: str) -> None:
+        self._loop.run(self._client.register(username, password))
+
+    def login(self, username: str, password: str) -> None:
+        self._loop.run(self._client.login(username, password))
+
+    def logout(self) -> None:
+        self._loop.run(self._client.logout())
+
+    def send(self, destination: Union[str, list[str]], subject: str,
+             content: str) -> gloutils.DeliveryPayload:
+        return self._loop.run(self._client.send(destination, subject, content))
+
+    def list_inbox(self, offset: int = 0, limit: Optional[int] = None
+                   ) -> gloutils.EmailListPayload:
+        return self._loop.run(self._client.list_inbox(offset, limit))
+
+    def fetch(self, number: int) -> gloutils.EmailContentPayload:
+        return self._loop.run(self._client.fetch(number))
+
+    def stats(self) -> gloutils.StatsPayload:
+        return self._loop.run(self._client.stats())
+
+    def search(self, terms: str, sender: Optional[str] = None,
+               since: Optional[str] = None, until: Optional[str] = None
+               ) -> gloutils.EmailListPayload:
+        return self._loop.run(self._client.search(terms, sender, since, until))
+
+    def close(self) -> None:
+        try:
+            self._loop.run(self._client.close())
+        finally:
+            self._loop.stop()
+
+
+class Pool:
+    """Façade synchrone d'AsyncPool, utilisable depuis plusieurs fils."""
+
+    def __init__(self, host: str, port: int = gloutils.APP_PORT,
+                 max_connections: int = 10, max_idle: int = 2,
+                 wire_format: str = glocodec.BINARY,
+                 compression: bool = True) -> None:
+        self._loop = _LoopThread()
+        self._pool = AsyncPool(host, port, max_connections, max_idle,
+                               wire_format, compression)
+
+    def __enter__(self) -> "Pool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def user(self, username: str, password: str) -> "User":
+        """Retourne les opérations sur la boîte de l'utilisateur."""
+        return User(self._loop, self._pool.user(username, password))
+
+    def close(self) -> None:
+        try:
+            self._loop.run(self._pool.close())
+        finally:
+            self._loop.stop()
+
+
+class User:
+    """Façade synchrone d'AsyncUser."""
+
+    def __init__(self, loop: _LoopThread, user: AsyncUser) -> None:
+        self._loop = loop
+        self._user = user
+        self.username = user.username
+
+    def send(self, destination: Union[str, list[str]], subject: str,
+             content: str) -> gloutils.DeliveryPayload:
+        return self._loop.run(self._user.send(destination, subject, content))
+
+    def list_inbox(self, offset: int = 0, limit: Optional[int] = None
+                   ) -> gloutils.EmailListPayload:
+        return self._loop.run(self._user.list_inbox(offset, limit))
+
+    def fetch(self, number: int) -> gloutils.EmailContentPayload:
+        return self._loop.run(self._user.fetch(number))
+
+    def stats(self) -> gloutils.StatsPayload:
+        return self._loop.run(self._user.stats())
+
+    def search(self, terms: str, sender: Optional[str] = None,
+               since: Optional[str] = None, until: Optional[str] = None
+               ) -> gloutils.EmailListPayload:
+        return self._loop.run(self._user.search(terms, sender, since, until))
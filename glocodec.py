@@ -0,0 +1,289 @@
+"""\
+Module fournissant l'encodage des GloMessage sur le réseau.
+
+Deux formats sont disponibles:
+- "json", le format d'origine (`json.dumps` du GloMessage);
+- "binary", un format compact où l'entête et chaque champ des payloads
+  sont encodés avec struct, les chaînes étant précédées de leur longueur.
+
+Le format binaire est négocié à la connexion (entête NEGOTIATE). Un
+message binaire commence par l'octet `MAGIC`, ce qui permet à `decode`
+de reconnaître les deux formats. Un payload qui ne correspond à aucun
+gabarit connu est simplement envoyé en JSON.
+"""
+import enum
+import json
+import struct
+from typing import Any, Callable
+
+import gloutils
+
+JSON = "json"
+BINARY = "binary"
+FORMATS = (BINARY, JSON)
+
+# Premier octet d'un message binaire; un message JSON commence par "{".
+MAGIC = 0xB7
+
+# Octet magique, entête, type de payload, drapeaux et champs présents.
+_ENVELOPE = struct.Struct("!BBBBH")
+# Drapeau de l'enveloppe: un `request_id` (u32) la suit.
+FLAG_REQUEST_ID = 0x01
+_U8 = struct.Struct("!B")
+_U32 = struct.Struct("!I")
+_U64 = struct.Struct("!Q")
+
+
+class CodecError(ValueError):
+    """Erreur levée pour un message impossible à décoder."""
+
+
+class PayloadKind(enum.IntEnum):
+    """Gabarit du payload d'un message binaire."""
+    NONE = 0
+    ERROR = enum.auto()
+    AUTH = enum.auto()
+    EMAIL_CONTENT = enum.auto()
+    EMAIL_LIST = enum.auto()
+    EMAIL_CHOICE = enum.auto()
+    STATS = enum.auto()
+    NEGOTIATION = enum.auto()
+    EMAIL_CONTENT_MULTI = enum.auto()
+    DELIVERY = enum.auto()
+    INBOX_PAGE = enum.auto()
+    CHUNK = enum.auto()
+    SEARCH = enum.auto()
+    METRICS = enum.auto()
+
+
+# Champs de chaque gabarit, dans l'ordre d'encodage, avec leur type:
+# "bool", "u32" et "u64" pour les entiers, "str" pour le texte et
+# "strlist" pour les listes de texte.
+_SCHEMAS: dict[PayloadKind, tuple[tuple[str, str], ...]] = {
+    PayloadKind.ERROR: (("error_message", "str"),),
+    PayloadKind.AUTH: (("username", "str"), ("password", "str")),
+    PayloadKind.EMAIL_CONTENT: (("sender", "str"), ("destination", "str"),
+                                ("subject", "str"), ("date", "str"),
+                                ("content", "str"), ("chunked", "bool")),
+    PayloadKind.EMAIL_LIST: (("email_list", "strlist"), ("total", "u64")),
+    PayloadKind.EMAIL_CHOICE: (("choice", "u32"),),
+    PayloadKind.STATS: (("count", "u64"), ("size", "u64")),
+    PayloadKind.NEGOTIATION: (("formats", "strlist"), ("compression", "bool"),
+                              ("streaming", "bool")),
+    PayloadKind.EMAIL_CONTENT_MULTI: (("sender", "str"),
+                                      ("destination", "strlist"),
+                                      ("subject", "str"), ("date", "str"),
+                                      ("content", "str"), ("chunked", "bool")),
+    PayloadKind.DELIVERY: (("recipients", "strlist"), ("errors", "strlist")),
+    PayloadKind.INBOX_PAGE: (("offset", "u32"), ("limit", "u32")),
+    PayloadKind.CHUNK: (("data", "str"), ("last", "bool")),
+    PayloadKind.SEARCH: (("terms", "str"), ("sender", "str"), ("since", "str"),
+                         ("until", "str")),
+    PayloadKind.METRICS: (("metrics", "str"),),
+}
+
+# Champs facultatifs (NotRequired) de chaque gabarit.
+_OPTIONAL: dict[PayloadKind, frozenset[str]] = {
+    PayloadKind.EMAIL_CONTENT: frozenset({"chunked"}),
+    PayloadKind.EMAIL_LIST: frozenset({"total"}),
+    PayloadKind.NEGOTIATION: frozenset({"compression", "streaming"}),
+    PayloadKind.EMAIL_CONTENT_MULTI: frozenset({"chunked"}),
+    PayloadKind.SEARCH: frozenset({"sender", "since", "until"}),
+}
+
+# Clés de chaque gabarit.
+_FIELD_NAMES = {kind: frozenset(name for name, _ in fields)
+                for kind, fields in _SCHEMAS.items()}
+
+
+def _find_kinds(keys: frozenset[str]) -> list[PayloadKind]:
+    """
+    Retourne les gabarits possibles d'un payload d'après ses clés; les
+    types des champs départagent ceux qui ont les mêmes clés.
+    """
+    return [kind for kind, names in _FIELD_NAMES.items()
+            if names - _OPTIONAL.get(kind, frozenset()) <= keys <= names]
+
+
+def _pack_str(parts: list[bytes], value: str) -> None:
+    data = value.encode("utf-8")
+    parts.append(_U32.pack(len(data)))
+    parts.append(data)
+
+
+def _pack_field(parts: list[bytes], kind: str, value: Any) -> None:
+    """Encode un champ; lève TypeError ou struct.error s'il est invalide."""
+    if kind == "bool":
+        if not isinstance(value, bool):
+            raise TypeError(value)
+        parts.append(b"\x01" if value else b"\x00")
+    elif kind == "u32":
+        if not isinstance(value, int):
+            raise TypeError(value)
+        parts.append(_U32.pack(value))
+    elif kind == "u64":
+        if not isinstance(value, int):
+            raise TypeError(value)
+        parts.append(_U64.pack(value))
+    elif kind == "str":
+        if not isinstance(value, str):
+            raise TypeError(value)
+        _pack_str(parts, value)
+    else:
+        if not isinstance(value, list):
+            raise TypeError(value)
+        parts.append(_U32.pack(len(value)))
+        for item in value:
+            if not isinstance(item, str):
+                raise TypeError(item)
+            _pack_str(parts, item)
+
+
+def encode_json(message: gloutils.GloMessage) -> bytes:
+    """Encode le message dans le format JSON d'origine."""
+    return json.dumps(message).encode("utf-8")
+
+
+def encode_binary(message: gloutils.GloMessage) -> bytes:
+    """
+    Encode le message dans le format binaire.
+
+    Se rabat sur JSON pour un message dont le payload ne correspond à
+    aucun gabarit.
+    """
+    payload = message.get("payload")
+    kinds = [PayloadKind.NONE]
+    if payload is not None:
+        if not isinstance(payload, dict):
+            return encode_json(message)
+        kinds = _find_kinds(frozenset(payload))
+    for kind in kinds:
+        try:
+            return _pack_message(message, kind)
+        except (TypeError, KeyError, struct.error):
+            continue
+    return encode_json(message)
+
+
+def _pack_message(message: gloutils.GloMessage, kind: PayloadKind) -> bytes:
+    """
+    Encode le message avec le gabarit `kind`; lève TypeError, KeyError ou
+    struct.error s'il n'y correspond pas.
+    """
+    payload = message.get("payload")
+    parts = [b""]
+    present = 0
+    flags = 0
+    if "request_id" in message:
+        flags |= FLAG_REQUEST_ID
+        _pack_field(parts, "u32", message["request_id"])
+    for bit, (name, field_kind) in enumerate(_SCHEMAS.get(kind, ())):
+        if name in payload:
+            present |= 1 << bit
+            _pack_field(parts, field_kind, payload[name])
+    parts[0] = _ENVELOPE.pack(MAGIC, message["header"], kind, flags, present)
+    return b"".join(parts)
+
+
+class _Reader:
+    """Curseur de lecture d'un message binaire."""
+
+    def __init__(self, data: bytes) -> None:
+        self._view = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        values = fmt.unpack_from(self._view, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def read_str(self) -> str:
+        length, = self.unpack(_U32)
+        end = self.offset + length
+        if end > len(self._view):
+            raise CodecError("Chaîne tronquée")
+        text = str(self._view[self.offset:end], "utf-8")
+        self.offset = end
+        return text
+
+    def read_field(self, kind: str) -> Any:
+        if kind == "bool":
+            octet, = self.unpack(_U8)
+            if octet > 1:
+                raise CodecError("Booléen invalide")
+            return bool(octet)
+        if kind == "u32":
+            return self.unpack(_U32)[0]
+        if kind == "u64":
+            return self.unpack(_U64)[0]
+        if kind == "str":
+            return self.read_str()
+        count, = self.unpack(_U32)
+        if count > len(self._view) - self.offset:
+            raise CodecError("Liste tronquée")
+        return [self.read_str() for _ in range(count)]
+
+
+def _decode_binary(data: bytes) -> gloutils.GloMessage:
+    """Décode un message binaire, qui doit se terminer avec son payload."""
+    reader = _Reader(data)
+    _, header, kind, flags, present = reader.unpack(_ENVELOPE)
+    if flags & ~FLAG_REQUEST_ID:
+        raise CodecError("Drapeaux inconnus")
+    try:
+        message = gloutils.GloMessage(header=gloutils.Headers(header))
+    except ValueError as ex:
+        raise CodecError("Entête inconnue") from ex
+    if flags & FLAG_REQUEST_ID:
+        message["request_id"] = reader.read_field("u32")
+    if kind != PayloadKind.NONE:
+        try:
+            fields = _SCHEMAS[PayloadKind(kind)]
+        except ValueError as ex:
+            raise CodecError("Gabarit de payload inconnu") from ex
+        payload = {}
+        for bit, (name, field_kind) in enumerate(fields):
+            if present & (1 << bit):
+                payload[name] = reader.read_field(field_kind)
+        message["payload"] = payload
+    if reader.offset != len(data):
+        raise CodecError("Octets en trop après le message")
+    return message
+
+
+def decode(data: bytes) -> gloutils.GloMessage:
+    """
+    Décode un message reçu, qu'il soit en JSON ou en binaire.
+
+    Lève CodecError (une ValueError) si le message est invalide.
+    """
+    try:
+        if data[:1] == bytes((MAGIC,)):
+            return _decode_binary(data)
+        return json.loads(data)
+    except CodecError:
+        raise
+    except (ValueError, struct.error) as ex:
+        raise CodecError("Le message reçu est invalide") from ex
+
+
+ENCODERS: dict[str, Callable[[gloutils.GloMessage], bytes]] = {
+    JSON: encode_json,
+    BINARY: encode_binary,
+}
+
+
+def encode(message: gloutils.GloMessage, wire_format: str = JSON) -> bytes:
+    """Encode le message dans le format `wire_format`."""
+    return ENCODERS[wire_format](message)
+
+
+def choose_format(offered: list[str], accepted: tuple[str, ...]) -> str:
+    """
+    Retourne le premier format proposé par le client que le serveur
+    accepte, ou JSON s'il n'y en a aucun.
+    """
+    for wire_format in offered:
+        if wire_format in accepted:
+            return wire_format
+    return JSON
@@ -0,0 +1,537 @@
+"""\
+Générateur de charge pour le serveur, sans interface.
+
+Simule `--users` utilisateurs connectés en même temps (asyncio), qui
+enchaînent des créations de compte, connexions, envois, consultations,
+lectures et statistiques selon la répartition `--mix`, au débit total
+`--rate`. Les messages suivent le protocole du client (`glosocket`,
+`glocodec`, `gloutils.Headers`).
+
+À la fin, le débit, le taux d'erreurs et les percentiles de latence
+(p50, p95, p99) sont affichés pour chaque entête. La latence d'une requête
+est mesurée à partir du moment où le débit visé prévoyait de l'envoyer:
+un serveur qui prend du retard n'est pas avantagé par l'attente des
+utilisateurs simulés. L'ouverture de session (négociation, puis connexion
+ou création du compte) n'est pas mesurée.
+
+Avec `--seed`, un dossier de données est d'abord rempli, sans passer par
+le serveur, avec des boîtes de tailles réalistes: le nombre de courriels
+de chaque boîte et la taille des corps suivent une loi log-normale.
+"""
+import argparse
+import asyncio
+import json
+import math
+import pathlib
+import random
+import sys
+import time
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    # Plateformes sans resource (Windows): limite de descripteurs inchangée.
+    resource = None
+
+import gloauth
+import glocodec
+import glosocket
+import glosqlite
+import glostorage
+import gloutils
+
+# Mot de passe de tous les comptes simulés, conforme aux règles du serveur.
+PASSWORD = "Motdepasse123"
+DEFAULT_MIX = "login=5,register=1,send=30,list=30,read=25,stats=9"
+OPERATIONS = ("register", "login", "send", "list", "read", "stats", "search")
+# Taille maximale d'un corps généré, sous la taille maximale d'une trame.
+BODY_MAX_SIZE = 8 * 1024 * 1024
+
+# Mots des sujets et des corps générés, pour que l'index de recherche ait
+# un vocabulaire réaliste.
+_WORDS = ("bonjour", "réunion", "facture", "projet", "rapport", "semaine",
+          "équipe", "client", "livraison", "budget", "serveur", "courriel",
+          "travail", "pratique", "examen", "lundi", "mardi", "mercredi",
+          "jeudi", "vendredi", "merci", "urgent", "rappel", "document",
+          "version", "réseau", "protocole", "message", "question", "réponse",
+          "demande", "suivi", "compte", "mot", "passe", "annexe", "date",
+          "heure", "salle", "présentation", "résultat", "note", "cours")
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    """
+    Lit une répartition `operation=poids,...`; lève ValueError si une
+    opération est inconnue ou si aucun poids n'est positif.
+    """
+    mix: dict[str, float] = {}
+    for element in text.split(","):
+        if not element.strip():
+            continue
+        operation, _, poids = element.partition("=")
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise ValueError(f"Opération inconnue: {operation}")
+        mix[operation] = float(poids)
+        if mix[operation] < 0:
+            raise ValueError(f"Poids négatif: {operation}")
+    if not any(mix.values()):
+        raise ValueError("Aucune opération")
+    return mix
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Percentile par rang le plus proche d'une liste triée."""
+    if not values:
+        return 0.0
+    rang = max(1, math.ceil(fraction * len(values)))
+    return values[rang - 1]
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _body(rng: random.Random, median: int) -> str:
+    """Corps d'une taille tirée selon une loi log-normale de médiane `median`."""
+    taille = min(BODY_MAX_SIZE,
+                 max(1, int(rng.lognormvariate(math.log(max(1, median)), 1.0))))
+    mots = _text(rng, taille // 7 + 1)
+    return (mots * (taille // len(mots) + 1))[:taille]
+
+
+class Statistics:
+    """Latences, en secondes, et erreurs des requêtes de chaque entête."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    def record(self, header: str, latency: float, ok: bool) -> None:
+        self.latencies.setdefault(header, []).append(latency)
+        self.errors.setdefault(header, 0)
+        if not ok:
+            self.errors[header] += 1
+
+    def report(self, duration: float) -> dict[str, dict[str, float]]:
+        """Résumé de chaque entête et de l'ensemble (`TOTAL`)."""
+        rapport: dict[str, dict[str, float]] = {}
+        toutes: list[float] = []
+        for header, latences in sorted(self.latencies.items()):
+            toutes.extend(latences)
+            rapport[header] = _summary(sorted(latences), self.errors[header],
+                                       duration)
+        rapport["TOTAL"] = _summary(sorted(toutes), sum(self.errors.values()),
+                                    duration)
+        return rapport
+
+
+def _summary(latences: list[float], erreurs: int,
+             duration: float) -> dict[str, float]:
+    return {"count": len(latences),
+            "errors": erreurs,
+            "error_rate": erreurs / len(latences) if latences else 0.0,
+            "throughput": len(latences) / duration if duration else 0.0,
+            "p50_ms": percentile(latences, 0.50) * 1000,
+            "p95_ms": percentile(latences, 0.95) * 1000,
+            "p99_ms": percentile(latences, 0.99) * 1000}
+
+
+def format_report(rapport: dict[str, dict[str, float]]) -> str:
+    """Met le résumé en tableau."""
+    lignes = [f"{'Entête':<24}{'Requêtes':>10}{'Erreurs':>9}{'req/s':>10}"
+              f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+    for header, ligne in rapport.items():
+        lignes.append(f"{header:<24}{ligne['count']:>10}{ligne['errors']:>9}"
+                      f"{ligne['throughput']:>10.1f}{ligne['p50_ms']:>10.2f}"
+                      f"{ligne['p95_ms']:>10.2f}{ligne['p99_ms']:>10.2f}")
+    return "\n".join(lignes)
+
+
+class Pacer:
+    """
+    Répartit les requêtes de tous les utilisateurs simulés au débit
+    `rate` par seconde (0 = sans limite). Une seule boucle asyncio s'en
+    sert, sans verrou.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+
+    async def wait(self) -> float:
+        """Attend le prochain créneau et retourne son heure prévue."""
+        maintenant = time.monotonic()
+        if not self._interval:
+            return maintenant
+        # Un retard de plus d'une seconde n'est pas rattrapé d'un coup.
+        creneau = max(self._next, maintenant - 1.0)
+        self._next = creneau + self._interval
+        if creneau > maintenant:
+            await asyncio.sleep(creneau - maintenant)
+        return creneau
+
+
+class VirtualUser:
+    """Utilisateur simulé, avec sa propre connexion au serveur."""
+
+    def __init__(self, args: argparse.Namespace, username: str,
+                 usernames: list[str], stats: Statistics,
+                 rng: random.Random) -> None:
+        self._args = args
+        self._username = username
+        # Comptes existants, partagés par les utilisateurs simulés.
+        self._usernames = usernames
+        self._stats = stats
+        self._rng = rng
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._format = glocodec.JSON
+        self._compression = False
+        self._streaming = False
+        # Nombre de courriels de la boîte, d'après la dernière réponse.
+        self._total = 0
+
+    async def _connect(self) -> None:
+        """Ouvre la connexion, négocie le format et connecte l'utilisateur."""
+        self._reader, self._writer = await asyncio.open_connection(
+            self._args.dest, self._args.port)
+        self._format = glocodec.JSON
+        self._compression = False
+        self._streaming = False
+        reponse = await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.NEGOTIATE,
+            payload=gloutils.NegotiationPayload(
+                formats=[self._args.wire_format, glocodec.JSON],
+                compression=not self._args.no_compression,
+                streaming=True)))
+        payload = reponse.get("payload", {})
+        if payload.get("formats", [None])[0] in glocodec.ENCODERS:
+            self._format = payload["formats"][0]
+        self._compression = payload.get("compression") is True
+        self._streaming = payload.get("streaming") is True
+        auth = gloutils.AuthPayload(username=self._username, password=PASSWORD)
+        reponse = await self._exchange(gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGIN, payload=auth))
+        if reponse["header"] != gloutils.Headers.OK:
+            reponse = await self._exchange(gloutils.GloMessage(
+                header=gloutils.Headers.AUTH_REGISTER, payload=auth))
+        if reponse["header"] != gloutils.Headers.OK:
+            raise glosocket.GLOSocketError(f"Session refusée: {self._username}")
+        if self._username not in self._usernames:
+            self._usernames.append(self._username)
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        try:
+            await self._send(gloutils.GloMessage(header=gloutils.Headers.BYE))
+        except glosocket.GLOSocketError:
+            pass
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        self._writer = None
+
+    async def _send(self, message: gloutils.GloMessage) -> None:
+        """Envoie un message, le corps d'un long courriel en plusieurs trames."""
+        payload = message.get("payload")
+        if (self._streaming
+                and message["header"] == gloutils.Headers.EMAIL_SENDING
+                and len(payload["content"]) > gloutils.STREAM_THRESHOLD):
+            contenu = payload["content"]
+            await self._send(gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_SENDING,
+                payload=dict(payload, content="", chunked=True)))
+            taille = gloutils.STREAM_CHUNK_SIZE
+            for debut in range(0, len(contenu), taille):
+                await self._send(gloutils.GloMessage(
+                    header=gloutils.Headers.EMAIL_CHUNK,
+                    payload=gloutils.ChunkPayload(
+                        data=contenu[debut:debut + taille],
+                        last=debut + taille >= len(contenu))))
+            return
+        await glosocket.send_frame_async(
+            self._writer, glocodec.encode(message, self._format),
+            compress=self._compression)
+
+    async def _recv(self) -> gloutils.GloMessage:
+        try:
+            return glocodec.decode(await glosocket.recv_frame_async(self._reader))
+        except glocodec.CodecError as ex:
+            raise glosocket.GLOSocketError("Message du serveur invalide") from ex
+
+    async def _exchange(self, message: gloutils.GloMessage
+                        ) -> gloutils.GloMessage:
+        """
+        Envoie une requête et attend sa réponse entière, y compris un corps
+        en plusieurs trames, qui est lu puis ignoré.
+        """
+        await self._send(message)
+        reponse = await self._recv()
+        if reponse.get("payload", {}).get("chunked") is True:
+            while True:
+                morceau = await self._recv()
+                if morceau.get("header") != gloutils.Headers.EMAIL_CHUNK:
+                    raise glosocket.GLOSocketError("Morceau de courriel attendu")
+                if morceau["payload"]["last"]:
+                    break
+        return reponse
+
+    async def _timed(self, message: gloutils.GloMessage,
+                     debut: float) -> gloutils.GloMessage:
+        """Échange une requête et enregistre sa latence depuis `debut`."""
+        header = gloutils.Headers(message["header"]).name
+        try:
+            reponse = await self._exchange(message)
+        except (glosocket.GLOSocketError, OSError):
+            self._stats.record(header, time.monotonic() - debut, False)
+            raise
+        self._stats.record(header, time.monotonic() - debut,
+                           reponse.get("header") == gloutils.Headers.OK)
+        return reponse
+
+    def _message(self, operation: str) -> Optional[gloutils.GloMessage]:
+        """Construit la requête d'une opération, ou None pour sauter."""
+        rng = self._rng
+        match operation:
+            case "register":
+                nom = f"{self._args.prefix}r{rng.getrandbits(48):x}"
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.AUTH_REGISTER,
+                    payload=gloutils.AuthPayload(username=nom, password=PASSWORD))
+            case "login":
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.AUTH_LOGIN,
+                    payload=gloutils.AuthPayload(username=self._username,
+                                                 password=PASSWORD))
+            case "send":
+                destinataire = rng.choice(self._usernames or [self._username])
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.EMAIL_SENDING,
+                    payload=gloutils.EmailContentPayload(
+                        sender=f"{self._username}@{gloutils.SERVER_DOMAIN}",
+                        destination=f"{destinataire}@{gloutils.SERVER_DOMAIN}",
+                        subject=_text(rng, 4),
+                        date=gloutils.get_current_utc_time(),
+                        content=_body(rng, self._args.body_size)))
+            case "list":
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.INBOX_READING_REQUEST,
+                    payload=gloutils.InboxPagePayload(offset=0, limit=20))
+            case "read":
+                if self._total < 1:
+                    return self._message("list")
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.INBOX_READING_CHOICE,
+                    payload=gloutils.EmailChoicePayload(
+                        choice=rng.randint(1, min(self._total, 20))))
+            case "stats":
+                return gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)
+            case "search":
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.SEARCH,
+                    payload=gloutils.SearchPayload(terms=rng.choice(_WORDS)))
+        return None
+
+    async def run(self, deadline: float, mix: dict[str, float],
+                  pacer: Pacer) -> None:
+        """Enchaîne les opérations jusqu'à `deadline`, en se reconnectant."""
+        operations, poids = list(mix), list(mix.values())
+        while time.monotonic() < deadline:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                operation = self._rng.choices(operations, poids)[0]
+                message = self._message(operation)
+                if message is None:
+                    continue
+                if operation == "login":
+                    # AUTH_LOGOUT n'a pas de réponse.
+                    await self._send(gloutils.GloMessage(
+                        header=gloutils.Headers.AUTH_LOGOUT))
+                debut = await pacer.wait()
+                if time.monotonic() >= deadline:
+                    break
+                reponse = await self._timed(message, debut)
+                if (operation == "register"
+                        and reponse.get("header") == gloutils.Headers.OK):
+                    # La connexion est maintenant celle du nouveau compte.
+                    self._username = message["payload"]["username"]
+                    self._usernames.append(self._username)
+                    self._total = 0
+                payload = reponse.get("payload", {})
+                if "total" in payload:
+                    self._total = payload["total"]
+                elif "count" in payload:
+                    self._total = payload["count"]
+            except (glosocket.GLOSocketError, OSError):
+                # Connexion rompue: elle est rouverte au tour suivant.
+                if self._writer is not None:
+                    self._writer.close()
+                self._writer = None
+                await asyncio.sleep(0.1)
+        await self.close()
+
+
+def _raise_file_limit(count: int) -> None:
+    """Relève la limite de descripteurs de fichiers pour `count` connexions."""
+    if resource is None:
+        return
+    souple, dure = resource.getrlimit(resource.RLIMIT_NOFILE)
+    voulue = count + 64
+    if souple != resource.RLIM_INFINITY and souple < voulue:
+        if dure != resource.RLIM_INFINITY:
+            voulue = min(voulue, dure)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (voulue, dure))
+
+
+async def run_load(args: argparse.Namespace) -> tuple[Statistics, float]:
+    """Lance les utilisateurs simulés et retourne leurs statistiques."""
+    stats = Statistics()
+    pacer = Pacer(args.rate)
+    mix = parse_mix(args.mix)
+    usernames: list[str] = []
+    rng = random.Random(args.random_seed)
+    debut = time.monotonic()
+    deadline = debut + args.ramp_up + args.duration
+
+    async def lancer(numero: int) -> None:
+        # Les connexions sont étalées sur la durée de la montée en charge.
+        await asyncio.sleep(args.ramp_up * numero / max(1, args.users))
+        utilisateur = VirtualUser(args, f"{args.prefix}{numero}", usernames, stats,
+                                  random.Random(rng.getrandbits(64)))
+        await utilisateur.run(deadline, mix, pacer)
+
+    await asyncio.gather(*(lancer(numero) for numero in range(args.users)))
+    return stats, time.monotonic() - debut
+
+
+def seed(storage: glostorage.Storage, users: int, messages: int,
+         body_size: int, prefix: str, rng: random.Random) -> int:
+    """
+    Crée `users` comptes et remplit leurs boîtes: `messages` courriels en
+    moyenne par boîte et des corps de `body_size` octets en médiane.
+
+    Retourne le nombre de courriels livrés.
+    """
+    empreinte = gloauth.hash_password(PASSWORD)
+    noms = [f"{prefix}{numero}" for numero in range(users)]
+    for nom in noms:
+        storage.add_user(nom, empreinte)
+    sigma = 1.0
+    livres = 0
+    for nom in noms:
+        # Loi log-normale de moyenne `messages`.
+        nombre = int(rng.lognormvariate(
+            math.log(max(1, messages)) - sigma ** 2 / 2, sigma))
+        for _ in range(nombre):
+            contenu = _body(rng, body_size)
+            payload = gloutils.EmailContentPayload(
+                sender=f"{rng.choice(noms)}@{gloutils.SERVER_DOMAIN}",
+                destination=f"{nom}@{gloutils.SERVER_DOMAIN}",
+                subject=_text(rng, 4),
+                date=gloutils.get_current_utc_time(),
+                content=contenu)
+            resultat = storage.deliver(storage.store_email(payload), [nom],
+                                       contenu)
+            livres += resultat.count(glostorage.Delivery.DELIVERED)
+    return livres
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--destination", action="store",
+                        dest="dest", default=None,
+                        help="Adresse IP/URL du serveur à charger.")
+    parser.add_argument("--port", action="store", type=int,
+                        dest="port", default=gloutils.APP_PORT,
+                        help="Port du serveur.")
+    parser.add_argument("-u", "--users", action="store", type=int,
+                        dest="users", default=100,
+                        help="Nombre d'utilisateurs simulés (et de comptes"
+                             " créés par --seed).")
+    parser.add_argument("--duration", action="store", type=float,
+                        dest="duration", default=30.0,
+                        help="Durée de la mesure en secondes, après la"
+                             " montée en charge.")
+    parser.add_argument("--ramp-up", action="store", type=float,
+                        dest="ramp_up", default=5.0,
+                        help="Durée en secondes sur laquelle les connexions"
+                             " sont étalées.")
+    parser.add_argument("--rate", action="store", type=float,
+                        dest="rate", default=0.0,
+                        help="Débit total visé en requêtes par seconde"
+                             " (0 = sans limite).")
+    parser.add_argument("--mix", action="store",
+                        dest="mix", default=DEFAULT_MIX,
+                        help="Répartition des opérations, parmi "
+                             + ", ".join(OPERATIONS) + ".")
+    parser.add_argument("--body-size", action="store", type=int,
+                        dest="body_size", default=2048,
+                        help="Taille médiane en octets des corps envoyés.")
+    parser.add_argument("-f", "--format", action="store",
+                        dest="wire_format", choices=glocodec.FORMATS,
+                        default=glocodec.BINARY,
+                        help="Format des messages à proposer au serveur.")
+    parser.add_argument("--no-compression", action="store_true",
+                        dest="no_compression",
+                        help="Ne propose pas la compression des messages.")
+    parser.add_argument("--prefix", action="store",
+                        dest="prefix", default="charge",
+                        help="Préfixe des noms des comptes simulés.")
+    parser.add_argument("--random-seed", action="store", type=int,
+                        dest="random_seed", default=None,
+                        help="Graine des tirages, pour rejouer une charge.")
+    parser.add_argument("--json", action="store",
+                        dest="json_path", default=None,
+                        help="Écrit aussi le résumé en JSON dans ce fichier.")
+    parser.add_argument("--seed", action="store",
+                        dest="seed_dir", default=None,
+                        help="Remplit d'abord ce dossier de données (serveur"
+                             " arrêté).")
+    parser.add_argument("--storage", action="store",
+                        dest="storage", choices=("directory", "sqlite"),
+                        default="directory",
+                        help="Stockage du dossier rempli par --seed.")
+    parser.add_argument("--seed-messages", action="store", type=int,
+                        dest="seed_messages", default=50,
+                        help="Nombre moyen de courriels par boîte remplie.")
+    args = parser.parse_args(sys.argv[1:])
+    try:
+        parse_mix(args.mix)
+    except ValueError as ex:
+        parser.error(f"--mix: {ex}")
+    if args.dest is None and args.seed_dir is None:
+        parser.error("--destination ou --seed est requis")
+    if args.seed_dir is not None:
+        data_dir = pathlib.Path(args.seed_dir)
+        if args.storage == "sqlite":
+            storage = glosqlite.SQLiteStorage(data_dir / gloutils.SQLITE_FILENAME)
+        else:
+            storage = glostorage.DirectoryStorage(data_dir)
+        try:
+            livres = seed(storage, args.users, args.seed_messages,
+                          args.body_size, args.prefix,
+                          random.Random(args.random_seed))
+        finally:
+            storage.close()
+        print(f"{args.users} compte(s) et {livres} courriel(s) créés.")
+    if args.dest is None:
+        return 0
+    _raise_file_limit(args.users)
+    stats, duree = asyncio.run(run_load(args))
+    rapport = stats.report(duree)
+    print(format_report(rapport))
+    if args.json_path is not None:
+        pathlib.Path(args.json_path).write_text(
+            json.dumps({"duration": duree, "users": args.users,
+                        "rate": args.rate, "mix": parse_mix(args.mix),
+                        "headers": rapport}, indent=2), encoding="utf-8")
+    return 1 if rapport["TOTAL"]["count"] == 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,406 @@
+"""\
+Module fournissant les métriques du serveur.
+
+Pour chaque entête (`gloutils.Headers`), le serveur compte les requêtes et
+les erreurs et range la durée de leur traitement dans un histogramme
+(`Histogram`) à la manière de HdrHistogram: des intervalles linéaires
+dans chaque puissance de deux, soit une précision relative d'environ 6 %
+de la microseconde à plusieurs heures, avec un compteur par intervalle
+occupé.
+
+S'y ajoutent les octets reçus et envoyés (taille des messages non
+compressés, dans les deux sens), les connexions, et le temps
+passé dans le stockage (`TimedStorage`, qui enveloppe le stockage du
+serveur) et dans les entrées-sorties réseau.
+
+Les métriques sont rendues en texte au format d'exposition de Prometheus
+(`Metrics.render`), retourné par l'entête METRICS ou par le socket Unix
+local `MetricsEndpoint`, par exemple avec `nc -U chemin`.
+
+Chaque mesure ne coûte que deux lectures d'horloge et un verrou: les
+métriques restent actives en production.
+"""
+import os
+import pathlib
+import socket
+import threading
+import time
+from typing import Iterator, Optional
+
+import glosearch
+import glostorage
+import gloutils
+
+# Bits de la partie linéaire d'un intervalle: 2**(SUB_BITS - 1) intervalles
+# par puissance de deux.
+SUB_BITS = 5
+_SUB_COUNT = 1 << SUB_BITS
+_HALF = _SUB_COUNT >> 1
+
+# Quantiles rendus pour chaque histogramme.
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _bucket(value: int) -> int:
+    """Indice de l'intervalle d'une valeur entière positive."""
+    if value < _SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BITS
+    return _SUB_COUNT + (shift - 1) * _HALF + (value >> shift) - _HALF
+
+
+def _bucket_limit(index: int) -> int:
+    """Plus grande valeur de l'intervalle `index`."""
+    if index < _SUB_COUNT:
+        return index
+    shift, top = divmod(index - _SUB_COUNT, _HALF)
+    shift += 1
+    return ((top + _HALF + 1) << shift) - 1
+
+
+class Histogram:
+    """Histogramme de durées en microsecondes, non synchronisé."""
+
+    def __init__(self) -> None:
+        self.counts: dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        index = _bucket(max(0, value))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        """Borne supérieure de l'intervalle qui contient le quantile."""
+        if not self.count:
+            return 0
+        rang = max(1, round(fraction * self.count))
+        cumul = 0
+        for index in sorted(self.counts):
+            cumul += self.counts[index]
+            if cumul >= rang:
+                return min(_bucket_limit(index), self.max)
+        return self.max
+
+    def buckets(self) -> Iterator[tuple[int, int]]:
+        """Bornes supérieures des intervalles occupés et comptes cumulés."""
+        cumul = 0
+        for index in sorted(self.counts):
+            cumul += self.counts[index]
+            yield _bucket_limit(index), cumul
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class Metrics:
+    """
+    Métriques d'un processus serveur, mises à jour depuis la boucle et
+    les fils du pool sous un seul verrou.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self.requests: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.latencies: dict[str, Histogram] = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.connections_total = 0
+        # Appels au stockage: nombre et durée totale en secondes.
+        self.storage_calls: dict[str, int] = {}
+        self.storage_seconds: dict[str, float] = {}
+        # Durée des entrées-sorties réseau, par sens.
+        self.network_seconds = {"recv": 0.0, "send": 0.0}
+
+    def request(self, header: str, seconds: float, error: bool) -> None:
+        """Enregistre le traitement d'une requête."""
+        with self._lock:
+            self.requests[header] = self.requests.get(header, 0) + 1
+            if error:
+                self.errors[header] = self.errors.get(header, 0) + 1
+            histogramme = self.latencies.get(header)
+            if histogramme is None:
+                histogramme = self.latencies[header] = Histogram()
+            histogramme.record(int(seconds * 1e6))
+
+    def storage(self, call: str, seconds: float) -> None:
+        with self._lock:
+            self.storage_calls[call] = self.storage_calls.get(call, 0) + 1
+            self.storage_seconds[call] = (self.storage_seconds.get(call, 0.0)
+                                          + seconds)
+
+    def network(self, direction: str, seconds: float, size: int = 0) -> None:
+        """Enregistre une entrée-sortie réseau et les octets transférés."""
+        with self._lock:
+            self.network_seconds[direction] += seconds
+            if direction == "recv":
+                self.bytes_received += size
+            else:
+                self.bytes_sent += size
+
+    def transferred(self, received: int = 0, sent: int = 0) -> None:
+        with self._lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self) -> None:
+        with self._lock:
+            self.connections -= 1
+
+    def render(self, gauges: Optional[dict[str, float]] = None) -> str:
+        """
+        Rend les métriques en texte, avec les jauges supplémentaires
+        `gauges` (nom: valeur) fournies par le serveur.
+        """
+        lignes: list[str] = []
+
+        def metrique(nom: str, kind: str, aide: str) -> None:
+            lignes.append(f"# HELP {nom} {aide}")
+            lignes.append(f"# TYPE {nom} {kind}")
+
+        with self._lock:
+            metrique("glo_requests_total", "counter", "Requêtes traitées.")
+            for header, nombre in sorted(self.requests.items()):
+                lignes.append(f'glo_requests_total{{header="{_label(header)}"}} {nombre}')
+            metrique("glo_errors_total", "counter",
+                     "Requêtes en erreur (réponse ERROR ou message invalide).")
+            for header, nombre in sorted(self.errors.items()):
+                lignes.append(f'glo_errors_total{{header="{_label(header)}"}} {nombre}')
+            metrique("glo_request_duration_us", "histogram",
+                     "Durée du traitement des requêtes en microsecondes.")
+            for header, histogramme in sorted(self.latencies.items()):
+                etiquette = f'header="{_label(header)}"'
+                for borne, cumul in histogramme.buckets():
+                    lignes.append(f'glo_request_duration_us_bucket{{{etiquette},le="{borne}"}} {cumul}')
+                lignes.append(f'glo_request_duration_us_bucket{{{etiquette},le="+Inf"}} {histogramme.count}')
+                lignes.append(f"glo_request_duration_us_sum{{{etiquette}}} {histogramme.total}")
+                lignes.append(f"glo_request_duration_us_count{{{etiquette}}} {histogramme.count}")
+            metrique("glo_request_duration_quantile_us", "gauge",
+                     "Quantiles de la durée des requêtes en microsecondes.")
+            for header, histogramme in sorted(self.latencies.items()):
+                for quantile in QUANTILES:
+                    lignes.append(f'glo_request_duration_quantile_us{{header="{_label(header)}",quantile="{quantile}"}} {histogramme.percentile(quantile)}')
+            metrique("glo_bytes_received_total", "counter",
+                     "Octets des messages reçus, après décompression.")
+            lignes.append(f"glo_bytes_received_total {self.bytes_received}")
+            metrique("glo_bytes_sent_total", "counter",
+                     "Octets des messages envoyés, avant compression.")
+            lignes.append(f"glo_bytes_sent_total {self.bytes_sent}")
+            metrique("glo_connections", "gauge", "Connexions ouvertes.")
+            lignes.append(f"glo_connections {self.connections}")
+            metrique("glo_connections_total", "counter", "Connexions acceptées.")
+            lignes.append(f"glo_connections_total {self.connections_total}")
+            metrique("glo_storage_calls_total", "counter",
+                     "Appels au stockage.")
+            for call, nombre in sorted(self.storage_calls.items()):
+                lignes.append(f'glo_storage_calls_total{{call="{call}"}} {nombre}')
+            metrique("glo_storage_seconds_total", "counter",
+                     "Temps passé dans le stockage.")
+            for call, secondes in sorted(self.storage_seconds.items()):
+                lignes.append(f'glo_storage_seconds_total{{call="{call}"}} {secondes:.6f}')
+            metrique("glo_network_seconds_total", "counter",
+                     "Temps passé dans les entrées-sorties réseau.")
+            for direction, secondes in sorted(self.network_seconds.items()):
+                lignes.append(f'glo_network_seconds_total{{direction="{direction}"}} {secondes:.6f}')
+        metrique("glo_uptime_seconds", "gauge", "Durée de fonctionnement.")
+        lignes.append(f"glo_uptime_seconds {time.time() - self._started:.0f}")
+        for nom, valeur in sorted((gauges or {}).items()):
+            metrique(nom, "gauge", nom.removeprefix("glo_").replace("_", " ") + ".")
+            lignes.append(f"{nom} {valeur}")
+        return "\n".join(lignes) + "\n"
+
+
+class _TimedIterator:
+    """Itérateur dont chaque élément produit est chronométré."""
+
+    def __init__(self, iterator: Iterator[str], metrics: Metrics,
+                 call: str) -> None:
+        self._iterator = iterator
+        self._metrics = metrics
+        self._call = call
+
+    def __iter__(self) -> "_TimedIterator":
+        return self
+
+    def __next__(self) -> str:
+        debut = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self._metrics.storage(self._call, time.perf_counter() - debut)
+
+    def close(self) -> None:
+        close = getattr(self._iterator, "close", None)
+        if close is not None:
+            close()
+
+
+class _TimedBodyWriter(glostorage.BodyWriter):
+    """BodyWriter dont chaque appel est chronométré."""
+
+    def __init__(self, writer: glostorage.BodyWriter, metrics: Metrics) -> None:
+        self._writer = writer
+        self._metrics = metrics
+
+    @property
+    def size(self) -> int:
+        return self._writer.size
+
+    def write(self, data: bytes) -> None:
+        debut = time.perf_counter()
+        try:
+            self._writer.write(data)
+        finally:
+            self._metrics.storage("body_write", time.perf_counter() - debut)
+
+    def commit(self) -> str:
+        debut = time.perf_counter()
+        try:
+            return self._writer.commit()
+        finally:
+            self._metrics.storage("body_commit", time.perf_counter() - debut)
+
+    def abort(self) -> None:
+        self._writer.abort()
+
+
+class TimedStorage(glostorage.Storage):
+    """
+    Stockage qui chronomètre chaque appel au stockage `storage` qu'il
+    enveloppe; le corps d'un courriel lu par morceaux l'est à chaque
+    morceau.
+    """
+
+    def __init__(self, storage: glostorage.Storage, metrics: Metrics) -> None:
+        self._storage = storage
+        self._metrics = metrics
+        self.cache = storage.cache
+
+    def _timed(self, call: str, fonction, *args):
+        debut = time.perf_counter()
+        try:
+            return fonction(*args)
+        finally:
+            self._metrics.storage(call, time.perf_counter() - debut)
+
+    def get_password(self, username: str) -> Optional[str]:
+        return self._timed("get_password", self._storage.get_password, username)
+
+    def reload_password(self, username: str) -> Optional[str]:
+        return self._timed("reload_password", self._storage.reload_password,
+                           username)
+
+    def add_user(self, username: str, password: str) -> bool:
+        return self._timed("add_user", self._storage.add_user, username,
+                           password)
+
+    def set_password(self, username: str, password: str) -> None:
+        self._timed("set_password", self._storage.set_password, username,
+                    password)
+
+    def load_mailbox(self, username: str) -> None:
+        self._timed("load_mailbox", self._storage.load_mailbox, username)
+
+    def page(self, username: str, offset: int, limit: int
+             ) -> tuple[list[glostorage.IndexRecord], int]:
+        return self._timed("page", self._storage.page, username, offset, limit)
+
+    def get(self, username: str, number: int) -> glostorage.IndexRecord:
+        return self._timed("get", self._storage.get, username, number)
+
+    def read(self, username: str, number: int) -> gloutils.EmailContentPayload:
+        return self._timed("read", self._storage.read, username, number)
+
+    def stream(self, username: str, number: int, chunk_size: int
+               ) -> tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        entete, morceaux = self._timed("stream", self._storage.stream,
+                                       username, number, chunk_size)
+        return entete, _TimedIterator(morceaux, self._metrics, "stream_chunk")
+
+    def stats(self, username: str) -> gloutils.StatsPayload:
+        return self._timed("stats", self._storage.stats, username)
+
+    def store_email(self, payload: gloutils.EmailContentPayload
+                    ) -> glostorage.StoredEmail:
+        return self._timed("store_email", self._storage.store_email, payload)
+
+    def body_writer(self) -> glostorage.BodyWriter:
+        return _TimedBodyWriter(self._storage.body_writer(), self._metrics)
+
+    def deliver(self, email: glostorage.StoredEmail, usernames: list[str],
+                content: Optional[str] = None) -> list[glostorage.Delivery]:
+        return self._timed("deliver", self._storage.deliver, email, usernames,
+                           content)
+
+    def search(self, username: str, query: glosearch.Query
+               ) -> list[tuple[int, glostorage.IndexRecord]]:
+        return self._timed("search", self._storage.search, username, query)
+
+    def collect_garbage(self, grace: float = 3600.0) -> int:
+        return self._timed("collect_garbage", self._storage.collect_garbage,
+                           grace)
+
+    def close(self) -> None:
+        self._storage.close()
+
+
+class MetricsEndpoint:
+    """
+    Socket Unix local qui envoie les métriques rendues par `render` à
+    chaque connexion, puis la ferme. Servi par un fil dédié.
+    """
+
+    def __init__(self, path: pathlib.Path, render) -> None:
+        """Lève OSError si le socket ne peut pas être créé."""
+        self._path = path
+        self._render = render
+        # Un socket laissé par un serveur arrêté brutalement est remplacé.
+        path.unlink(missing_ok=True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.bind(os.fspath(path))
+            os.chmod(path, 0o600)
+            self._socket.listen()
+        except OSError:
+            self._socket.close()
+            raise
+        self._thread = threading.Thread(target=self._serve, daemon=True,
+                                        name="glo-metrics")
+        self._thread.start()
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                connexion, _ = self._socket.accept()
+            except OSError:
+                # Socket fermé par close().
+                return
+            with connexion:
+                try:
+                    connexion.sendall(self._render().encode("utf-8"))
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        try:
+            # Débloque accept() dans le fil du socket.
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        self._thread.join(timeout=1.0)
+        self._path.unlink(missing_ok=True)
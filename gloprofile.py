@@ -0,0 +1,202 @@
+"""\
+Module fournissant le profilage du serveur, démarré et arrêté pendant
+qu'il fonctionne.
+
+Tant que le profilage est actif, chaque traitement de message est
+profilé avec cProfile, séparément pour chaque entête, et tracemalloc
+trace les allocations. À l'arrêt, un rapport horodaté est écrit avec,
+pour chaque entête, les fonctions les plus coûteuses du traitement
+(`_send_email`, `_get_email_list`, ...) et les sites qui ont le plus
+alloué de mémoire. Le profil de chaque entête est aussi enregistré au
+format de pstats, pour snakeviz ou `python -m pstats`.
+
+Inactif, le profilage ne coûte qu'un test par message.
+"""
+import cProfile
+import io
+import os
+import pathlib
+import pstats
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+# Nombre de fonctions et de sites d'allocation rendus dans le rapport.
+TOP = 25
+# Fichiers exclus des sites d'allocation.
+_IGNORED_ALLOCATIONS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _callees(stats: pstats.Stats, name: str) -> list[str]:
+    """
+    Noms des fonctions Python appelées par la fonction `name`: les
+    traitements appelés par la répartition des messages.
+    """
+    return sorted({func[2] for func, (*_, callers) in stats.stats.items()
+                   if not func[2].startswith("<")
+                   and any(caller[2] == name for caller in callers)})
+
+
+class Profiler:
+    """
+    Profilage des traitements du serveur.
+
+    Les traitements sont exécutés par plusieurs fils: chaque fil a son
+    propre profil par entête, réuni aux autres lors de l'arrêt.
+    """
+
+    def __init__(self, directory: pathlib.Path, top: int = TOP) -> None:
+        """`directory` est le dossier des rapports."""
+        self._directory = directory
+        self._top = top
+        self._lock = threading.Condition()
+        self.active = False
+        self._started = 0.0
+        self._tracing = False
+        # Profil de chaque (fil, entête), nombre d'appels et nom de la
+        # fonction profilée pour chaque entête, et traitements en cours.
+        self._profiles: dict[tuple[int, str], cProfile.Profile] = {}
+        self._calls: dict[str, int] = {}
+        self._handlers: dict[str, str] = {}
+        self._running = 0
+
+    def call(self, key: str, function, *args):
+        """
+        Appelle `function(*args)`, profilée sous `key` si le profilage est
+        actif, et retourne son résultat.
+        """
+        profil = None
+        with self._lock:
+            if self.active:
+                cle = (threading.get_ident(), key)
+                profil = self._profiles.get(cle)
+                if profil is None:
+                    profil = self._profiles[cle] = cProfile.Profile()
+                self._calls[key] = self._calls.get(key, 0) + 1
+                self._handlers.setdefault(key, function.__name__)
+                self._running += 1
+        if profil is None:
+            return function(*args)
+        try:
+            try:
+                profil.enable()
+            except ValueError:
+                # Un autre profileur est déjà actif dans ce fil.
+                return function(*args)
+            try:
+                return function(*args)
+            finally:
+                profil.disable()
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._lock.notify_all()
+
+    def start(self) -> bool:
+        """Démarre le profilage; retourne faux s'il était déjà actif."""
+        with self._lock:
+            if self.active:
+                return False
+            self._started = time.time()
+            # Un traçage démarré ailleurs (PYTHONTRACEMALLOC) est laissé actif.
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+            self.active = True
+        return True
+
+    def stop(self) -> Optional[pathlib.Path]:
+        """
+        Arrête le profilage, après la fin des traitements en cours, et
+        écrit le rapport. Retourne son chemin, ou None si le profilage
+        n'était pas actif.
+
+        Lève OSError si le rapport ne peut pas être écrit.
+        """
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._lock.wait_for(lambda: self._running == 0)
+            profiles, calls, handlers = (self._profiles, self._calls,
+                                         self._handlers)
+            self._profiles, self._calls, self._handlers = {}, {}, {}
+            debut = self._started
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if self._tracing:
+            tracemalloc.stop()
+        return self._write_report(debut, profiles, calls, handlers, snapshot)
+
+    def _write_report(self, debut: float,
+                      profiles: dict[tuple[int, str], cProfile.Profile],
+                      calls: dict[str, int], handlers: dict[str, str],
+                      snapshot: Optional[tracemalloc.Snapshot]
+                      ) -> pathlib.Path:
+        """Écrit le rapport et le profil de chaque entête."""
+        fin = time.time()
+        self._directory.mkdir(parents=True, exist_ok=True)
+        base = (f"glo-profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(fin))}"
+                f"-{os.getpid()}")
+        rapport = io.StringIO()
+        rapport.write(f"Profil du serveur GLO (pid {os.getpid()}) du"
+                      f" {time.ctime(debut)} au {time.ctime(fin)}"
+                      f" ({fin - debut:.1f} s)\n")
+        par_entete: dict[str, list[cProfile.Profile]] = {}
+        for (_, key), profil in profiles.items():
+            par_entete.setdefault(key, []).append(profil)
+        for key in sorted(par_entete, key=lambda key: -calls.get(key, 0)):
+            premier, *autres = par_entete[key]
+            stats = pstats.Stats(premier, stream=rapport)
+            for profil in autres:
+                stats.add(profil)
+            traitement = ", ".join(_callees(stats, handlers[key])) or key
+            stats.dump_stats(self._directory / f"{base}.{key}.prof")
+            rapport.write(f"\n== {key}: {traitement}"
+                          f" ({calls.get(key, 0)} appels) ==\n")
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self._top)
+        if not par_entete:
+            rapport.write("\nAucun message traité.\n")
+        if snapshot is not None:
+            rapport.write(f"\n== Allocations: {self._top} premiers sites ==\n")
+            for statistique in (snapshot.filter_traces(_IGNORED_ALLOCATIONS)
+                                .statistics("lineno")[:self._top]):
+                rapport.write(f"{statistique}\n")
+        chemin = self._directory / f"{base}.txt"
+        chemin.write_text(rapport.getvalue(), encoding="utf-8")
+        return chemin
+
+    def request_start(self) -> None:
+        """
+        Démarre le profilage dans un autre fil. Peut être appelée depuis
+        un gestionnaire de signal, qui ne doit pas attendre le verrou.
+        """
+        threading.Thread(target=self._start_and_report, daemon=True,
+                         name="glo-profile").start()
+
+    def request_stop(self) -> None:
+        """
+        Arrête le profilage et écrit le rapport dans un autre fil, sans
+        bloquer la boucle du serveur. Peut être appelée depuis un
+        gestionnaire de signal.
+        """
+        threading.Thread(target=self._stop_and_report, daemon=True,
+                         name="glo-profile").start()
+
+    def _start_and_report(self) -> None:
+        if self.start():
+            print("Profilage démarré.")
+
+    def _stop_and_report(self) -> None:
+        try:
+            chemin = self.stop()
+        except OSError as ex:
+            print("Erreur lors de l'écriture du profil:", ex)
+            return
+        if chemin is not None:
+            print(f"Profil écrit dans {chemin}.")
@@ -0,0 +1,180 @@
+"""\
+Module fournissant la recherche plein texte dans les boîtes de courriels.
+
+Le sujet et le début du corps (BODY_LIMIT octets) de chaque courriel sont
+découpés en termes (`document_terms`): mots en minuscules, sans accents.
+Chaque boîte a son index inversé, qui associe à chaque terme les courriels
+qui le contiennent.
+
+L'index d'une boîte du dossier de données (`SearchIndex`) est un journal
+en ajout seul (`SEARCH_FILENAME`), une ligne JSON par courriel, complété à
+chaque livraison. Il est relu en mémoire à la première recherche, puis
+seule sa fin l'est, comme l'index de la boîte: un redémarrage ne relit
+aucun courriel. Les courriels livrés avant l'index y sont ajoutés lors
+de la recherche suivante.
+
+Une recherche (`Query`) retient les courriels qui contiennent tous ses
+termes, puis applique ses filtres sur l'expéditeur et la date aux résumés
+de l'index de la boîte, sans lire les courriels.
+"""
+import datetime
+import email.utils
+import json
+import os
+import pathlib
+import re
+import unicodedata
+from typing import Iterable, Optional
+
+import gloutils
+
+# Octets du corps d'un courriel pris en compte par l'index.
+BODY_LIMIT = 1024 * 1024
+# Les mots plus longs (empreintes, données encodées) ne sont pas indexés.
+TERM_MAX_LENGTH = 64
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> set[str]:
+    """Retourne les termes d'un texte: ses mots en minuscules, sans accents."""
+    texte = unicodedata.normalize("NFKD", text.casefold())
+    texte = "".join(caractere for caractere in texte
+                    if not unicodedata.combining(caractere))
+    return {mot for mot in _WORD_RE.findall(texte)
+            if len(mot) <= TERM_MAX_LENGTH}
+
+
+def document_terms(subject: str, body: str) -> list[str]:
+    """Retourne les termes indexés d'un courriel, en ordre alphabétique."""
+    return sorted(tokenize(subject) | tokenize(body[:BODY_LIMIT]))
+
+
+def _parse_day(value: str) -> datetime.date:
+    """Lit une date AAAA-MM-JJ; lève ValueError si elle est invalide."""
+    return datetime.date.fromisoformat(value)
+
+
+class Query:
+    """
+    Recherche décrite par un SearchPayload.
+
+    `terms` est l'ensemble des termes recherchés, vide si la recherche ne
+    porte que sur les filtres.
+    """
+
+    def __init__(self, payload: gloutils.SearchPayload) -> None:
+        """Lève ValueError si le payload est invalide."""
+        self.terms = tokenize(payload["terms"])
+        self.sender = payload.get("sender", "").casefold().strip()
+        self.since: Optional[datetime.date] = None
+        self.until: Optional[datetime.date] = None
+        if payload.get("since"):
+            self.since = _parse_day(payload["since"])
+        if payload.get("until"):
+            self.until = _parse_day(payload["until"])
+
+    def accepts(self, record: dict) -> bool:
+        """Applique les filtres sur l'expéditeur et la date à un résumé."""
+        if self.sender and self.sender not in record["sender"].casefold():
+            return False
+        if self.since is None and self.until is None:
+            return True
+        try:
+            jour = email.utils.parsedate_to_datetime(record["date"]).date()
+        except (TypeError, ValueError):
+            # Date illisible: le courriel ne peut pas être dans l'intervalle.
+            return False
+        if self.since is not None and jour < self.since:
+            return False
+        return self.until is None or jour <= self.until
+
+
+class SearchIndex:
+    """
+    Index inversé d'une boîte, conservé dans le journal `path`.
+
+    Les courriels sont désignés par leur position dans l'index de la boîte
+    (0 = le plus ancien). Les méthodes doivent être appelées sous le verrou
+    de la boîte, et `append` et `reset` aussi sous son verrou de fichier.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._path = path
+        self._postings: dict[str, list[int]] = {}
+        self._documents: set[int] = set()
+        # Partie du journal déjà lue, comme pour l'index de la boîte.
+        self._offset = 0
+        self._inode = 0
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __contains__(self, document: int) -> bool:
+        return document in self._documents
+
+    def _clear(self) -> None:
+        self._postings.clear()
+        self._documents.clear()
+        self._offset = 0
+        self._inode = 0
+
+    def refresh(self) -> None:
+        """
+        Lit la fin du journal, complétée par cette boîte ou par un autre
+        processus, ou le journal entier s'il a été remplacé.
+        """
+        try:
+            info = os.stat(self._path)
+        except FileNotFoundError:
+            self._clear()
+            return
+        if info.st_ino != self._inode or info.st_size < self._offset:
+            self._clear()
+            self._inode = info.st_ino
+        if info.st_size == self._offset:
+            return
+        with self._path.open("rb") as journal:
+            journal.seek(self._offset)
+            data = journal.read()
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            try:
+                entree = json.loads(line)
+                document, terms = int(entree["doc"]), entree["terms"]
+            except (ValueError, KeyError, TypeError):
+                # Ligne tronquée par un arrêt brutal: le courriel sera
+                # indexé de nouveau.
+                continue
+            if document in self._documents:
+                continue
+            self._documents.add(document)
+            for term in terms:
+                self._postings.setdefault(term, []).append(document)
+
+    def append(self, document: int, terms: Iterable[str]) -> None:
+        """Ajoute un courriel au journal, sans le relire en mémoire."""
+        line = json.dumps({"doc": document, "terms": list(terms)}) + "\n"
+        with self._path.open("ab") as journal:
+            journal.write(line.encode("utf-8"))
+
+    def reset(self) -> None:
+        """Vide l'index, dont les positions ne sont plus valides."""
+        self._path.unlink(missing_ok=True)
+        self._clear()
+
+    def lookup(self, terms: set[str]) -> Optional[set[int]]:
+        """
+        Retourne les courriels qui contiennent tous les termes, ou None
+        s'il n'y a aucun terme (tous les courriels).
+        """
+        if not terms:
+            return None
+        listes = sorted((self._postings.get(term, []) for term in terms), key=len)
+        documents = set(listes[0])
+        for liste in listes[1:]:
+            if not documents:
+                break
+            documents.intersection_update(liste)
+        return documents
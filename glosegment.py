@@ -0,0 +1,268 @@
+"""\
+Module fournissant le journal de segments, un format de boîte de courriels
+en ajout seul.
+
+Les fiches des courriels d'une boîte sont écrites les unes à la suite des
+autres dans des fichiers segments (`<numéro>.seg`) d'au plus
+SEGMENT_MAX_SIZE octets, au lieu d'un fichier par courriel. Chaque
+enregistrement est précédé de sa longueur et de son CRC-32.
+
+La table `offsets` donne, pour chaque enregistrement, son segment, sa
+position et sa longueur, sur une taille fixe (`_ENTRY`): l'enregistrement
+k est une tranche de la projection mémoire (mmap) de son segment, sans
+ouverture de fichier.
+
+Le compactage réécrit les enregistrements de la table dans de nouveaux
+segments pleins, ce qui élimine les segments à moitié remplis et les
+enregistrements orphelins (écrits juste avant un arrêt brutal, mais jamais
+ajoutés à la table), puis remplace la table d'un seul coup. Les numéros
+des enregistrements ne changent pas.
+
+Les écritures se font sous le verrou de la boîte; les lecteurs, même dans
+d'autres processus, suivent la table quand elle grandit ou est remplacée.
+"""
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import zlib
+from typing import Iterator, Optional
+
+# Premiers octets de chaque segment.
+MAGIC = b"GLOSEG1\n"
+SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+OFFSETS_FILENAME = "offsets"
+
+# Segment, position et longueur d'un enregistrement dans la table.
+_ENTRY = struct.Struct("!IQI")
+# Longueur et CRC-32 précédant chaque enregistrement.
+_HEADER = struct.Struct("!II")
+
+
+class SegmentError(ValueError):
+    """Erreur levée pour un enregistrement absent ou corrompu."""
+
+
+def _segment_name(number: int) -> str:
+    return f"{number:08d}.seg"
+
+
+def _file_size(path: pathlib.Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+class SegmentLog:
+    """
+    Journal de segments d'une boîte, rangé dans le dossier `path`.
+
+    `read` et `__len__` peuvent être appelées depuis plusieurs fils;
+    `append` et `compact` doivent l'être sous le verrou de la boîte.
+    """
+
+    def __init__(self, path: pathlib.Path, create: bool = False) -> None:
+        """
+        Ouvre le journal de `path`, ou le crée vide si `create` est vrai.
+
+        Lève FileNotFoundError si le journal n'existe pas.
+        """
+        self._path = path
+        self._offsets_path = path / OFFSETS_FILENAME
+        if create:
+            path.mkdir(exist_ok=True)
+            self._offsets_path.touch()
+        elif not self._offsets_path.exists():
+            raise FileNotFoundError(self._offsets_path)
+        self._lock = threading.Lock()
+        self._table: Optional[mmap.mmap] = None
+        self._table_inode = 0
+        self._count = 0
+        self._maps: dict[int, mmap.mmap] = {}
+
+    def close(self) -> None:
+        """Libère les projections mémoire."""
+        with self._lock:
+            self._unmap()
+
+    def _unmap(self) -> None:
+        for projection in self._maps.values():
+            projection.close()
+        self._maps.clear()
+        if self._table is not None:
+            self._table.close()
+            self._table = None
+        self._count = 0
+
+    def _refresh(self) -> None:
+        """
+        Projette de nouveau la table si elle a grandi ou si elle a été
+        remplacée par un compactage, sous le verrou `_lock`.
+        """
+        info = os.stat(self._offsets_path)
+        if info.st_ino != self._table_inode:
+            # Table remplacée: les segments ont pu être réécrits.
+            self._unmap()
+            self._table_inode = info.st_ino
+        count = info.st_size // _ENTRY.size
+        if count == self._count:
+            return
+        if self._table is not None:
+            self._table.close()
+            self._table = None
+        if count:
+            with self._offsets_path.open("rb") as table:
+                self._table = mmap.mmap(table.fileno(), count * _ENTRY.size,
+                                        access=mmap.ACCESS_READ)
+        self._count = count
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return self._count
+
+    def _segment(self, number: int, end: int) -> mmap.mmap:
+        """
+        Retourne la projection du segment `number`, refaite si le segment
+        a grandi depuis au-delà de `end`.
+        """
+        projection = self._maps.get(number)
+        if projection is None or len(projection) < end:
+            if projection is not None:
+                projection.close()
+            with (self._path / _segment_name(number)).open("rb") as segment:
+                projection = mmap.mmap(segment.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            self._maps[number] = projection
+        return projection
+
+    def read(self, index: int) -> bytes:
+        """
+        Retourne l'enregistrement `index` (0 = le premier écrit).
+
+        Lève SegmentError s'il est absent ou corrompu.
+        """
+        with self._lock:
+            if index >= self._count:
+                self._refresh()
+            try:
+                data = self._read(index)
+            except FileNotFoundError:
+                # Segment supprimé par un compactage d'un autre processus:
+                # la table a été remplacée.
+                self._refresh()
+                data = self._read(index)
+        return data
+
+    def _read(self, index: int) -> bytes:
+        """Lit l'enregistrement `index`, sous le verrou `_lock`."""
+        if not 0 <= index < self._count:
+            raise SegmentError(f"Enregistrement {index} absent")
+        number, offset, length = _ENTRY.unpack_from(
+            self._table, index * _ENTRY.size)
+        projection = self._segment(number, offset + length)
+        if len(projection) < offset + length:
+            raise SegmentError(f"Segment {number} tronqué")
+        taille, crc = _HEADER.unpack_from(projection, offset)
+        data = projection[offset + _HEADER.size:offset + length]
+        if taille != len(data) or zlib.crc32(data) != crc:
+            raise SegmentError(f"Enregistrement {index} corrompu")
+        return data
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Parcourt les enregistrements dans l'ordre d'écriture."""
+        for index in range(len(self)):
+            yield self.read(index)
+
+    def _segments(self) -> list[int]:
+        """Numéros des segments présents, en ordre croissant."""
+        return sorted(int(segment.stem) for segment in self._path.glob("*.seg"))
+
+    def append(self, data: bytes) -> int:
+        """
+        Ajoute un enregistrement à la fin du dernier segment, ou d'un
+        nouveau segment s'il dépasserait SEGMENT_MAX_SIZE, et retourne son
+        numéro.
+
+        L'enregistrement est écrit avant son entrée de table: un arrêt
+        entre les deux laisse un orphelin que le compactage supprime.
+        """
+        with self._offsets_path.open("r+b") as table:
+            # Une entrée tronquée par un arrêt brutal est écrasée.
+            fin = table.seek(0, os.SEEK_END)
+            fin -= fin % _ENTRY.size
+            if fin:
+                table.seek(fin - _ENTRY.size)
+                number, _, _ = _ENTRY.unpack(table.read(_ENTRY.size))
+            else:
+                segments = self._segments()
+                number = segments[-1] if segments else 1
+            path = self._path / _segment_name(number)
+            size = _file_size(path)
+            record = _HEADER.pack(len(data), zlib.crc32(data)) + data
+            if size > len(MAGIC) and size + len(record) > SEGMENT_MAX_SIZE:
+                number += 1
+                path = self._path / _segment_name(number)
+                size = _file_size(path)
+            with path.open("ab") as segment:
+                if size == 0:
+                    segment.write(MAGIC)
+                    size = len(MAGIC)
+                segment.write(record)
+            table.seek(fin)
+            table.write(_ENTRY.pack(number, size, len(record)))
+        return fin // _ENTRY.size
+
+    def compact(self) -> int:
+        """
+        Réécrit les enregistrements de la table dans de nouveaux segments,
+        remplace la table, puis supprime les anciens segments.
+
+        Retourne le nombre d'octets libérés.
+        """
+        anciens = self._segments()
+        avant = sum(_file_size(self._path / _segment_name(number))
+                    for number in anciens)
+        number = (anciens[-1] if anciens else 0) + 1
+        entries: list[bytes] = []
+        size = 0
+        segment = None
+        temp = self._path / f".{OFFSETS_FILENAME}.{os.getpid()}.tmp"
+        try:
+            for data in self:
+                record = _HEADER.pack(len(data), zlib.crc32(data)) + data
+                if segment is not None and size + len(record) > SEGMENT_MAX_SIZE:
+                    segment.close()
+                    segment = None
+                    number += 1
+                if segment is None:
+                    segment = (self._path / _segment_name(number)).open("wb")
+                    segment.write(MAGIC)
+                    size = len(MAGIC)
+                segment.write(record)
+                entries.append(_ENTRY.pack(number, size, len(record)))
+                size += len(record)
+            if segment is not None:
+                segment.close()
+                segment = None
+            temp.write_bytes(b"".join(entries))
+            os.replace(temp, self._offsets_path)
+        except BaseException:
+            if segment is not None:
+                segment.close()
+            temp.unlink(missing_ok=True)
+            for nouveau in self._segments():
+                if nouveau not in anciens:
+                    (self._path / _segment_name(nouveau)).unlink(missing_ok=True)
+            raise
+        # Les lecteurs qui projettent encore un ancien segment le gardent
+        # jusqu'à ce qu'ils voient la nouvelle table.
+        for ancien in anciens:
+            (self._path / _segment_name(ancien)).unlink(missing_ok=True)
+        with self._lock:
+            self._refresh()
+        apres = sum(_file_size(self._path / _segment_name(nouveau))
+                    for nouveau in self._segments())
+        return avant - apres
@@ -1,9 +1,40 @@
 """\
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
+
+Chaque message est précédé de sa taille encodée sur 4 octets (`!I`).
+La réception lit directement dans un tampon préalloué à la taille annoncée
+et l'envoi transmet l'entête et le corps sans les concaténer.
+Les fonctions `*_frame` transmettent des octets et les fonctions `*_mesg`
+du texte UTF-8. Des versions asyncio (`*_async`) utilisent le même format,
+et les classes FrameReader et FrameWriter le découpent pour les sockets non
+bloquants.
+
+Un message peut être compressé avec zlib (`compress=True`): le bit de poids
+fort de l'entête (`COMPRESSED_FLAG`) le signale, et la taille annoncée est
+alors celle des données compressées. La réception reconnaît ce bit d'elle-
+même et décompresse par morceaux sans jamais produire plus de `max_size`
+octets.
 """
+import asyncio
+import collections
 import socket
 import struct
+import zlib
+from typing import Optional
+
+# Taille maximale demandée à chaque appel de recv_into.
+CHUNK_SIZE = 4096
+# Taille maximale acceptée pour un message, vérifiée avant toute allocation.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Taille en dessous de laquelle un message n'est pas compressé.
+COMPRESSION_THRESHOLD = 1024
+# Bit de l'entête marquant un message compressé.
+COMPRESSED_FLAG = 0x80000000
+# Nombre maximal de tampons passés à un même appel de sendmsg.
+_MAX_IOV = 64
+
+_HEADER = struct.Struct("!I")
 
 
 class GLOSocketError(Exception):
@@ -13,55 +44,401 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+def _recv_into(source: socket.socket, view: memoryview,
+               chunk_size: int) -> None:
     """
-    Fonction utilitaire pour recv_mesg.
+    Fonction utilitaire pour recv_frame.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Applique socket.recv_into en boucle jusqu'à ce que
+    `view` soit entièrement rempli.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    received = 0
+    size = len(view)
+    while received < size:
         try:
-            buffer = source.recv(chunk_size)
+            count = source.recv_into(view[received:received + chunk_size])
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if not count:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
-    return msg
+        received += count
 
 
-def send_mesg(dest_soc: socket.socket, message: str) -> None:
+def _frame_buffers(data: bytes, max_size: Optional[int],
+                   compress: bool = False) -> list[bytes]:
     """
-    Encode le message puis le transmet à la destination.
+    Retourne l'entête et le corps du message, à transmettre à la suite.
+
+    Avec `compress`, un message d'au moins COMPRESSION_THRESHOLD octets est
+    compressé si cela le raccourcit.
+
+    Lève une exception GLOSocketError si le message dépasse `max_size`
+    (MAX_FRAME_SIZE par défaut).
+    """
+    if len(data) > (MAX_FRAME_SIZE if max_size is None else max_size):
+        raise GLOSocketError("The message exceeds the maximum frame size")
+    if compress and len(data) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return [_HEADER.pack(len(compressed) | COMPRESSED_FLAG),
+                    compressed]
+    return [_HEADER.pack(len(data)), data]
+
+
+def _parse_header(header: bytes, max_size: int) -> tuple[int, bool]:
+    """
+    Retourne la taille annoncée par l'entête et si le message est
+    compressé.
+
+    Lève une exception GLOSocketError si la taille dépasse `max_size`.
+    """
+    value, = _HEADER.unpack(header)
+    length = value & ~COMPRESSED_FLAG
+    if length > max_size:
+        raise GLOSocketError("The announced message length exceeds"
+                             " the maximum frame size")
+    return length, bool(value & COMPRESSED_FLAG)
+
+
+class _Inflater:
+    """
+    Décompression incrémentale d'un message, bornée à `max_size` octets
+    produits pour résister aux bombes de décompression.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._decompressor = zlib.decompressobj()
+        self._remaining = max_size
+        self._output = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        """Décompresse un morceau du message."""
+        try:
+            chunk = self._decompressor.decompress(data, self._remaining + 1)
+        except zlib.error as ex:
+            raise GLOSocketError("The compressed data is invalid") from ex
+        if len(chunk) > self._remaining or self._decompressor.unconsumed_tail:
+            raise GLOSocketError("The decompressed message exceeds"
+                                 " the maximum frame size")
+        self._remaining -= len(chunk)
+        self._output += chunk
+
+    def finish(self) -> bytearray:
+        """
+        Retourne le message décompressé, qui doit être complet et ne pas
+        être suivi d'autres octets.
+        """
+        if not self._decompressor.eof:
+            raise GLOSocketError("The compressed data is truncated")
+        if self._decompressor.unused_data:
+            raise GLOSocketError("The compressed data is followed by"
+                                 " trailing bytes")
+        return self._output
+
+
+def _inflate(data: bytes, max_size: int) -> bytearray:
+    """Décompresse un message complet sans dépasser `max_size` octets."""
+    inflater = _Inflater(max_size)
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        inflater.feed(view[start:start + CHUNK_SIZE])
+    return inflater.finish()
+
+
+def _send_some(dest: socket.socket,
+               views: collections.deque[memoryview]) -> None:
+    """
+    Transmet le début de `views` avec un seul appel à socket.sendmsg
+    (envoi scatter/gather) et retire de `views` ce qui a été envoyé.
+    """
+    if hasattr(dest, "sendmsg"):
+        sent = dest.sendmsg([views[i] for i in range(min(len(views),
+                                                         _MAX_IOV))])
+    else:
+        # Plateformes sans sendmsg (Windows).
+        sent = dest.send(views[0])
+    while sent:
+        if sent >= len(views[0]):
+            sent -= len(views[0])
+            views.popleft()
+        else:
+            views[0] = views[0][sent:]
+            sent = 0
+
+
+def _send_buffers(dest: socket.socket, buffers: list[bytes]) -> None:
+    """
+    Fonction utilitaire pour send_frame.
+
+    Transmet les tampons à la suite sans les concaténer, en reprenant là
+    où un envoi partiel s'est arrêté.
+    """
+    views = collections.deque(memoryview(buffer) for buffer in buffers
+                              if len(buffer))
+    while views:
+        _send_some(dest, views)
+
+
+def send_frame(dest_soc: socket.socket, data: bytes,
+               max_size: Optional[int] = None,
+               compress: bool = False) -> None:
+    """
+    Transmet un message déjà encodé à la destination, compressé si
+    `compress` est vrai et que le message est assez grand.
 
     Lève une exception GLOSocketError en cas de problème
-    de communication.
+    de communication ou si le message dépasse `max_size`
+    (MAX_FRAME_SIZE par défaut).
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    buffers = _frame_buffers(data, max_size, compress)
     try:
-        dest_soc.sendall(data_length + data)
+        _send_buffers(dest_soc, buffers)
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
-def recv_mesg(source_soc: socket.socket) -> str:
+def send_mesg(dest_soc: socket.socket, message: str,
+              max_size: Optional[int] = None) -> None:
+    """
+    Encode le message puis le transmet à la destination.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si le message dépasse `max_size`
+    (MAX_FRAME_SIZE par défaut).
+    """
+    send_frame(dest_soc, message.encode(encoding='utf-8'), max_size)
+
+
+def recv_frame(source_soc: socket.socket,
+               chunk_size: Optional[int] = None,
+               max_size: Optional[int] = None) -> bytearray:
+    """
+    Récupère un message de la source, sans le décoder.
+
+    `chunk_size` (CHUNK_SIZE par défaut) borne chaque lecture et
+    `max_size` (MAX_FRAME_SIZE par défaut) la taille annoncée acceptée,
+    comme celle du message décompressé. Un message compressé est
+    décompressé au fil de la réception.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si la taille annoncée est trop grande.
+    """
+    chunk_size = CHUNK_SIZE if chunk_size is None else chunk_size
+    max_size = MAX_FRAME_SIZE if max_size is None else max_size
+
+    header = bytearray(_HEADER.size)
+    _recv_into(source_soc, memoryview(header), chunk_size)
+    length, compressed = _parse_header(header, max_size)
+
+    if not compressed:
+        data = bytearray(length)
+        _recv_into(source_soc, memoryview(data), chunk_size)
+        return data
+
+    inflater = _Inflater(max_size)
+    chunk = bytearray(min(length, chunk_size))
+    while length > 0:
+        view = memoryview(chunk)[:min(length, len(chunk))]
+        _recv_into(source_soc, view, chunk_size)
+        inflater.feed(view)
+        length -= len(view)
+    return inflater.finish()
+
+
+def _decode(data: bytes) -> str:
+    """Décode un message reçu en texte."""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError as ex:
+        raise GLOSocketError("The received data is not valid UTF-8") from ex
+
+
+def recv_mesg(source_soc: socket.socket,
+              chunk_size: Optional[int] = None,
+              max_size: Optional[int] = None) -> str:
     """
     Récupère un message de la source et le décode.
 
+    `chunk_size` (CHUNK_SIZE par défaut) borne chaque lecture et
+    `max_size` (MAX_FRAME_SIZE par défaut) la taille annoncée acceptée.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si la taille annoncée est trop grande.
+    """
+    return _decode(recv_frame(source_soc, chunk_size, max_size))
+
+
+async def send_frame_async(writer: asyncio.StreamWriter, data: bytes,
+                           max_size: Optional[int] = None,
+                           compress: bool = False) -> None:
+    """
+    Version asyncio de send_frame, avec le même format de message.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si le message dépasse `max_size`.
+    """
+    buffers = _frame_buffers(data, max_size, compress)
+    try:
+        writer.writelines(buffers)
+        await writer.drain()
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with socket") from ex
+
+
+async def send_mesg_async(writer: asyncio.StreamWriter, message: str,
+                          max_size: Optional[int] = None) -> None:
+    """
+    Version asyncio de send_mesg, avec le même format de message.
+
     Lève une exception GLOSocketError en cas de problème
-    de communication.
+    de communication ou si le message dépasse `max_size`.
     """
-    data_length = _recvall(source_soc, 4)
+    await send_frame_async(writer, message.encode(encoding='utf-8'),
+                           max_size)
+
+
+async def recv_frame_async(reader: asyncio.StreamReader,
+                           max_size: Optional[int] = None) -> bytes:
+    """
+    Version asyncio de recv_frame, avec le même format de message.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si la taille annoncée est trop grande.
+    """
+    max_size = MAX_FRAME_SIZE if max_size is None else max_size
     try:
-        length, = struct.unpack("!I", data_length)
-    except struct.error as ex:
-        raise GLOSocketError("The received data was"
-                             " not the message's length") from ex
+        length, compressed = _parse_header(
+            await reader.readexactly(_HEADER.size), max_size)
+        data = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    except OSError as ex:
+        raise GLOSocketError("The source socket is closed.") from ex
+    if compressed:
+        return _inflate(data, max_size)
+    return data
+
+
+async def recv_mesg_async(reader: asyncio.StreamReader,
+                          max_size: Optional[int] = None) -> str:
+    """
+    Version asyncio de recv_mesg, avec le même format de message.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si la taille annoncée est trop grande.
+    """
+    return _decode(await recv_frame_async(reader, max_size))
+
+
+class FrameReader:
+    """
+    Machine à états reconstituant les messages reçus sur un socket non
+    bloquant.
+
+    L'entête puis le corps de chaque message sont accumulés d'un appel à
+    l'autre, directement dans des tampons préalloués; seuls les messages
+    complets sont retournés, sans être décodés.
+    """
+
+    def __init__(self, chunk_size: Optional[int] = None,
+                 max_size: Optional[int] = None) -> None:
+        self._chunk_size = CHUNK_SIZE if chunk_size is None else chunk_size
+        self._max_size = MAX_FRAME_SIZE if max_size is None else max_size
+        self._header = bytearray(_HEADER.size)
+        self._body: Optional[bytearray] = None
+        self._compressed = False
+        self._view = memoryview(self._header)
+        self._received = 0
+        # Vrai quand l'autre socket a fermé la connexion.
+        self.closed = False
+
+    def _complete(self, messages: list[bytearray]) -> None:
+        """Passe à l'étape suivante quand le tampon courant est rempli."""
+        if self._body is None:
+            length, self._compressed = _parse_header(self._header,
+                                                     self._max_size)
+            self._body = bytearray(length)
+            self._view = memoryview(self._body)
+        else:
+            if self._compressed:
+                messages.append(_inflate(self._body, self._max_size))
+            else:
+                messages.append(self._body)
+            self._body = None
+            self._view = memoryview(self._header)
+        self._received = 0
+
+    def feed_from(self, source: socket.socket) -> list[bytearray]:
+        """
+        Lit tout ce qui est disponible sur `source` sans bloquer et
+        retourne les messages complétés.
+
+        Si l'autre socket a fermé la connexion, `closed` devient vrai;
+        les messages complétés avant la fermeture sont tout de même
+        retournés. Lève une exception GLOSocketError en cas de problème
+        de communication ou de taille annoncée trop grande.
+        """
+        messages: list[bytearray] = []
+        while not self.closed:
+            if self._received == len(self._view):
+                # Corps vide: rien à lire avant le prochain message.
+                self._complete(messages)
+                continue
+            end = min(len(self._view), self._received + self._chunk_size)
+            try:
+                count = source.recv_into(self._view[self._received:end])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as ex:
+                raise GLOSocketError("The source socket is closed.") from ex
+            if not count:
+                self.closed = True
+                break
+            self._received += count
+            if self._received == len(self._view):
+                self._complete(messages)
+        return messages
+
+
+class FrameWriter:
+    """
+    File des messages à transmettre sur un socket non bloquant.
+
+    Les messages sont ajoutés sans copie et transmis par sendmsg au
+    rythme où le socket les accepte.
+    """
+
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self._max_size = max_size
+        self._views: collections.deque[memoryview] = collections.deque()
+
+    def __bool__(self) -> bool:
+        """Vrai s'il reste des données à transmettre."""
+        return bool(self._views)
+
+    def write(self, data: bytes, compress: bool = False) -> None:
+        """
+        Ajoute un message déjà encodé à la file, compressé si `compress`
+        est vrai et que le message est assez grand.
+
+        Lève une exception GLOSocketError si le message est trop grand.
+        """
+        for buffer in _frame_buffers(data, self._max_size, compress):
+            if buffer:
+                self._views.append(memoryview(buffer))
+
+    def flush_to(self, dest: socket.socket) -> bool:
+        """
+        Transmet le plus possible de la file sans bloquer.
 
-    data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+        Retourne vrai si la file a été vidée. Lève une exception
+        GLOSocketError en cas de problème de communication.
+        """
+        while self._views:
+            try:
+                _send_some(dest, self._views)
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError as ex:
+                raise GLOSocketError("Cannot send data with socket") from ex
+        return True
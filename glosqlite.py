@@ -0,0 +1,493 @@
+"""\
+Module fournissant le stockage du serveur dans une base SQLite.
+
+Les comptes, les résumés des courriels et leurs corps sont dans une seule
+base (`SQLITE_FILENAME` du dossier de données) en mode WAL: les lectures ne
+bloquent pas les livraisons, et plusieurs processus serveurs peuvent
+partager la base. Chaque fil d'exécution a sa propre connexion.
+
+Le nombre de courriels et la taille de chaque boîte sont tenus à jour
+dans la table des utilisateurs, dans la transaction de la livraison qui
+vérifie le quota. Chaque courriel y reçoit son rang dans la boîte
+(`seq`, 1 pour le plus ancien): le courriel numéro n (1 pour le plus
+récent) est celui de rang `count - n + 1`, trouvé d'un seul accès à
+l'index (utilisateur, rang), et une page est un parcours de cet index.
+
+Comme dans le magasin de contenus du dossier de données, un corps n'est
+conservé qu'une fois (empreinte SHA-256), avec son nombre de références.
+
+L'index de recherche plein texte est la table `terms` (utilisateur, terme,
+courriel), complétée dans la transaction de chaque livraison. Les
+courriels livrés avant elle sont indexés à l'ouverture de la base.
+"""
+import codecs
+import contextlib
+import hashlib
+import json
+import pathlib
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Iterator, Optional
+
+import glosearch
+import glostorage
+import gloutils
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    quota_count INTEGER,
+    quota_size INTEGER,
+    count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS bodies (
+    key TEXT PRIMARY KEY,
+    content BLOB NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0,
+    touched REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS emails (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    received REAL NOT NULL,
+    sender TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    date TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    seq INTEGER
+);
+CREATE TABLE IF NOT EXISTS lost (
+    id INTEGER PRIMARY KEY,
+    address TEXT NOT NULL,
+    received REAL NOT NULL,
+    email TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    user TEXT NOT NULL,
+    term TEXT NOT NULL,
+    email INTEGER NOT NULL,
+    PRIMARY KEY (user, term, email)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Index des courriels par rang dans la boîte, créé après `_add_seq`.
+_SEQ_INDEX = ("CREATE UNIQUE INDEX IF NOT EXISTS emails_by_user_seq"
+              " ON emails (user, seq)")
+
+# Colonnes d'un résumé, dans l'ordre de `_record`.
+_RECORD_COLUMNS = "id, sender, destination, subject, date, size, body"
+
+# Taille des morceaux copiés vers un corps reçu par morceaux.
+_COPY_SIZE = 1024 * 1024
+
+
+def _record(row: tuple) -> glostorage.IndexRecord:
+    """Construit le résumé d'un courriel à partir d'une ligne de `emails`."""
+    identifiant, sender, destination, subject, date, size, body = row
+    return glostorage.IndexRecord(sender=sender,
+                                  subject=subject,
+                                  date=date,
+                                  size=size,
+                                  record=identifiant,
+                                  destination=json.loads(destination),
+                                  blob=body)
+
+
+def _body_prefix(connection: sqlite3.Connection, key: str) -> str:
+    """Lit la partie d'un corps que l'index de recherche retient."""
+    row = connection.execute("SELECT substr(content, 1, ?) FROM bodies"
+                             " WHERE key = ?",
+                             (glosearch.BODY_LIMIT, key)).fetchone()
+    if row is None:
+        return ""
+    return bytes(row[0]).decode("utf-8", errors="ignore")
+
+
+def _add_terms(connection: sqlite3.Connection, username: str, email: int,
+               terms: list[str]) -> None:
+    """Ajoute les termes d'un courriel à l'index de recherche."""
+    connection.executemany(
+        "INSERT OR IGNORE INTO terms (user, term, email) VALUES (?, ?, ?)",
+        [(username, term, email) for term in terms])
+
+
+def _set_indexed(connection: sqlite3.Connection, email: int) -> None:
+    """Retient le dernier courriel indexé."""
+    connection.execute(
+        "INSERT INTO meta (key, value) VALUES ('indexed', ?)"
+        " ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value)",
+        (email,))
+
+
+class SQLiteStorage(glostorage.Storage):
+    """Stockage du serveur dans la base SQLite `path`."""
+
+    def __init__(self, path: pathlib.Path,
+                 default_quota: glostorage.Quota = glostorage.NO_QUOTA,
+                 cache: Optional[glostorage.MessageCache] = None) -> None:
+        """
+        Ouvre la base `path`, créée au besoin avec son schéma.
+
+        `default_quota` est le quota des boîtes qui n'ont pas le leur
+        (colonnes `quota_count` et `quota_size`), et `cache` le cache des
+        courriels lus.
+        """
+        self._path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._default_quota = default_quota
+        self.cache = cache
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        self._add_seq()
+        self._index_missing()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Retourne la connexion du fil courant, ouverte au premier appel."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Transactions explicites (BEGIN) seulement.
+            connection = sqlite3.connect(self._path, timeout=30.0,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self, mode: str = "DEFERRED"
+                     ) -> Iterator[sqlite3.Connection]:
+        """
+        Exécute un bloc dans une transaction, validée à la fin ou annulée
+        si le bloc lève une exception. IMMEDIATE réserve l'écriture dès le
+        début.
+        """
+        connection = self._connection()
+        connection.execute(f"BEGIN {mode}")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _add_seq(self) -> None:
+        """
+        Ajoute le rang des courriels (`seq`) à une base créée sans lui, dans
+        l'ordre de réception, et remplace l'index par date de réception.
+        """
+        with self._transaction("IMMEDIATE") as connection:
+            colonnes = [row[1] for row in
+                        connection.execute("PRAGMA table_info(emails)")]
+            if "seq" not in colonnes:
+                connection.execute("ALTER TABLE emails ADD COLUMN seq INTEGER")
+            connection.execute(
+                "UPDATE emails SET seq = (SELECT rang FROM"
+                " (SELECT id, ROW_NUMBER() OVER (PARTITION BY user"
+                " ORDER BY received, id) AS rang FROM emails) AS r"
+                " WHERE r.id = emails.id) WHERE seq IS NULL")
+            connection.execute("DROP INDEX IF EXISTS emails_by_user_date")
+            connection.execute(_SEQ_INDEX)
+
+    def _index_missing(self) -> None:
+        """
+        Indexe les courriels dont l'identifiant dépasse celui du dernier
+        courriel indexé (`indexed` de la table `meta`).
+        """
+        with self._transaction("IMMEDIATE") as connection:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = 'indexed'").fetchone()
+            dernier = 0 if row is None else row[0]
+            for identifiant, user, subject, body in connection.execute(
+                    "SELECT id, user, subject, body FROM emails WHERE id > ?"
+                    " ORDER BY id", (dernier,)).fetchall():
+                _add_terms(connection, user, identifiant,
+                           glosearch.document_terms(
+                               subject, _body_prefix(connection, body)))
+                dernier = identifiant
+            _set_indexed(connection, dernier)
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def get_password(self, username: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT password FROM users WHERE name = ?", (username,)).fetchone()
+        return None if row is None else row[0]
+
+    def add_user(self, username: str, password: str) -> bool:
+        try:
+            with self._transaction("IMMEDIATE") as connection:
+                curseur = connection.execute(
+                    "INSERT OR IGNORE INTO users (name, password) VALUES (?, ?)",
+                    (username, password))
+        except sqlite3.Error as ex:
+            raise OSError(f"Base de données indisponible: {ex}") from ex
+        return curseur.rowcount == 1
+
+    def set_password(self, username: str, password: str) -> None:
+        with self._transaction("IMMEDIATE") as connection:
+            connection.execute("UPDATE users SET password = ? WHERE name = ?",
+                               (password, username))
+
+    def page(self, username: str, offset: int, limit: int
+             ) -> tuple[list[glostorage.IndexRecord], int]:
+        with self._transaction() as connection:
+            row = connection.execute("SELECT count FROM users WHERE name = ?",
+                                     (username,)).fetchone()
+            total = 0 if row is None else row[0]
+            rows = connection.execute(
+                f"SELECT {_RECORD_COLUMNS} FROM emails"
+                " WHERE user = ? AND seq <= ? ORDER BY seq DESC LIMIT ?",
+                (username, total - offset, limit)).fetchall()
+        return [_record(row) for row in rows], total
+
+    def get(self, username: str, number: int) -> glostorage.IndexRecord:
+        if number < 1:
+            raise IndexError(number)
+        row = self._connection().execute(
+            f"SELECT {_RECORD_COLUMNS} FROM emails WHERE user = ?"
+            " AND seq = (SELECT count FROM users WHERE name = ?) - ? + 1",
+            (username, username, number)).fetchone()
+        if row is None:
+            raise IndexError(number)
+        return _record(row)
+
+    def read(self, username: str, number: int) -> gloutils.EmailContentPayload:
+        record = self.get(username, number)
+        key = (username, f"#{record['record']}")
+        if self.cache is not None:
+            email = self.cache.get(key)
+            if email is not None:
+                return email
+        row = self._connection().execute(
+            "SELECT content FROM bodies WHERE key = ?",
+            (record["blob"],)).fetchone()
+        if row is None:
+            raise OSError(f"Corps de courriel absent: {record['blob']}")
+        email = gloutils.EmailContentPayload(
+            sender=record["sender"],
+            destination=record["destination"],
+            subject=record["subject"],
+            date=record["date"],
+            content=bytes(row[0]).decode("utf-8"))
+        if self.cache is not None:
+            self.cache.put(key, email, record["size"])
+        return email
+
+    def stream(self, username: str, number: int, chunk_size: int
+               ) -> tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Le corps est lu par morceaux avec substr(), chacun par la
+        connexion du fil qui poursuit l'itération.
+        """
+        record = self.get(username, number)
+        row = self._connection().execute(
+            "SELECT length(content) FROM bodies WHERE key = ?",
+            (record["blob"],)).fetchone()
+        if row is None:
+            raise OSError(f"Corps de courriel absent: {record['blob']}")
+        payload = gloutils.EmailContentPayload(
+            sender=record["sender"],
+            destination=record["destination"],
+            subject=record["subject"],
+            date=record["date"],
+            content="")
+        return payload, self._read_chunks(record["blob"], row[0], chunk_size)
+
+    def _read_chunks(self, key: str, length: int,
+                     chunk_size: int) -> Iterator[str]:
+        """Lit un corps UTF-8 par morceaux sans couper un caractère."""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for debut in range(0, length, chunk_size):
+            row = self._connection().execute(
+                "SELECT substr(content, ?, ?) FROM bodies WHERE key = ?",
+                (debut + 1, chunk_size, key)).fetchone()
+            text = decoder.decode(bytes(row[0]) if row else b"",
+                                  final=debut + chunk_size >= length)
+            if text:
+                yield text
+
+    def stats(self, username: str) -> gloutils.StatsPayload:
+        row = self._connection().execute(
+            "SELECT count, size FROM users WHERE name = ?",
+            (username,)).fetchone()
+        count, size = row if row is not None else (0, 0)
+        return gloutils.StatsPayload(count=count, size=size)
+
+    def _put_body(self, key: str, data: bytes) -> None:
+        """Ajoute un corps, ou le protège du ramasse-miettes s'il existe."""
+        with self._transaction("IMMEDIATE") as connection:
+            connection.execute(
+                "INSERT INTO bodies (key, content, touched) VALUES (?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET touched = excluded.touched",
+                (key, data, time.time()))
+
+    def store_email(self, payload: gloutils.EmailContentPayload
+                    ) -> glostorage.StoredEmail:
+        glostorage.check_email(payload)
+        content = payload["content"].encode("utf-8")
+        key = hashlib.sha256(content).hexdigest()
+        self._put_body(key, content)
+        return glostorage.make_stored_email(payload, key, len(content))
+
+    def body_writer(self) -> glostorage.BodyWriter:
+        return _BodyWriter(self)
+
+    def deliver(self, email: glostorage.StoredEmail, usernames: list[str],
+                content: Optional[str] = None) -> list[glostorage.Delivery]:
+        """
+        Toutes les livraisons, leurs termes, les courriels perdus et les
+        références au corps sont écrits dans une seule transaction.
+        """
+        resultats: list[glostorage.Delivery] = []
+        destination = json.dumps(email["destination"])
+        maintenant = time.time()
+        terms: Optional[list[str]] = None
+        with self._transaction("IMMEDIATE") as connection:
+            references = 0
+            for username in usernames:
+                row = connection.execute(
+                    "SELECT quota_count, quota_size, count, size FROM users"
+                    " WHERE name = ?", (username,)).fetchone()
+                if row is None:
+                    connection.execute(
+                        "INSERT INTO lost (address, received, email, body)"
+                        " VALUES (?, ?, ?, ?)",
+                        (f"{username}@{gloutils.SERVER_DOMAIN}", maintenant,
+                         json.dumps(email), email["blob"]))
+                    references += 1
+                    resultats.append(glostorage.Delivery.UNKNOWN)
+                    continue
+                quota_count, quota_size, count, size = row
+                if quota_count is None:
+                    quota_count = self._default_quota["count"]
+                if quota_size is None:
+                    quota_size = self._default_quota["size"]
+                if ((quota_count and count + 1 > quota_count)
+                        or (quota_size and size + email["size"] > quota_size)):
+                    resultats.append(glostorage.Delivery.FULL)
+                    continue
+                curseur = connection.execute(
+                    "INSERT INTO emails (user, received, sender, destination,"
+                    " subject, date, size, body, seq)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (username, maintenant, email["sender"], destination,
+                     email["subject"], email["date"], email["size"],
+                     email["blob"], count + 1))
+                if terms is None:
+                    if content is None:
+                        content = _body_prefix(connection, email["blob"])
+                    terms = glosearch.document_terms(email["subject"], content)
+                _add_terms(connection, username, curseur.lastrowid, terms)
+                _set_indexed(connection, curseur.lastrowid)
+                connection.execute(
+                    "UPDATE users SET count = count + 1, size = size + ?"
+                    " WHERE name = ?", (email["size"], username))
+                references += 1
+                resultats.append(glostorage.Delivery.DELIVERED)
+            if references:
+                connection.execute(
+                    "UPDATE bodies SET refs = refs + ? WHERE key = ?",
+                    (references, email["blob"]))
+        return resultats
+
+    def search(self, username: str, query: glosearch.Query
+               ) -> list[tuple[int, glostorage.IndexRecord]]:
+        """
+        Les courriels qui contiennent tous les termes sont l'intersection
+        de leurs lignes de `terms`; leur numéro dans la boîte se déduit de
+        leur rang.
+        """
+        requete = (f"SELECT {_RECORD_COLUMNS},"
+                   " (SELECT count FROM users WHERE name = ?) - seq + 1"
+                   " AS number FROM emails WHERE user = ?")
+        parametres = [username, username]
+        if query.terms:
+            requete += " AND id IN ({})".format(" INTERSECT ".join(
+                ["SELECT email FROM terms WHERE user = ? AND term = ?"]
+                * len(query.terms)))
+            for term in sorted(query.terms):
+                parametres += [username, term]
+        resultats: list[tuple[int, glostorage.IndexRecord]] = []
+        for row in self._connection().execute(requete + " ORDER BY number",
+                                              parametres):
+            record = _record(row[:-1])
+            if query.accepts(record):
+                resultats.append((row[-1], record))
+        return resultats
+
+    def collect_garbage(self, grace: float = 3600.0) -> int:
+        """
+        Les références étant comptées dans la transaction de chaque
+        livraison, seuls les corps jamais livrés sont supprimés.
+        """
+        with self._transaction("IMMEDIATE") as connection:
+            curseur = connection.execute(
+                "DELETE FROM bodies WHERE refs <= 0 AND touched < ?",
+                (time.time() - grace,))
+        return curseur.rowcount
+
+
+class _BodyWriter(glostorage.BodyWriter):
+    """
+    Corps reçu par morceaux dans un fichier temporaire, copié dans la base
+    par morceaux (blobopen) à la fin.
+    """
+
+    def __init__(self, storage: SQLiteStorage) -> None:
+        self._storage = storage
+        self._file = tempfile.TemporaryFile(dir=storage._path.parent)
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def commit(self) -> str:
+        key = self._hash.hexdigest()
+        try:
+            with self._storage._transaction("IMMEDIATE") as connection:
+                row = connection.execute(
+                    "SELECT rowid FROM bodies WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE bodies SET touched = ? WHERE rowid = ?",
+                        (time.time(), row[0]))
+                    return key
+                curseur = connection.execute(
+                    "INSERT INTO bodies (key, content, touched)"
+                    " VALUES (?, zeroblob(?), ?)", (key, self.size, time.time()))
+                self._file.seek(0)
+                with connection.blobopen("bodies", "content",
+                                         curseur.lastrowid) as blob:
+                    while data := self._file.read(_COPY_SIZE):
+                        blob.write(data)
+        finally:
+            self._file.close()
+        return key
+
+    def abort(self) -> None:
+        self._file.close()
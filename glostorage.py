@@ -0,0 +1,1516 @@
+"""\
+Module fournissant le stockage des boîtes de courriels du serveur.
+
+Chaque boîte possède un index (`INDEX_FILENAME`) contenant un résumé de
+chaque courriel dans l'ordre de livraison. L'index est complété à chaque
+livraison, ce qui évite de parcourir et de décoder tout le dossier pour
+lister ou retrouver un courriel.
+
+Le nombre de courriels et leur taille totale sont tenus à jour au même
+moment dans `STATS_FILENAME`, et peuvent être limités par un quota
+(`QUOTA_FILENAME` ou les valeurs par défaut du serveur).
+
+Plusieurs processus peuvent partager un même dossier de données: les
+livraisons se font sous un verrou de fichier (`LOCK_FILENAME`), les
+fichiers sont écrits puis renommés, et chaque processus relit la fin de
+l'index quand un autre l'a complété.
+
+Le corps des courriels est conservé une seule fois dans un magasin de
+contenus (`BlobStore`, dossier `SERVER_BLOBS_DIR`) où il est désigné par
+son empreinte SHA-256; les boîtes ne contiennent que des fiches
+(`StoredEmail`). Un courriel envoyé à plusieurs destinataires n'a qu'une
+fiche, écrite une fois (`spooled`) puis liée physiquement dans chaque
+boîte. Les anciens courriels complets restent lisibles.
+
+Les courriels lus peuvent être gardés décodés dans un cache commun aux
+boîtes (`MessageCache`), borné en octets.
+
+Une boîte peut aussi ranger ses fiches dans un journal de segments
+(`glosegment`, dossier `SEGMENTS_DIRNAME`) plutôt qu'un fichier par
+courriel. Une boîte existante y est convertie par `Mailbox.convert`,
+pendant que le serveur fonctionne.
+
+Chaque boîte a aussi son index de recherche plein texte (`glosearch`,
+fichier `SEARCH_FILENAME`), complété à chaque livraison.
+
+Le serveur n'accède à son stockage que par l'interface `Storage`, dont
+`DirectoryStorage` est l'implémentation dans le dossier de données décrite
+ci-dessus; `glosqlite` en fournit une autre, dans une base SQLite.
+"""
+import abc
+import codecs
+import collections
+import contextlib
+import enum
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import threading
+import time
+from typing import BinaryIO, Iterator, NotRequired, Optional, TypedDict, Union
+
+try:
+    import fcntl
+except ImportError:
+    # Plateformes sans fcntl (Windows): un seul processus serveur.
+    fcntl = None
+
+import glosearch
+import glosegment
+import gloutils
+
+# Fichiers d'un dossier utilisateur qui ne sont pas des courriels.
+RESERVED_FILENAMES = frozenset({gloutils.PASSWORD_FILENAME,
+                                gloutils.INDEX_FILENAME,
+                                gloutils.STATS_FILENAME,
+                                gloutils.QUOTA_FILENAME,
+                                gloutils.LOCK_FILENAME,
+                                gloutils.SEGMENTS_DIRNAME,
+                                gloutils.SEARCH_FILENAME})
+
+
+class StoredEmail(TypedDict, total=True):
+    """
+    Fiche d'un courriel dans une boîte: tout sauf le corps, désigné par
+    l'empreinte `blob` dans le magasin de contenus. `size` est la taille
+    du courriel complet.
+    """
+    sender: str
+    destination: Union[str, list[str]]
+    subject: str
+    date: str
+    size: int
+    blob: str
+
+
+class IndexRecord(TypedDict, total=True):
+    """
+    Résumé d'un courriel conservé dans l'index d'une boîte.
+
+    `destination` et `blob` sont absents pour les courriels écrits en
+    entier dans la boîte, avant le magasin de contenus. La fiche est soit
+    le fichier `file` de la boîte, soit l'enregistrement numéro `record`
+    de son journal de segments.
+    """
+    sender: str
+    subject: str
+    date: str
+    size: int
+    file: NotRequired[str]
+    record: NotRequired[int]
+    destination: NotRequired[Union[str, list[str]]]
+    blob: NotRequired[str]
+
+
+class Quota(TypedDict, total=True):
+    """Limites d'une boîte, 0 signifiant aucune limite."""
+    count: int
+    size: int
+
+
+NO_QUOTA = Quota(count=0, size=0)
+
+
+def write_atomic(path: pathlib.Path, data: bytes) -> None:
+    """
+    Remplace le contenu de `path` sans jamais le laisser à moitié écrit,
+    même si d'autres processus ou fils écrivent le même fichier.
+    """
+    temp = path.with_name(f".{path.name}.{os.getpid()}"
+                          f".{threading.get_ident()}.tmp")
+    try:
+        temp.write_bytes(data)
+        os.replace(temp, path)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+
+
+def link_or_write(source: Optional[pathlib.Path], path: pathlib.Path,
+                  data: bytes) -> None:
+    """
+    Remplace `path` par un lien physique vers `source`, qui contient déjà
+    `data`. Écrit `data` à la place s'il n'y a pas de source ou si le
+    système de fichiers ne permet pas les liens.
+    """
+    if source is not None:
+        temp = path.with_name(f".{path.name}.{os.getpid()}"
+                              f".{threading.get_ident()}.tmp")
+        try:
+            os.link(source, temp)
+            os.replace(temp, path)
+            return
+        except OSError:
+            temp.unlink(missing_ok=True)
+    write_atomic(path, data)
+
+
+def link_unique(source: Optional[pathlib.Path], directory: pathlib.Path,
+                base: str, data: bytes) -> pathlib.Path:
+    """
+    Ajoute à `directory` un lien physique vers `source`, qui contient déjà
+    `data`, nommé `base` ou, si ce nom est pris, `base-1`, `base-2`, etc.
+    Le lien échoue plutôt que de remplacer un fichier, même si d'autres
+    processus ou fils choisissent le même nom en même temps. Sans source
+    ou sans liens, `data` est écrit dans un fichier créé en exclusivité.
+
+    Retourne le chemin du fichier ajouté.
+    """
+    suffix = 0
+    while True:
+        path = directory / (f"{base}-{suffix}" if suffix else base)
+        try:
+            if source is not None:
+                try:
+                    os.link(source, path)
+                    return path
+                except FileExistsError:
+                    raise
+                except OSError:
+                    # Système de fichiers sans liens physiques.
+                    source = None
+            with path.open("xb") as fichier:
+                fichier.write(data)
+            return path
+        except FileExistsError:
+            suffix += 1
+
+
+# Caractères permis dans le nom d'une fiche de SERVER_LOST_DIR.
+_UNSAFE_NAME_RE = re.compile(r"[^\w ,:+@.-]")
+# Longueur maximale en octets d'un nom de fichier, avec de la marge pour
+# les noms temporaires de `write_atomic`.
+_NAME_MAX = 200
+
+
+def lost_name(date: str, username: str) -> str:
+    """
+    Retourne le nom de la fiche d'un courriel envoyé à l'utilisateur
+    inconnu `username` dans SERVER_LOST_DIR.
+
+    La date et le nom viennent du client: les caractères qui pourraient
+    désigner un autre dossier (dont "/") sont remplacés par "_", et un nom
+    caché ou trop long est remplacé par son empreinte.
+    """
+    nom = _UNSAFE_NAME_RE.sub("_", f"{date}{username}@{gloutils.SERVER_DOMAIN}")
+    if nom.startswith(".") or len(nom.encode("utf-8")) > _NAME_MAX:
+        nom = hashlib.sha256(nom.encode("utf-8")).hexdigest()
+    return nom
+
+
+@contextlib.contextmanager
+def spooled(directory: pathlib.Path, data: bytes) -> Iterator[pathlib.Path]:
+    """
+    Écrit `data` une seule fois dans un fichier temporaire de `directory`,
+    à lier dans chaque boîte avec `link_or_write`, et le supprime à la fin.
+    """
+    spool = directory / f".spool.{os.getpid()}.{threading.get_ident()}.tmp"
+    spool.write_bytes(data)
+    try:
+        yield spool
+    finally:
+        spool.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def _file_lock(path: pathlib.Path) -> Iterator[None]:
+    """Verrou exclusif entre processus sur le fichier `path`."""
+    with path.open("a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class QuotaExceededError(Exception):
+    """Erreur levée quand une livraison dépasserait le quota d'une boîte."""
+
+
+class BlobStore:
+    """
+    Magasin des corps de courriels, adressés par leur empreinte SHA-256.
+
+    Chaque contenu `<empreinte>` est rangé dans un sous-dossier nommé par
+    ses deux premiers caractères, avec à côté son compteur de références
+    (`<empreinte>.refs`). Le ramasse-miettes (`collect`) supprime les
+    contenus qui ne sont plus référencés.
+
+    Les compteurs sont modifiés sous un verrou de fichier commun aux
+    processus. Un contenu ajouté ou réutilisé par `put` est protégé du
+    ramasse-miettes pendant un délai de grâce, le temps que les fiches qui
+    le référencent soient écrites et comptées.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self._path = path
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._lock_path = path / gloutils.LOCK_FILENAME
+        self._lock = threading.Lock()
+
+    def _blob_path(self, key: str) -> pathlib.Path:
+        return self._path / key[:2] / key
+
+    def _refs_path(self, key: str) -> pathlib.Path:
+        return self._path / key[:2] / f"{key}.refs"
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Verrou du magasin entre fils et entre processus."""
+        with self._lock, _file_lock(self._lock_path):
+            yield
+
+    def put(self, data: bytes) -> str:
+        """
+        Ajoute un contenu, s'il n'est pas déjà présent, et retourne son
+        empreinte. Le contenu ne compte aucune référence de plus.
+        """
+        key = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(key)
+        with self._locked():
+            try:
+                # Contenu déjà présent: on le protège du ramasse-miettes.
+                os.utime(path)
+                return key
+            except FileNotFoundError:
+                pass
+        path.parent.mkdir(exist_ok=True)
+        write_atomic(path, data)
+        return key
+
+    def writer(self) -> "BlobWriter":
+        """Retourne un BlobWriter pour ajouter un contenu par morceaux."""
+        return BlobWriter(self)
+
+    def _adopt(self, temp: pathlib.Path, key: str) -> None:
+        """Range le fichier temporaire `temp` sous l'empreinte `key`."""
+        path = self._blob_path(key)
+        with self._locked():
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                path.parent.mkdir(exist_ok=True)
+                os.replace(temp, path)
+                return
+        # Contenu déjà présent.
+        temp.unlink()
+
+    def read(self, key: str) -> bytes:
+        """Lit le contenu d'empreinte `key`."""
+        return self._blob_path(key).read_bytes()
+
+    def open(self, key: str) -> BinaryIO:
+        """Ouvre le contenu d'empreinte `key` en lecture."""
+        return self._blob_path(key).open("rb")
+
+    def _read_refs(self, key: str) -> int:
+        try:
+            return int(self._refs_path(key).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return 0
+
+    def refs(self, key: str) -> int:
+        """Retourne le nombre de références du contenu `key`."""
+        with self._locked():
+            return self._read_refs(key)
+
+    def add_refs(self, key: str, count: int) -> None:
+        """Ajoute `count` références au contenu `key`."""
+        with self._locked():
+            write_atomic(self._refs_path(key),
+                         str(self._read_refs(key) + count).encode("utf-8"))
+
+    def keys(self) -> list[str]:
+        """Retourne les empreintes de tous les contenus."""
+        return [blob.name for blob in self._path.glob("??/*")
+                if not blob.name.endswith(".refs")
+                and not blob.name.startswith(".")]
+
+    def recount(self, references: dict[str, int]) -> None:
+        """
+        Remplace les compteurs par les références réellement trouvées dans
+        les boîtes (`references`), pour corriger une dérive.
+        """
+        with self._locked():
+            for key in self.keys():
+                if references.get(key, 0) != self._read_refs(key):
+                    write_atomic(self._refs_path(key), str(
+                        references.get(key, 0)).encode("utf-8"))
+
+    def collect(self, grace: float = 3600.0) -> int:
+        """
+        Supprime les contenus sans référence qui n'ont pas été ajoutés ou
+        réutilisés depuis `grace` secondes, et retourne leur nombre.
+        """
+        count = 0
+        limite = time.time() - grace
+        with self._locked():
+            for key in self.keys():
+                path = self._blob_path(key)
+                try:
+                    if (self._read_refs(key) > 0
+                            or path.stat().st_mtime > limite):
+                        continue
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                self._refs_path(key).unlink(missing_ok=True)
+                count += 1
+        return count
+
+
+class BodyWriter(abc.ABC):
+    """
+    Corps de courriel reçu par morceaux et ajouté au stockage à la fin;
+    `size` est le nombre d'octets déjà écrits.
+    """
+    size: int
+
+    @abc.abstractmethod
+    def write(self, data: bytes) -> None:
+        """Ajoute un morceau à la fin du corps."""
+
+    @abc.abstractmethod
+    def commit(self) -> str:
+        """Range le corps dans le stockage et retourne son empreinte."""
+
+    @abc.abstractmethod
+    def abort(self) -> None:
+        """Abandonne le corps."""
+
+
+class BlobWriter(BodyWriter):
+    """
+    Contenu ajouté au magasin par morceaux: écrit dans un fichier
+    temporaire du magasin, puis rangé sous son empreinte par `commit`.
+    """
+
+    def __init__(self, store: BlobStore) -> None:
+        self._store = store
+        self._temp = store._path / (f".upload.{os.getpid()}"
+                                    f".{threading.get_ident()}.{id(self)}.tmp")
+        self._file = self._temp.open("wb")
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        """Ajoute un morceau à la fin du contenu."""
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def commit(self) -> str:
+        """Range le contenu dans le magasin et retourne son empreinte."""
+        self._file.close()
+        key = self._hash.hexdigest()
+        try:
+            self._store._adopt(self._temp, key)
+        except BaseException:
+            self._temp.unlink(missing_ok=True)
+            raise
+        return key
+
+    def abort(self) -> None:
+        """Abandonne le contenu et supprime le fichier temporaire."""
+        self._file.close()
+        self._temp.unlink(missing_ok=True)
+
+
+class MessageCache:
+    """
+    Cache LRU des courriels décodés, commun à toutes les boîtes.
+
+    Un courriel y est désigné par sa boîte et le nom de sa fiche, qui ne
+    change pas quand d'autres courriels sont livrés (contrairement à son
+    numéro). La taille de chaque courriel est celle de son entrée d'index,
+    et le total est limité à `max_bytes`: les courriels les moins
+    récemment lus sont évincés au besoin. Un `max_bytes` nul désactive le
+    cache.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[
+            tuple[str, str], tuple[gloutils.EmailContentPayload, int]
+        ] = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: tuple[str, str]
+            ) -> Optional[gloutils.EmailContentPayload]:
+        """Retourne une copie du courriel `key`, ou None s'il est absent."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return gloutils.EmailContentPayload(**entry[0])
+
+    def put(self, key: tuple[str, str],
+            email: gloutils.EmailContentPayload, size: int) -> None:
+        """
+        Ajoute le courriel `key`, de `size` octets, en évinçant les moins
+        récemment lus. Un courriel plus gros que le cache n'est pas gardé.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            ancien = self._entries.pop(key, None)
+            if ancien is not None:
+                self.size -= ancien[1]
+            self._entries[key] = (gloutils.EmailContentPayload(**email), size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, taille) = self._entries.popitem(last=False)
+                self.size -= taille
+                self.evictions += 1
+
+    def discard(self, key: tuple[str, str]) -> None:
+        """Retire le courriel `key` s'il est présent."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def invalidate(self, mailbox: str) -> None:
+        """Retire tous les courriels de la boîte `mailbox`."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == mailbox]:
+                self.size -= self._entries.pop(key)[1]
+
+    def stats(self) -> dict[str, int]:
+        """Retourne les compteurs du cache."""
+        with self._lock:
+            return {"entries": len(self._entries), "size": self.size,
+                    "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+def make_stored_email(payload: gloutils.EmailContentPayload, blob: str,
+                      content_size: int) -> StoredEmail:
+    """
+    Construit la fiche d'un courriel dont le corps, de `content_size`
+    octets, est le contenu `blob` du magasin.
+
+    La taille du courriel est celle de ses champs en JSON plus celle du
+    corps, sans jamais encoder le corps lui-même.
+    """
+    entete = {key: value for key, value in payload.items()
+              if key not in ("content", "chunked")}
+    return StoredEmail(sender=payload["sender"],
+                       destination=payload["destination"],
+                       subject=payload["subject"],
+                       date=payload["date"],
+                       size=len(json.dumps(entete).encode("utf-8")) + content_size,
+                       blob=blob)
+
+
+def check_email(payload: gloutils.EmailContentPayload) -> None:
+    """
+    Vérifie les champs d'un courriel avant que quoi que ce soit ne soit
+    rangé: lève ValueError si l'un d'eux n'est pas du texte.
+    """
+    for key in ("sender", "subject", "date", "content"):
+        if not isinstance(payload.get(key), str):
+            raise ValueError(f"Le champ {key} du courriel est invalide")
+    destination = payload.get("destination")
+    if not isinstance(destination, str) and (
+            not isinstance(destination, list)
+            or not all(isinstance(adresse, str) for adresse in destination)):
+        raise ValueError("Le champ destination du courriel est invalide")
+
+
+def store_email(payload: gloutils.EmailContentPayload,
+                blobs: BlobStore) -> StoredEmail:
+    """
+    Place le corps du courriel dans le magasin et retourne sa fiche.
+
+    Lève ValueError, sans rien écrire, si le courriel est invalide
+    (`check_email`).
+    """
+    check_email(payload)
+    content = payload["content"].encode("utf-8")
+    return make_stored_email(payload, blobs.put(content), len(content))
+
+
+def _make_record(email: Union[StoredEmail, gloutils.EmailContentPayload],
+                 filename: Optional[str], size: int,
+                 position: Optional[int] = None) -> IndexRecord:
+    """
+    Construit l'entrée d'index d'un courriel, fiche ou courriel complet,
+    écrit dans le fichier `filename` ou à la position `position` du
+    journal de segments.
+    """
+    record = IndexRecord(sender=email["sender"],
+                         subject=email["subject"],
+                         date=email["date"],
+                         size=size)
+    if filename is not None:
+        record["file"] = filename
+    if position is not None:
+        record["record"] = position
+    if "blob" in email:
+        record["destination"] = email["destination"]
+        record["blob"] = email["blob"]
+    return record
+
+
+class Mailbox:
+    """
+    Boîte de courriels d'un utilisateur.
+
+    Les entrées de l'index sont gardées en mémoire du plus ancien au plus
+    récent; le courriel numéro 1 est le plus récent, comme dans l'affichage
+    `SUBJECT_DISPLAY`.
+
+    Les fiches sont des fichiers de la boîte ou, si elle a un dossier
+    `SEGMENTS_DIRNAME`, les enregistrements de son journal de segments.
+
+    Les méthodes peuvent être appelées depuis plusieurs fils d'exécution,
+    et d'autres processus peuvent livrer dans la même boîte.
+    """
+
+    def __init__(self, path: pathlib.Path,
+                 default_quota: Quota = NO_QUOTA,
+                 blobs: Optional[BlobStore] = None,
+                 cache: Optional[MessageCache] = None,
+                 segmented: bool = False) -> None:
+        """
+        Charge l'index, les statistiques et le quota de la boîte située
+        dans `path`.
+
+        Si l'index n'existe pas (dossier créé avant l'index), il est
+        reconstruit à partir des fichiers présents. Le quota propre à
+        l'utilisateur, s'il existe, remplace `default_quota`. `blobs` est
+        le magasin des corps, par défaut celui du dossier de données, et
+        `cache` le cache des courriels lus, s'il y en a un. Une boîte vide
+        est créée avec un journal de segments si `segmented` est vrai.
+        """
+        self._path = path
+        self._blobs = blobs or BlobStore(path.parent / gloutils.SERVER_BLOBS_DIR)
+        self._cache = cache
+        self._index_path = path / gloutils.INDEX_FILENAME
+        self._stats_path = path / gloutils.STATS_FILENAME
+        self._lock_path = path / gloutils.LOCK_FILENAME
+        self._lock = threading.Lock()
+        self._records: list[IndexRecord] = []
+        # Partie de l'index déjà lue, pour ne relire que ce qu'un autre
+        # processus y a ajouté.
+        self._index_offset = 0
+        self._index_inode = 0
+        self._segments: Optional[glosegment.SegmentLog] = None
+        self._search = glosearch.SearchIndex(path / gloutils.SEARCH_FILENAME)
+        self.count = 0
+        self.size = 0
+        with self._file_lock():
+            if self._index_path.exists():
+                self._load()
+            else:
+                self._open_segments()
+                self._rebuild()
+            if segmented and self._segments is None and not self._records:
+                self._segments = glosegment.SegmentLog(
+                    path / gloutils.SEGMENTS_DIRNAME, create=True)
+        self.quota = self._load_quota(default_quota)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._records)
+
+    def _file_lock(self) -> contextlib.AbstractContextManager:
+        """Verrou de la boîte entre processus."""
+        return _file_lock(self._lock_path)
+
+    def _open_segments(self) -> None:
+        """Ouvre le journal de segments de la boîte, s'il existe."""
+        if self._segments is None:
+            try:
+                self._segments = glosegment.SegmentLog(
+                    self._path / gloutils.SEGMENTS_DIRNAME)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def segmented(self) -> bool:
+        """Vrai si les fiches sont rangées dans un journal de segments."""
+        return self._segments is not None
+
+    def _read_index(self, offset: int) -> list[IndexRecord]:
+        """
+        Lit les entrées complètes de l'index à partir de `offset` et
+        avance `_index_offset` jusqu'à la fin de la dernière.
+        """
+        with self._index_path.open("rb") as index:
+            self._index_inode = os.fstat(index.fileno()).st_ino
+            index.seek(offset)
+            data = index.read()
+        end = data.rfind(b"\n") + 1
+        self._index_offset = offset + end
+        return [json.loads(line) for line in data[:end].splitlines()
+                if line.strip()]
+
+    def _load(self) -> None:
+        """
+        Lit l'index, une entrée JSON par ligne, puis les statistiques.
+
+        Appelée sous le verrou de fichier, pour que les deux concordent.
+        Un index relu a pu être reconstruit: les courriels de la boîte
+        sont retirés du cache.
+        """
+        if self._cache is not None:
+            self._cache.invalidate(self._path.name)
+        # La boîte a pu être convertie par un autre processus.
+        self._open_segments()
+        self._records = self._read_index(0)
+        try:
+            stats = json.loads(self._stats_path.read_text(encoding="utf-8"))
+            self.count, self.size = stats["count"], stats["size"]
+        except (OSError, ValueError, KeyError):
+            # Statistiques absentes ou corrompues: on les déduit de l'index.
+            self.count = len(self._records)
+            self.size = sum(record["size"] for record in self._records)
+            self._save_stats()
+
+    def _refresh(self, locked: bool = False) -> None:
+        """
+        Prend en compte les livraisons faites par d'autres processus.
+
+        Un seul stat() suffit quand l'index n'a pas changé; sinon seules
+        les nouvelles entrées sont lues. Un index remplacé (reconstruit)
+        est relu en entier, sous le verrou de fichier sauf si l'appelant
+        (`locked`) le détient déjà.
+        """
+        try:
+            info = os.stat(self._index_path)
+        except FileNotFoundError:
+            return
+        if info.st_ino != self._index_inode or info.st_size < self._index_offset:
+            if locked:
+                self._load()
+            else:
+                with self._file_lock():
+                    self._load()
+        elif info.st_size > self._index_offset:
+            for record in self._read_index(self._index_offset):
+                self._records.append(record)
+                self.count += 1
+                self.size += record["size"]
+
+    def _load_quota(self, default_quota: Quota) -> Quota:
+        """Lit le quota de l'utilisateur, sinon retourne celui par défaut."""
+        try:
+            quota = json.loads((self._path / gloutils.QUOTA_FILENAME)
+                               .read_text(encoding="utf-8"))
+            return Quota(count=int(quota.get("count", default_quota["count"])),
+                         size=int(quota.get("size", default_quota["size"])))
+        except (OSError, ValueError, TypeError, AttributeError):
+            return default_quota
+
+    def _save_stats(self) -> None:
+        """Écrit les statistiques à côté de l'index."""
+        write_atomic(self._stats_path, json.dumps(
+            {"count": self.count, "size": self.size}).encode("utf-8"))
+
+    def stats(self) -> gloutils.StatsPayload:
+        """Retourne les statistiques tenues à jour, sans parcourir le dossier."""
+        with self._lock:
+            self._refresh()
+            return gloutils.StatsPayload(count=self.count, size=self.size)
+
+    def can_accept(self, size: int) -> bool:
+        """Indique si un courriel de `size` octets respecte le quota."""
+        if self.quota["count"] and self.count + 1 > self.quota["count"]:
+            return False
+        if self.quota["size"] and self.size + size > self.quota["size"]:
+            return False
+        return True
+
+    def rebuild(self) -> None:
+        """
+        Reconstruit l'index à partir des courriels du dossier.
+
+        Les courriels sont ordonnés par date de modification, comme le
+        faisait le serveur avant l'introduction de l'index. Les fichiers
+        illisibles sont ignorés.
+        """
+        with self._lock, self._file_lock():
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        """Reconstruit l'index, verrous déjà acquis."""
+        if self._cache is not None:
+            self._cache.invalidate(self._path.name)
+        # L'ordre des courriels peut changer: ils seront indexés de nouveau.
+        self._search.reset()
+        records: list[IndexRecord] = []
+        if self._segments is not None:
+            # Les fichiers qui restent d'une conversion interrompue sont
+            # déjà dans le journal.
+            for position in range(len(self._segments)):
+                try:
+                    fiche = json.loads(self._segments.read(position))
+                    records.append(_make_record(fiche, None, fiche["size"],
+                                                position))
+                except (ValueError, KeyError):
+                    continue
+        else:
+            emails = [fichier for fichier in self._path.iterdir()
+                      if fichier.name not in RESERVED_FILENAMES
+                      and not fichier.name.startswith(".")]
+            for email in sorted(emails, key=os.path.getmtime):
+                try:
+                    fiche = json.loads(email.read_text(encoding="utf-8"))
+                    records.append(_make_record(
+                        fiche, email.name,
+                        fiche["size"] if "blob" in fiche else email.stat().st_size))
+                except (OSError, ValueError, KeyError):
+                    continue
+        write_atomic(self._index_path, "".join(
+            json.dumps(record) + "\n" for record in records).encode("utf-8"))
+        self._records = records
+        self._index_offset = self._index_path.stat().st_size
+        self._index_inode = self._index_path.stat().st_ino
+        self.count = len(records)
+        self.size = sum(record["size"] for record in records)
+        self._save_stats()
+
+    def get(self, number: int) -> IndexRecord:
+        """
+        Retourne l'entrée du courriel `number` (1 = le plus récent).
+
+        Lève IndexError si le numéro est hors de la boîte.
+        """
+        with self._lock:
+            self._refresh()
+            if not 1 <= number <= len(self._records):
+                raise IndexError(number)
+            return self._records[len(self._records) - number]
+
+    def newest_first(self) -> list[IndexRecord]:
+        """Retourne les entrées du plus récent au plus ancien."""
+        with self._lock:
+            self._refresh()
+            return self._records[::-1]
+
+    def page(self, offset: int, limit: int) -> tuple[list[IndexRecord], int]:
+        """
+        Retourne au plus `limit` entrées, du plus récent au plus ancien, en
+        sautant les `offset` plus récentes, ainsi que le nombre total de
+        courriels. Seules les entrées de la page sont copiées.
+        """
+        with self._lock:
+            self._refresh()
+            total = len(self._records)
+            fin = max(0, total - offset)
+            debut = max(0, fin - limit)
+            return self._records[debut:fin][::-1], total
+
+    def read(self, number: int) -> gloutils.EmailContentPayload:
+        """
+        Lit le courriel `number` (1 = le plus récent), en joignant le corps
+        conservé dans le magasin à son entrée d'index.
+
+        Le courriel est d'abord cherché dans le cache, où il est ajouté
+        après la lecture. La fiche d'une boîte à segments est lue
+        directement dans la projection mémoire de son segment.
+        """
+        record = self.get(number)
+        key = (self._path.name, _record_key(record))
+        if self._cache is not None:
+            email = self._cache.get(key)
+            if email is not None:
+                return email
+        if "record" in record:
+            fiche = json.loads(self._segments.read(record["record"]))
+            email = gloutils.EmailContentPayload(
+                sender=fiche["sender"],
+                destination=fiche["destination"],
+                subject=fiche["subject"],
+                date=fiche["date"],
+                content=self._blobs.read(fiche["blob"]).decode("utf-8"))
+        elif "blob" not in record:
+            email = json.loads((self._path / record["file"]).read_text(
+                encoding="utf-8"))
+        else:
+            email = gloutils.EmailContentPayload(
+                sender=record["sender"],
+                destination=record["destination"],
+                subject=record["subject"],
+                date=record["date"],
+                content=self._blobs.read(record["blob"]).decode("utf-8"))
+        if self._cache is not None:
+            self._cache.put(key, email, record["size"])
+        return email
+
+    def stream(self, number: int, chunk_size: int
+               ) -> tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Retourne le courriel `number` sans son corps (`content` vide) et un
+        itérateur sur le corps, lu par morceaux d'au plus `chunk_size`
+        octets au fil de l'itération.
+
+        Le contenu est ouvert dès l'appel: une erreur de lecture est levée
+        ici plutôt qu'au cours de l'itération.
+        """
+        record = self.get(number)
+        if "blob" not in record:
+            payload = self.read(number)
+            content, payload["content"] = payload["content"], ""
+            return payload, (content[start:start + chunk_size]
+                             for start in range(0, len(content), chunk_size))
+        payload = gloutils.EmailContentPayload(
+            sender=record["sender"],
+            destination=record["destination"],
+            subject=record["subject"],
+            date=record["date"],
+            content="")
+        return payload, _read_chunks(self._blobs.open(record["blob"]),
+                                     chunk_size)
+
+    def _unique_filename(self, base: str) -> str:
+        """Évite d'écraser un courriel portant déjà le même nom."""
+        filename = base
+        suffix = 0
+        while filename in RESERVED_FILENAMES or (self._path / filename).exists():
+            suffix += 1
+            filename = f"{base}-{suffix}"
+        return filename
+
+    def deliver(self, email: StoredEmail,
+                data: Optional[bytes] = None,
+                source: Optional[pathlib.Path] = None,
+                terms: Optional[list[str]] = None) -> IndexRecord:
+        """
+        Écrit la fiche du courriel dans la boîte et l'ajoute à l'index.
+
+        Le corps doit déjà être dans le magasin (`store_email`), et c'est à
+        l'appelant d'en compter la référence. `data` est la fiche déjà
+        encodée, et `source` un fichier qui la contient et qui est lié dans
+        la boîte plutôt que réécrit (envoi à plusieurs destinataires). Dans
+        une boîte à segments, la fiche est ajoutée au journal.
+
+        `terms` sont les termes du courriel (`glosearch.document_terms`),
+        ajoutés à l'index de recherche; sans eux, le courriel sera indexé à
+        la prochaine recherche.
+
+        Lève QuotaExceededError, avant toute écriture, si le courriel
+        dépasse le quota de la boîte.
+        """
+        if data is None:
+            data = json.dumps(email).encode("utf-8")
+        with self._lock, self._file_lock():
+            self._refresh(locked=True)
+            if not self.can_accept(email["size"]):
+                raise QuotaExceededError(self._path.name)
+            if self._segments is not None:
+                record = _make_record(email, None, email["size"],
+                                      self._segments.append(data))
+            else:
+                filename = self._unique_filename(email["date"] + email["sender"])
+                if self._cache is not None:
+                    # Un courriel de ce nom a pu être retiré du dossier.
+                    self._cache.discard((self._path.name, filename))
+                link_or_write(source, self._path / filename, data)
+                record = _make_record(email, filename, email["size"])
+            line = (json.dumps(record) + "\n").encode("utf-8")
+            with self._index_path.open("ab") as index:
+                index.write(line)
+            self._index_offset += len(line)
+            if terms is not None:
+                self._search.append(len(self._records), terms)
+            self._records.append(record)
+            self.count += 1
+            self.size += email["size"]
+            self._save_stats()
+        return record
+
+    def search(self, query: glosearch.Query) -> list[tuple[int, IndexRecord]]:
+        """
+        Retourne le numéro et l'entrée de chaque courriel qui répond à la
+        recherche, du plus récent au plus ancien.
+
+        Seuls les courriels absents de l'index de recherche (livrés avant
+        lui) sont lus, une fois, pour l'y ajouter.
+        """
+        with self._lock:
+            self._refresh()
+            self._search.refresh()
+            if len(self._search) < len(self._records):
+                with self._file_lock():
+                    self._refresh(locked=True)
+                    self._index_missing()
+            documents = self._search.lookup(query.terms)
+            total = len(self._records)
+            if documents is None:
+                positions = range(total - 1, -1, -1)
+            else:
+                positions = sorted((position for position in documents
+                                    if position < total), reverse=True)
+            return [(total - position, self._records[position])
+                    for position in positions
+                    if query.accepts(self._records[position])]
+
+    def _index_missing(self) -> None:
+        """
+        Ajoute à l'index de recherche les courriels qui n'y sont pas,
+        verrous déjà acquis.
+        """
+        self._search.refresh()
+        for position, record in enumerate(self._records):
+            if position in self._search:
+                continue
+            try:
+                if "blob" in record:
+                    body = _body_prefix(self._blobs, record["blob"])
+                else:
+                    body = json.loads((self._path / record["file"]).read_text(
+                        encoding="utf-8"))["content"]
+            except (OSError, ValueError, KeyError):
+                # Corps illisible: seul le sujet est indexé.
+                body = ""
+            self._search.append(position,
+                                glosearch.document_terms(record["subject"], body))
+        self._search.refresh()
+
+    def convert(self) -> bool:
+        """
+        Convertit la boîte au journal de segments, pendant que d'autres
+        fils ou processus peuvent s'en servir.
+
+        Les fiches sont copiées dans un journal temporaire, qui prend la
+        place du dossier `SEGMENTS_DIRNAME`, puis l'index est remplacé et
+        les fichiers supprimés. Un ancien courriel complet est d'abord
+        placé dans le magasin de contenus. Retourne faux si la boîte était
+        déjà convertie.
+        """
+        with self._lock, self._file_lock():
+            self._refresh(locked=True)
+            if self._segments is not None:
+                return False
+            temp = self._path / f".{gloutils.SEGMENTS_DIRNAME}.tmp"
+            shutil.rmtree(temp, ignore_errors=True)
+            log = glosegment.SegmentLog(temp, create=True)
+            records: list[IndexRecord] = []
+            try:
+                for record in self._records:
+                    fiche = json.loads((self._path / record["file"]).read_text(
+                        encoding="utf-8"))
+                    if "blob" not in fiche:
+                        content = fiche["content"].encode("utf-8")
+                        fiche = make_stored_email(
+                            fiche, self._blobs.put(content), len(content))
+                        # Taille d'origine, pour garder les statistiques.
+                        fiche["size"] = record["size"]
+                        self._blobs.add_refs(fiche["blob"], 1)
+                    records.append(_make_record(
+                        fiche, None, record["size"],
+                        log.append(json.dumps(fiche).encode("utf-8"))))
+            except BaseException:
+                log.close()
+                shutil.rmtree(temp, ignore_errors=True)
+                raise
+            log.close()
+            os.replace(temp, self._path / gloutils.SEGMENTS_DIRNAME)
+            self._open_segments()
+            write_atomic(self._index_path, "".join(
+                json.dumps(record) + "\n" for record in records).encode("utf-8"))
+            anciens, self._records = self._records, records
+            self._index_offset = self._index_path.stat().st_size
+            self._index_inode = self._index_path.stat().st_ino
+            if self._cache is not None:
+                self._cache.invalidate(self._path.name)
+            for record in anciens:
+                (self._path / record["file"]).unlink(missing_ok=True)
+        return True
+
+    def compact(self) -> int:
+        """
+        Compacte le journal de segments de la boîte et retourne le nombre
+        d'octets libérés (0 pour une boîte sans journal).
+        """
+        with self._lock, self._file_lock():
+            if self._segments is None:
+                return 0
+            return self._segments.compact()
+
+
+def _record_key(record: IndexRecord) -> str:
+    """Identifiant stable de la fiche d'un courriel dans sa boîte."""
+    if "record" in record:
+        return f"#{record['record']}"
+    return record["file"]
+
+
+def _body_prefix(blobs: BlobStore, key: str) -> str:
+    """Lit la partie d'un corps du magasin que l'index de recherche retient."""
+    with blobs.open(key) as corps:
+        return corps.read(glosearch.BODY_LIMIT).decode("utf-8", errors="ignore")
+
+
+def _read_chunks(file: BinaryIO, chunk_size: int) -> Iterator[str]:
+    """
+    Lit un fichier UTF-8 par morceaux sans couper un caractère, puis le
+    ferme.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with file:
+        while True:
+            data = file.read(chunk_size)
+            text = decoder.decode(data, final=not data)
+            if text:
+                yield text
+            if not data:
+                return
+
+
+class Delivery(enum.IntEnum):
+    """Résultat de la livraison d'un courriel à un destinataire."""
+    DELIVERED = 0
+    # Destinataire inconnu: le courriel est placé dans SERVER_LOST_DIR.
+    UNKNOWN = enum.auto()
+    # Boîte pleine: le courriel n'est pas écrit.
+    FULL = enum.auto()
+
+
+class Storage(abc.ABC):
+    """
+    Stockage du serveur: comptes, boîtes de courriels et corps.
+
+    Une boîte est désignée par le nom de son utilisateur et un courriel par
+    son numéro dans la boîte (1 = le plus récent). Les méthodes peuvent
+    être appelées depuis plusieurs fils d'exécution. `cache` est le cache
+    des courriels lus, s'il y en a un.
+    """
+    cache: Optional[MessageCache] = None
+
+    @abc.abstractmethod
+    def get_password(self, username: str) -> Optional[str]:
+        """
+        Retourne l'empreinte du mot de passe de l'utilisateur, ou None
+        s'il n'existe pas.
+        """
+
+    def reload_password(self, username: str) -> Optional[str]:
+        """
+        Relit l'empreinte du mot de passe, qu'un autre processus a pu
+        changer.
+        """
+        return self.get_password(username)
+
+    @abc.abstractmethod
+    def add_user(self, username: str, password: str) -> bool:
+        """
+        Crée le compte et sa boîte vide avec l'empreinte `password`.
+
+        Retourne faux si l'utilisateur existe déjà; lève OSError si le
+        compte n'a pas pu être créé.
+        """
+
+    @abc.abstractmethod
+    def set_password(self, username: str, password: str) -> None:
+        """Remplace l'empreinte du mot de passe de l'utilisateur."""
+
+    def load_mailbox(self, username: str) -> None:
+        """Prépare la boîte d'un utilisateur qui vient de se connecter."""
+
+    @abc.abstractmethod
+    def page(self, username: str, offset: int, limit: int
+             ) -> tuple[list[IndexRecord], int]:
+        """
+        Retourne au plus `limit` résumés, du plus récent au plus ancien,
+        en sautant les `offset` plus récents, ainsi que le nombre total de
+        courriels de la boîte.
+        """
+
+    @abc.abstractmethod
+    def get(self, username: str, number: int) -> IndexRecord:
+        """
+        Retourne le résumé du courriel `number`.
+
+        Lève IndexError si le numéro est hors de la boîte.
+        """
+
+    @abc.abstractmethod
+    def read(self, username: str, number: int) -> gloutils.EmailContentPayload:
+        """Lit le courriel `number`; lève IndexError comme `get`."""
+
+    @abc.abstractmethod
+    def stream(self, username: str, number: int, chunk_size: int
+               ) -> tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        """
+        Retourne le courriel `number` sans son corps (`content` vide) et un
+        itérateur sur le corps, lu par morceaux d'au plus `chunk_size`
+        octets au fil de l'itération.
+        """
+
+    @abc.abstractmethod
+    def stats(self, username: str) -> gloutils.StatsPayload:
+        """Retourne le nombre de courriels et la taille de la boîte."""
+
+    @abc.abstractmethod
+    def store_email(self, payload: gloutils.EmailContentPayload) -> StoredEmail:
+        """
+        Range le corps du courriel et retourne sa fiche.
+
+        Lève ValueError, sans rien ranger, si un champ du courriel est
+        invalide (`check_email`).
+        """
+
+    @abc.abstractmethod
+    def body_writer(self) -> BodyWriter:
+        """Retourne un BodyWriter pour recevoir un corps par morceaux."""
+
+    @abc.abstractmethod
+    def deliver(self, email: StoredEmail, usernames: list[str],
+                content: Optional[str] = None) -> list[Delivery]:
+        """
+        Livre le courriel, dont le corps est déjà rangé, à chaque
+        utilisateur et retourne le résultat de chacun, dans le même ordre.
+
+        Le courriel est ajouté à l'index de recherche de chaque boîte.
+        `content` est son corps s'il est en mémoire; sinon, le début du
+        corps rangé est relu.
+        """
+
+    @abc.abstractmethod
+    def search(self, username: str, query: glosearch.Query
+               ) -> list[tuple[int, IndexRecord]]:
+        """
+        Retourne le numéro et le résumé de chaque courriel de la boîte qui
+        répond à la recherche, du plus récent au plus ancien, à partir de
+        l'index de recherche et sans lire les courriels.
+        """
+
+    @abc.abstractmethod
+    def collect_garbage(self, grace: float = 3600.0) -> int:
+        """
+        Supprime les corps qui ne sont plus référencés depuis au moins
+        `grace` secondes et retourne leur nombre.
+        """
+
+    def close(self) -> None:
+        """Libère les ressources du stockage."""
+
+
+class UserDirectory:
+    """
+    Annuaire en mémoire des utilisateurs du dossier de données et de leur
+    empreinte, conservée dans le fichier `PASSWORD_FILENAME` de chacun.
+
+    Chargé au démarrage à partir des dossiers de `data_dir`, puis tenu à
+    jour à chaque création de compte et changement d'empreinte. Un
+    utilisateur inconnu est cherché sur le disque, au cas où un autre
+    processus serveur l'aurait créé.
+    """
+
+    def __init__(self, data_dir: pathlib.Path) -> None:
+        self._data_dir = data_dir
+        self._lock = threading.Lock()
+        self._users: dict[str, str] = {}
+        if data_dir.is_dir():
+            for user_dir in data_dir.iterdir():
+                self._read(user_dir.name)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._users)
+
+    @staticmethod
+    def _valid(username: str) -> bool:
+        """Indique si le nom désigne bien un dossier de `data_dir`."""
+        return (username not in ("", ".", "..")
+                and "/" not in username and "\0" not in username)
+
+    def _read(self, username: str) -> Optional[str]:
+        """Lit l'empreinte de l'utilisateur sur le disque et la retient."""
+        if not self._valid(username):
+            return None
+        try:
+            stored = (self._data_dir / username
+                      / gloutils.PASSWORD_FILENAME).read_text(encoding="utf-8")
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self._users[username] = stored
+        return stored
+
+    def get(self, username: str) -> Optional[str]:
+        """Retourne l'empreinte de l'utilisateur, ou None s'il n'existe pas."""
+        with self._lock:
+            stored = self._users.get(username)
+        if stored is None:
+            stored = self._read(username)
+        return stored
+
+    def reload(self, username: str) -> Optional[str]:
+        """
+        Relit l'empreinte de l'utilisateur sur le disque, qu'un autre
+        processus a pu changer, et la retourne.
+        """
+        return self._read(username)
+
+    def add(self, username: str, stored: str) -> bool:
+        """
+        Crée le dossier de l'utilisateur et y enregistre son empreinte.
+
+        Retourne faux si l'utilisateur existe déjà, ou si son nom ne
+        désigne pas un dossier de `data_dir` ("/", "..").
+        """
+        if not self._valid(username):
+            return False
+        with self._lock:
+            if username in self._users:
+                return False
+        user_dir = self._data_dir / username
+        try:
+            user_dir.mkdir()
+        except FileExistsError:
+            # Créé par un autre processus, ou dossier réservé du serveur.
+            return False
+        try:
+            write_atomic(user_dir / gloutils.PASSWORD_FILENAME,
+                         stored.encode("utf-8"))
+        except OSError:
+            user_dir.rmdir()
+            raise
+        with self._lock:
+            self._users[username] = stored
+        return True
+
+    def update(self, username: str, stored: str) -> None:
+        """Remplace l'empreinte de l'utilisateur."""
+        write_atomic(self._data_dir / username / gloutils.PASSWORD_FILENAME,
+                     stored.encode("utf-8"))
+        with self._lock:
+            self._users[username] = stored
+
+
+class DirectoryStorage(Storage):
+    """
+    Stockage dans le dossier de données: un dossier par utilisateur avec
+    son mot de passe et sa boîte (`Mailbox`), le magasin de contenus
+    `SERVER_BLOBS_DIR` et les courriels perdus dans `SERVER_LOST_DIR`.
+    """
+
+    def __init__(self, data_dir: pathlib.Path,
+                 default_quota: Quota = NO_QUOTA,
+                 cache: Optional[MessageCache] = None,
+                 segmented: bool = False) -> None:
+        """
+        Prépare le stockage du dossier `data_dir`, créé au besoin.
+
+        `default_quota` est le quota des boîtes qui n'ont pas le leur,
+        `cache` le cache des courriels lus, et `segmented` crée les
+        nouvelles boîtes avec un journal de segments.
+        """
+        self._data_dir = data_dir
+        data_dir.mkdir(parents=True, exist_ok=True)
+        (data_dir / gloutils.SERVER_LOST_DIR).mkdir(exist_ok=True)
+        self._blobs = BlobStore(data_dir / gloutils.SERVER_BLOBS_DIR)
+        self._users = UserDirectory(data_dir)
+        self._default_quota = default_quota
+        self._segmented = segmented
+        self.cache = cache
+        # Boîtes chargées, par nom d'utilisateur.
+        self._mailboxes: dict[str, Mailbox] = {}
+        self._mailboxes_lock = threading.Lock()
+
+    def _mailbox(self, username: str) -> Mailbox:
+        """Retourne la boîte de l'utilisateur, chargée au premier accès."""
+        with self._mailboxes_lock:
+            if username not in self._mailboxes:
+                self._mailboxes[username] = Mailbox(
+                    self._data_dir / username, self._default_quota,
+                    self._blobs, self.cache, self._segmented)
+            return self._mailboxes[username]
+
+    def get_password(self, username: str) -> Optional[str]:
+        return self._users.get(username)
+
+    def reload_password(self, username: str) -> Optional[str]:
+        return self._users.reload(username)
+
+    def add_user(self, username: str, password: str) -> bool:
+        if not self._users.add(username, password):
+            return False
+        self._mailbox(username)
+        return True
+
+    def set_password(self, username: str, password: str) -> None:
+        self._users.update(username, password)
+
+    def load_mailbox(self, username: str) -> None:
+        self._mailbox(username)
+
+    def page(self, username: str, offset: int, limit: int
+             ) -> tuple[list[IndexRecord], int]:
+        return self._mailbox(username).page(offset, limit)
+
+    def get(self, username: str, number: int) -> IndexRecord:
+        return self._mailbox(username).get(number)
+
+    def read(self, username: str, number: int) -> gloutils.EmailContentPayload:
+        return self._mailbox(username).read(number)
+
+    def stream(self, username: str, number: int, chunk_size: int
+               ) -> tuple[gloutils.EmailContentPayload, Iterator[str]]:
+        return self._mailbox(username).stream(number, chunk_size)
+
+    def stats(self, username: str) -> gloutils.StatsPayload:
+        return self._mailbox(username).stats()
+
+    def store_email(self, payload: gloutils.EmailContentPayload) -> StoredEmail:
+        return store_email(payload, self._blobs)
+
+    def body_writer(self) -> BodyWriter:
+        return self._blobs.writer()
+
+    def deliver(self, email: StoredEmail, usernames: list[str],
+                content: Optional[str] = None) -> list[Delivery]:
+        """
+        La fiche du courriel est écrite une seule fois, puis liée dans la
+        boîte de chaque destinataire et dans SERVER_LOST_DIR pour chaque
+        destinataire inconnu, sous un nom libre (`link_unique`) pour ne
+        jamais remplacer une fiche perdue. Chaque fiche compte pour une
+        référence au corps. Les termes du courriel sont calculés une seule
+        fois, avant toute écriture, pour qu'aucune fiche ne soit liée sans
+        que ses références au corps soient comptées.
+        """
+        data = json.dumps(email).encode("utf-8")
+        resultats: list[Delivery] = []
+        references = 0
+        terms: Optional[list[str]] = None
+        if any(self._users.get(username) is not None for username in usernames):
+            if content is None:
+                content = _body_prefix(self._blobs, email["blob"])
+            terms = glosearch.document_terms(email["subject"], content)
+        with spooled(self._data_dir, data) as source:
+            for username in usernames:
+                if self._users.get(username) is None:
+                    link_unique(source,
+                                self._data_dir / gloutils.SERVER_LOST_DIR,
+                                lost_name(email["date"], username), data)
+                    references += 1
+                    resultats.append(Delivery.UNKNOWN)
+                    continue
+                if terms is None:
+                    # Compte créé pendant la livraison.
+                    if content is None:
+                        content = _body_prefix(self._blobs, email["blob"])
+                    terms = glosearch.document_terms(email["subject"], content)
+                try:
+                    self._mailbox(username).deliver(email, data, source, terms)
+                except QuotaExceededError:
+                    resultats.append(Delivery.FULL)
+                    continue
+                references += 1
+                resultats.append(Delivery.DELIVERED)
+        if references:
+            self._blobs.add_refs(email["blob"], references)
+        return resultats
+
+    def search(self, username: str, query: glosearch.Query
+               ) -> list[tuple[int, IndexRecord]]:
+        return self._mailbox(username).search(query)
+
+    def collect_garbage(self, grace: float = 3600.0) -> int:
+        return collect_garbage(self._data_dir, grace)
+
+
+def rebuild_all(data_dir: pathlib.Path) -> int:
+    """
+    Reconstruit l'index de chaque boîte d'un dossier de données existant.
+
+    Retourne le nombre de boîtes traitées.
+    """
+    count = 0
+    if not data_dir.is_dir():
+        return count
+    for user_dir in data_dir.iterdir():
+        if (user_dir.is_dir() and user_dir.name != gloutils.SERVER_LOST_DIR
+                and (user_dir / gloutils.PASSWORD_FILENAME).exists()):
+            had_index = (user_dir / gloutils.INDEX_FILENAME).exists()
+            mailbox = Mailbox(user_dir)
+            if had_index:
+                mailbox.rebuild()
+            count += 1
+    return count
+
+
+def convert_all(data_dir: pathlib.Path) -> int:
+    """
+    Convertit au journal de segments chaque boîte d'un dossier de données,
+    même pendant que le serveur fonctionne.
+
+    Retourne le nombre de boîtes converties.
+    """
+    count = 0
+    if not data_dir.is_dir():
+        return count
+    for user_dir in data_dir.iterdir():
+        if (user_dir.is_dir() and user_dir.name != gloutils.SERVER_LOST_DIR
+                and (user_dir / gloutils.PASSWORD_FILENAME).exists()):
+            if Mailbox(user_dir).convert():
+                count += 1
+    return count
+
+
+def compact_all(data_dir: pathlib.Path) -> int:
+    """
+    Compacte le journal de segments de chaque boîte d'un dossier de
+    données et retourne le nombre d'octets libérés.
+    """
+    freed = 0
+    if not data_dir.is_dir():
+        return freed
+    for user_dir in data_dir.iterdir():
+        if (user_dir.is_dir()
+                and (user_dir / gloutils.SEGMENTS_DIRNAME).is_dir()
+                and (user_dir / gloutils.PASSWORD_FILENAME).exists()):
+            freed += Mailbox(user_dir).compact()
+    return freed
+
+
+def collect_garbage(data_dir: pathlib.Path, grace: float = 3600.0) -> int:
+    """
+    Recompte les références de chaque contenu du magasin à partir des
+    index des boîtes et des fiches de SERVER_LOST_DIR, puis supprime les
+    contenus qui ne sont plus référencés.
+
+    Retourne le nombre de contenus supprimés.
+    """
+    if not data_dir.is_dir():
+        return 0
+    blobs = BlobStore(data_dir / gloutils.SERVER_BLOBS_DIR)
+    references: dict[str, int] = {}
+    for user_dir in data_dir.iterdir():
+        if user_dir.is_dir() and (user_dir / gloutils.PASSWORD_FILENAME).exists():
+            for record in Mailbox(user_dir, blobs=blobs).newest_first():
+                if "blob" in record:
+                    references[record["blob"]] = references.get(record["blob"], 0) + 1
+    lost_dir = data_dir / gloutils.SERVER_LOST_DIR
+    if lost_dir.is_dir():
+        for lost in lost_dir.iterdir():
+            try:
+                fiche = json.loads(lost.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            if isinstance(fiche, dict) and "blob" in fiche:
+                references[fiche["blob"]] = references.get(fiche["blob"], 0) + 1
+    blobs.recount(references)
+    return blobs.collect(grace)
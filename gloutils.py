@@ -3,14 +3,27 @@ Module fournissant les constantes, énumérations,
 protocoles et gabarits à utiliser pour le TP4.
 """
 import enum
-from typing import TypedDict, Union
+from typing import NotRequired, TypedDict, Union
 import datetime
 
 APP_PORT = 5321
 SERVER_DATA_DIR = "glo_server_data"
 SERVER_LOST_DIR = "LOST"
+SERVER_BLOBS_DIR = "BLOBS"
 SERVER_DOMAIN = "glo2000.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INDEX_FILENAME = "index"
+STATS_FILENAME = "stats"
+QUOTA_FILENAME = "quota"
+LOCK_FILENAME = ".lock"
+SEGMENTS_DIRNAME = "segments"
+SEARCH_FILENAME = "search"
+SQLITE_FILENAME = "glo.sqlite3"
+
+# Un corps de courriel de plus de STREAM_THRESHOLD octets est transféré
+# en plusieurs trames EMAIL_CHUNK d'au plus STREAM_CHUNK_SIZE caractères.
+STREAM_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -20,7 +33,8 @@ CLIENT_USE_CHOICE = """Menu principal
 1. Consultation de courriels
 2. Envoi de courriels
 3. Statistiques
-4. Se déconnecter"""
+4. Recherche
+5. Se déconnecter"""
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
 
@@ -55,6 +69,14 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    NEGOTIATE = enum.auto()
+
+    EMAIL_CHUNK = enum.auto()
+
+    SEARCH = enum.auto()
+
+    METRICS = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -68,17 +90,56 @@ class AuthPayload(TypedDict, total=True):
 
 
 class EmailContentPayload(TypedDict, total=True):
-    """Payload pour les transferts de courriels."""
+    """
+    Payload pour les transferts de courriels.
+
+    `destination` est une adresse, ou une liste d'adresses pour un envoi à
+    plusieurs destinataires.
+
+    Si `chunked` est vrai, `content` est vide et le corps suit dans des
+    messages EMAIL_CHUNK.
+    """
     sender: str
-    destination: str
+    destination: Union[str, list[str]]
     subject: str
     date: str
     content: str
+    chunked: NotRequired[bool]
 
 
 class EmailListPayload(TypedDict, total=True):
-    """Payload pour les consulation de courriel."""
+    """
+    Payload pour les consulation de courriel.
+
+    `total` est le nombre de courriels de la boîte, dont `email_list` peut
+    ne contenir qu'une page.
+    """
     email_list: list[str]
+    total: NotRequired[int]
+
+
+class InboxPagePayload(TypedDict, total=True):
+    """
+    Payload facultatif de INBOX_READING_REQUEST: la page de la liste à
+    retourner, `offset` courriels étant sautés à partir du plus récent.
+    """
+    offset: int
+    limit: int
+
+
+class SearchPayload(TypedDict, total=True):
+    """
+    Payload pour la recherche dans les courriels: les mots recherchés, dans
+    le sujet ou le corps, et des filtres facultatifs sur l'expéditeur et
+    sur la date (AAAA-MM-JJ, bornes incluses).
+
+    La réponse est un EmailListPayload, avec les numéros des courriels dans
+    la boîte.
+    """
+    terms: str
+    sender: NotRequired[str]
+    since: NotRequired[str]
+    until: NotRequired[str]
 
 
 class EmailChoicePayload(TypedDict, total=True):
@@ -92,16 +153,63 @@ class StatsPayload(TypedDict, total=True):
     size: int
 
 
+class DeliveryPayload(TypedDict, total=True):
+    """
+    Payload du résultat d'un envoi à plusieurs destinataires: pour chaque
+    destinataire, dans le même ordre, le message d'erreur ou une chaîne
+    vide si le courriel a été livré.
+    """
+    recipients: list[str]
+    errors: list[str]
+
+
+class ChunkPayload(TypedDict, total=True):
+    """
+    Payload d'un morceau du corps d'un courriel transféré en plusieurs
+    trames; `last` est vrai pour le dernier.
+    """
+    data: str
+    last: bool
+
+
+class NegotiationPayload(TypedDict, total=True):
+    """
+    Payload pour la négociation du format des messages: les formats
+    proposés par le client, puis celui retenu par le serveur.
+
+    `compression` indique que le client accepte les messages compressés,
+    puis que le serveur l'a activée pour la connexion. `streaming` fait de
+    même pour les corps transférés en plusieurs trames (EMAIL_CHUNK).
+    """
+    formats: list[str]
+    compression: NotRequired[bool]
+    streaming: NotRequired[bool]
+
+
+class MetricsPayload(TypedDict, total=True):
+    """
+    Payload de la réponse à METRICS: les métriques du processus serveur,
+    en texte au format d'exposition de Prometheus.
+    """
+    metrics: str
+
+
 class GloMessage(TypedDict, total=False):
     """
     Classe à utiliser pour générer des messages.
 
     Les classes *Payload correspondent à des entêtes spécifiques
     certaines entêtes n'ont pas besoin de payload.
+
+    `request_id` est facultatif: le serveur le recopie dans sa réponse, ce
+    qui permet au client d'envoyer plusieurs requêtes sans attendre.
     """
     header: Headers
     payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+                   EmailListPayload, EmailChoicePayload, StatsPayload,
+                   NegotiationPayload, DeliveryPayload, InboxPagePayload,
+                   ChunkPayload, SearchPayload, MetricsPayload]
+    request_id: int
 
 
 def get_current_utc_time() -> str:
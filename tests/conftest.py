@@ -0,0 +1,5 @@
+"""Les modules du projet sont à la racine du dépôt, hors d'un paquet."""
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,85 @@
+"""
+Tests du mode non interactif de TP4_client, contre un serveur démarré
+dans le processus du test.
+"""
+import argparse
+import json
+import threading
+
+import pytest
+
+import gloauth
+import glostorage
+import gloutils
+import TP4_client
+import TP4_server
+
+PASSWORD = "Motdepasse123"
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    """Stockage d'un serveur en marche, avec les comptes alice et bob."""
+    monkeypatch.setattr(gloutils, "APP_PORT", 0)
+    stockage = glostorage.DirectoryStorage(tmp_path / "data")
+    serveur = TP4_server.Server(stockage, io_threads=2, kdf_workers=0)
+    monkeypatch.setattr(gloutils, "APP_PORT",
+                        serveur._server_socket.getsockname()[1])
+    fil = threading.Thread(target=serveur.run, daemon=True)
+    fil.start()
+    for username in ("alice", "bob"):
+        stockage.add_user(username, gloauth.hash_password(PASSWORD))
+    yield stockage
+    serveur.drain(0)
+    fil.join(10)
+    serveur.cleanup()
+
+
+def _deliver(storage: glostorage.Storage, subject: str) -> None:
+    courriel = gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+        subject=subject, date="Sun, 18 Oct 2026 12:00:00 +0000",
+        content=f"Corps {subject}")
+    assert storage.deliver(storage.store_email(courriel), ["bob"]) == [
+        glostorage.Delivery.DELIVERED]
+
+
+def _batch(*arguments: str) -> int:
+    args = argparse.Namespace(command=arguments[0], directory=arguments[1])
+    return TP4_client.Client("127.0.0.1").run_batch(args, "bob", PASSWORD)
+
+
+def test_export_numbers_from_the_oldest(storage, tmp_path, capsys):
+    for numero in range(1, 4):
+        _deliver(storage, f"s{numero}")
+    assert _batch("export", str(tmp_path / "export")) == 0
+    fichiers = sorted((tmp_path / "export").iterdir())
+    assert [fichier.name for fichier in fichiers] == [
+        "000001.json", "000002.json", "000003.json"]
+    assert [json.loads(fichier.read_text(encoding="utf-8"))["subject"]
+            for fichier in fichiers] == ["s1", "s2", "s3"]
+    assert "3 courriel(s) exporté(s)" in capsys.readouterr().out
+
+
+def test_export_during_deliveries(storage, tmp_path, monkeypatch):
+    monkeypatch.setattr(TP4_client, "_BATCH_WINDOW", 4)
+    for numero in range(1, 11):
+        _deliver(storage, f"s{numero}")
+    fetch_emails = TP4_client.Client._fetch_emails
+    appels = []
+
+    def fetch_pendant_livraison(self, choices):
+        # Deux courriels arrivent pendant chacun des premiers lots.
+        appels.append(choices)
+        if len(appels) <= 2:
+            _deliver(storage, f"nouveau{len(appels)}a")
+            _deliver(storage, f"nouveau{len(appels)}b")
+        return fetch_emails(self, choices)
+
+    monkeypatch.setattr(TP4_client.Client, "_fetch_emails",
+                        fetch_pendant_livraison)
+    assert _batch("export", str(tmp_path / "export")) == 0
+    fichiers = sorted((tmp_path / "export").iterdir())
+    assert [json.loads(fichier.read_text(encoding="utf-8"))["subject"]
+            for fichier in fichiers] == [f"s{numero}" for numero in range(1, 11)]
+    assert len(appels) > 3
@@ -0,0 +1,108 @@
+"""Tests de l'encodage des messages (glocodec)."""
+import json
+
+import pytest
+
+import glocodec
+import gloutils
+
+H = gloutils.Headers
+
+MESSAGES = [
+    gloutils.GloMessage(header=H.OK),
+    gloutils.GloMessage(header=H.BYE),
+    gloutils.GloMessage(header=H.STATS_REQUEST, request_id=7),
+    gloutils.GloMessage(header=H.ERROR, payload=gloutils.ErrorPayload(
+        error_message="Le mot de passe est invalide")),
+    gloutils.GloMessage(header=H.AUTH_LOGIN, payload=gloutils.AuthPayload(
+        username="alice", password="Motdepasse123")),
+    gloutils.GloMessage(header=H.EMAIL_SENDING, payload=gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+        subject="Réunion", date="Sun, 18 Oct 2026 12:00:00 +0000",
+        content="Corps accentué: éàü ✓")),
+    gloutils.GloMessage(header=H.EMAIL_SENDING, payload=gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca",
+        destination=["bob@glo2000.ca", "carol@glo2000.ca"],
+        subject="Multi", date="d", content="", chunked=True)),
+    gloutils.GloMessage(header=H.OK, payload=gloutils.EmailListPayload(
+        email_list=["#1 a - b c", "#2 d - e f"], total=2)),
+    gloutils.GloMessage(header=H.INBOX_READING_CHOICE,
+                        payload=gloutils.EmailChoicePayload(choice=3),
+                        request_id=2**32 - 1),
+    gloutils.GloMessage(header=H.OK, payload=gloutils.StatsPayload(
+        count=2, size=2**40)),
+    gloutils.GloMessage(header=H.NEGOTIATE, payload=gloutils.NegotiationPayload(
+        formats=["binary", "json"], compression=True, streaming=False)),
+    gloutils.GloMessage(header=H.EMAIL_CHUNK, payload=gloutils.ChunkPayload(
+        data="x" * 1000, last=False)),
+    gloutils.GloMessage(header=H.SEARCH, payload=gloutils.SearchPayload(
+        terms="réunion", since="2026-01-01")),
+    gloutils.GloMessage(header=H.OK, payload=gloutils.MetricsPayload(
+        metrics="glo_requests_total 1\n")),
+]
+
+
+@pytest.mark.parametrize("wire_format", glocodec.FORMATS)
+@pytest.mark.parametrize("message", MESSAGES)
+def test_round_trip(wire_format, message):
+    assert glocodec.decode(glocodec.encode(message, wire_format)) == message
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_binary_is_compact(message):
+    data = glocodec.encode(message, glocodec.BINARY)
+    assert data[0] == glocodec.MAGIC
+    assert len(data) < len(glocodec.encode(message, glocodec.JSON))
+
+
+def test_binary_decodes_headers_as_enum():
+    message = glocodec.decode(glocodec.encode(
+        gloutils.GloMessage(header=H.STATS_REQUEST), glocodec.BINARY))
+    assert message["header"] is H.STATS_REQUEST
+
+
+def test_unknown_payload_falls_back_to_json():
+    message = {"header": H.OK, "payload": {"inconnu": [1, 2]}}
+    data = glocodec.encode(message, glocodec.BINARY)
+    assert json.loads(data) == message
+    assert glocodec.decode(data) == message
+
+
+def test_mistyped_payload_falls_back_to_json():
+    message = {"header": H.INBOX_READING_CHOICE, "payload": {"choice": "1"}}
+    data = glocodec.encode(message, glocodec.BINARY)
+    assert data[:1] == b"{"
+    assert glocodec.decode(data) == message
+
+
+def _binary(header: int = H.OK, kind: int = 0, flags: int = 0) -> bytes:
+    return glocodec._ENVELOPE.pack(glocodec.MAGIC, header, kind, flags, 0)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"{pas du json",
+    _binary()[:3],
+    _binary(header=200),
+    _binary(header=0),
+    _binary(kind=200),
+    _binary(flags=0x80),
+    _binary(flags=glocodec.FLAG_REQUEST_ID),
+    glocodec.encode({"header": H.ERROR, "payload": {"error_message": "abc"}},
+                    glocodec.BINARY)[:-1],
+    _binary() + b"\0",
+    glocodec.encode({"header": H.ERROR, "payload": {"error_message": "abc"}},
+                    glocodec.BINARY) + b"x",
+    glocodec.encode({"header": H.OK, "request_id": 7}, glocodec.BINARY) + b"x",
+    glocodec._ENVELOPE.pack(glocodec.MAGIC, H.EMAIL_CHUNK,
+                            glocodec.PayloadKind.CHUNK, 0, 0b10) + b"\2",
+])
+def test_invalid_messages_raise_codec_error(data):
+    with pytest.raises(glocodec.CodecError):
+        glocodec.decode(data)
+
+
+def test_choose_format():
+    assert glocodec.choose_format(["binary", "json"], glocodec.FORMATS) == "binary"
+    assert glocodec.choose_format(["binary"], (glocodec.JSON,)) == "json"
+    assert glocodec.choose_format(["xml"], glocodec.FORMATS) == "json"
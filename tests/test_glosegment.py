@@ -0,0 +1,115 @@
+"""Tests du journal de segments (glosegment)."""
+import pytest
+
+import glosegment
+
+
+@pytest.fixture
+def log(tmp_path):
+    journal = glosegment.SegmentLog(tmp_path / "segments", create=True)
+    yield journal
+    journal.close()
+
+
+def test_open_missing_log(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        glosegment.SegmentLog(tmp_path / "absent")
+
+
+def test_append_and_read(log):
+    records = [f"fiche {i}".encode() * (i + 1) for i in range(20)]
+    assert [log.append(data) for data in records] == list(range(20))
+    assert len(log) == 20
+    assert log.read(0) == records[0]
+    assert log.read(19) == records[19]
+    assert list(log) == records
+
+
+def test_read_missing_record(log):
+    log.append(b"a")
+    with pytest.raises(glosegment.SegmentError):
+        log.read(1)
+    with pytest.raises(glosegment.SegmentError):
+        log.read(-1)
+
+
+def test_other_reader_sees_appends(tmp_path, log):
+    lecteur = glosegment.SegmentLog(tmp_path / "segments")
+    try:
+        assert len(lecteur) == 0
+        log.append(b"premier")
+        assert lecteur.read(0) == b"premier"
+        log.append(b"second")
+        assert list(lecteur) == [b"premier", b"second"]
+    finally:
+        lecteur.close()
+
+
+def test_segments_roll_over(monkeypatch, tmp_path, log):
+    monkeypatch.setattr(glosegment, "SEGMENT_MAX_SIZE", 100)
+    records = [bytes([i]) * 40 for i in range(6)]
+    for data in records:
+        log.append(data)
+    assert len(list((tmp_path / "segments").glob("*.seg"))) > 1
+    assert list(log) == records
+
+
+def test_corrupted_record(tmp_path, log):
+    log.append(b"intact")
+    log.append(b"abime")
+    segment = next((tmp_path / "segments").glob("*.seg"))
+    data = bytearray(segment.read_bytes())
+    data[-1] ^= 0xFF
+    segment.write_bytes(bytes(data))
+    log.close()
+    assert log.read(0) == b"intact"
+    with pytest.raises(glosegment.SegmentError):
+        log.read(1)
+
+
+def test_compact_keeps_records_and_numbers(monkeypatch, tmp_path, log):
+    monkeypatch.setattr(glosegment, "SEGMENT_MAX_SIZE", 100)
+    records = [bytes([i]) * 30 for i in range(10)]
+    for data in records:
+        log.append(data)
+    avant = sorted((tmp_path / "segments").glob("*.seg"))
+    monkeypatch.setattr(glosegment, "SEGMENT_MAX_SIZE", 1024)
+    assert log.compact() > 0
+    apres = sorted((tmp_path / "segments").glob("*.seg"))
+    assert len(apres) < len(avant)
+    assert not set(avant) & set(apres)
+    assert list(log) == records
+    assert log.read(7) == records[7]
+    assert log.append(b"suivant") == 10
+    assert log.read(10) == b"suivant"
+
+
+def test_compact_drops_orphans(tmp_path, log):
+    log.append(b"garde")
+    # Enregistrement écrit sans son entrée de table (arrêt brutal).
+    segment = next((tmp_path / "segments").glob("*.seg"))
+    with segment.open("ab") as fichier:
+        fichier.write(b"\0" * 500)
+    assert log.compact() >= 500
+    assert list(log) == [b"garde"]
+
+
+def test_compact_seen_by_other_reader(tmp_path, log):
+    for i in range(5):
+        log.append(b"%d" % i)
+    lecteur = glosegment.SegmentLog(tmp_path / "segments")
+    try:
+        assert lecteur.read(4) == b"4"
+        log.compact()
+        assert list(lecteur) == [b"%d" % i for i in range(5)]
+    finally:
+        lecteur.close()
+
+
+def test_truncated_table_entry_is_overwritten(tmp_path, log):
+    log.append(b"a")
+    offsets = tmp_path / "segments" / glosegment.OFFSETS_FILENAME
+    with offsets.open("ab") as table:
+        table.write(b"\1\2\3")
+    assert log.append(b"b") == 1
+    assert list(log) == [b"a", b"b"]
@@ -0,0 +1,47 @@
+"""Tests des messages compressés de glosocket."""
+import asyncio
+import socket
+import zlib
+
+import pytest
+
+import glosocket
+
+MESSAGE = b"Le rapport est pr\xc3\xaat " * 200
+
+
+def _frame(data: bytes) -> bytes:
+    return glosocket._HEADER.pack(len(data) | glosocket.COMPRESSED_FLAG) + data
+
+
+@pytest.fixture
+def pair():
+    gauche, droite = socket.socketpair()
+    yield gauche, droite
+    gauche.close()
+    droite.close()
+
+
+def test_compressed_round_trip(pair):
+    glosocket.send_frame(pair[0], MESSAGE, compress=True)
+    assert glosocket.recv_frame(pair[1]) == MESSAGE
+
+
+@pytest.mark.parametrize("data", [
+    zlib.compress(MESSAGE)[:-1],
+    zlib.compress(MESSAGE) + b"en trop",
+    zlib.compress(MESSAGE) + zlib.compress(MESSAGE),
+], ids=["tronque", "octets-en-trop", "deux-flux"])
+def test_invalid_compressed_frames(pair, data):
+    pair[0].sendall(_frame(data))
+    with pytest.raises(glosocket.GLOSocketError):
+        glosocket.recv_frame(pair[1])
+
+    async def lire() -> None:
+        reader = asyncio.StreamReader()
+        reader.feed_data(_frame(data))
+        reader.feed_eof()
+        await glosocket.recv_frame_async(reader)
+
+    with pytest.raises(glosocket.GLOSocketError):
+        asyncio.run(lire())
@@ -0,0 +1,340 @@
+"""
+Tests de régression du serveur: un message mal formé ou un traitement
+qui échoue ne doit retirer que le client qui l'a envoyé.
+
+Le serveur est démarré dans le processus du test, sur un port libre.
+"""
+import concurrent.futures
+import socket
+import threading
+from typing import Optional
+
+import pytest
+
+import gloauth
+import glocodec
+import glosocket
+import glostorage
+import gloutils
+import TP4_server
+
+H = gloutils.Headers
+PASSWORD = "Motdepasse123"
+
+# Moteur et nombre de fils du pool de chaque configuration testée.
+CONFIGS = [("selectors", 0), ("asyncio", 0), ("selectors", 4), ("asyncio", 4)]
+
+
+class _Client:
+    """Client minimal qui envoie un message et attend sa réponse."""
+
+    def __init__(self, port: int) -> None:
+        self.soc = socket.create_connection(("127.0.0.1", port), timeout=10)
+
+    def send(self, header: int, payload: Optional[dict] = None,
+             **champs) -> None:
+        """Envoie un message sans attendre sa réponse."""
+        message = {"header": header, **champs}
+        if payload is not None:
+            message["payload"] = payload
+        glosocket.send_frame(self.soc, glocodec.encode(message))
+
+    def receive(self) -> gloutils.GloMessage:
+        """Attend le message suivant du serveur."""
+        return glocodec.decode(glosocket.recv_frame(self.soc))
+
+    def request(self, header: int, payload: Optional[dict] = None
+                ) -> Optional[gloutils.GloMessage]:
+        """Retourne la réponse, ou None si le serveur a fermé la connexion."""
+        try:
+            self.send(header, payload)
+            return self.receive()
+        except glosocket.GLOSocketError:
+            return None
+
+    def close(self) -> None:
+        self.soc.close()
+
+
+@pytest.fixture(params=CONFIGS, ids=lambda config: f"{config[0]}-{config[1]}")
+def server(request, monkeypatch, tmp_path):
+    monkeypatch.setattr(gloutils, "APP_PORT", 0)
+    engine, io_threads = request.param
+    serveur = TP4_server.Server(glostorage.DirectoryStorage(tmp_path),
+                                io_threads=io_threads, kdf_workers=0)
+    fil = threading.Thread(target=(serveur.run_asyncio if engine == "asyncio"
+                                   else serveur.run), daemon=True)
+    fil.start()
+    yield serveur
+    serveur.drain(0)
+    fil.join(10)
+    serveur.cleanup()
+    assert not fil.is_alive()
+
+
+@pytest.fixture
+def connect(server):
+    port = server._server_socket.getsockname()[1]
+    clients: list[_Client] = []
+
+    def ouvrir(username: Optional[str] = None) -> _Client:
+        client = _Client(port)
+        clients.append(client)
+        if username is not None:
+            reponse = client.request(H.AUTH_REGISTER, {"username": username,
+                                                       "password": PASSWORD})
+            assert reponse == {"header": H.OK}
+        return client
+
+    yield ouvrir
+    for client in clients:
+        client.close()
+
+
+def _assert_alive(client: _Client) -> None:
+    reponse = client.request(H.STATS_REQUEST)
+    assert reponse is not None and reponse["header"] == H.OK
+
+
+def test_handler_exception_drops_only_its_client(server, connect, monkeypatch):
+    temoin = connect("temoin")
+    fautif = connect("fautif")
+    original = server._get_stats
+
+    def get_stats(client_soc):
+        if server._logged_users[client_soc] == "fautif":
+            raise KeyError("défaillance simulée")
+        return original(client_soc)
+
+    monkeypatch.setattr(server, "_get_stats", get_stats)
+    assert fautif.request(H.STATS_REQUEST) is None
+    _assert_alive(temoin)
+    _assert_alive(connect("nouveau"))
+
+
+def test_malformed_message_drops_only_its_client(connect):
+    temoin = connect("temoin")
+    fautif = connect("fautif")
+    assert fautif.request(H.AUTH_LOGIN, {"username": 1}) is None
+    _assert_alive(temoin)
+
+
+def test_handler_exceptions_with_concurrent_clients(server, connect,
+                                                    monkeypatch):
+    temoins = [connect(f"temoin{i}") for i in range(4)]
+    fautifs = [connect(f"fautif{i}") for i in range(4)]
+    original = server._get_stats
+
+    def get_stats(client_soc):
+        if server._logged_users[client_soc].startswith("fautif"):
+            raise OSError("défaillance simulée")
+        return original(client_soc)
+
+    monkeypatch.setattr(server, "_get_stats", get_stats)
+    reponses: dict[_Client, list] = {}
+
+    def envoyer(client: _Client) -> None:
+        reponses[client] = [client.request(H.STATS_REQUEST) for _ in range(5)]
+
+    fils = [threading.Thread(target=envoyer, args=(client,))
+            for client in temoins + fautifs]
+    for fil in fils:
+        fil.start()
+    for fil in fils:
+        fil.join(10)
+    for client in temoins:
+        assert all(reponse is not None and reponse["header"] == H.OK
+                   for reponse in reponses[client])
+    for client in fautifs:
+        assert reponses[client] == [None] * 5
+
+
+def _email(**champs) -> dict:
+    courriel = {"sender": "alice@glo2000.ca", "destination": "bob@glo2000.ca",
+                "subject": "Sujet", "date": "Sun, 18 Oct 2026 12:00:00 +0000",
+                "content": "Corps"}
+    courriel.update(champs)
+    return {cle: valeur for cle, valeur in courriel.items() if valeur is not ...}
+
+
+@pytest.mark.parametrize("payload", [
+    pytest.param(_email(content=...), id="sans-contenu"),
+    pytest.param(_email(subject=...), id="sans-sujet"),
+    pytest.param(_email(content=3), id="contenu-entier"),
+    pytest.param(_email(subject=["a"]), id="sujet-liste"),
+    pytest.param(_email(sender=None), id="expediteur-null"),
+    pytest.param(_email(date=1), id="date-entiere"),
+    pytest.param(_email(destination=3), id="destination-entiere"),
+    pytest.param(_email(destination=[]), id="destinations-vides"),
+    pytest.param(_email(destination=["bob@glo2000.ca", 3]),
+                 id="destination-entiere-en-liste"),
+    pytest.param([], id="payload-liste"),
+])
+def test_malformed_email_gets_an_error(connect, tmp_path, payload):
+    alice = connect("alice")
+    bob = connect("bob")
+    reponse = alice.request(H.EMAIL_SENDING, payload)
+    assert reponse is not None and reponse["header"] == H.ERROR
+    assert bob.request(H.STATS_REQUEST)["payload"] == {"count": 0, "size": 0}
+    assert not [chemin for chemin in (tmp_path / gloutils.SERVER_BLOBS_DIR).rglob("*")
+                if chemin.is_file()]
+    # La connexion de l'expéditeur reste utilisable.
+    assert alice.request(H.EMAIL_SENDING, _email()) == {"header": H.OK}
+    assert bob.request(H.STATS_REQUEST)["payload"]["count"] == 1
+
+
+def test_email_to_several_recipients(connect):
+    alice = connect("alice")
+    bob = connect("bob")
+    reponse = alice.request(H.EMAIL_SENDING, _email(
+        destination=["bob@glo2000.ca", "inconnu@glo2000.ca"]))
+    assert reponse["header"] == H.OK
+    assert reponse["payload"]["recipients"] == ["bob@glo2000.ca",
+                                                "inconnu@glo2000.ca"]
+    assert [bool(erreur) for erreur in reponse["payload"]["errors"]] == [False, True]
+    assert bob.request(H.STATS_REQUEST)["payload"]["count"] == 1
+
+
+def test_pipelined_requests_get_their_request_id(connect):
+    alice = connect("alice")
+    requetes = [
+        (H.EMAIL_SENDING, _email(destination="alice@glo2000.ca")),
+        (H.STATS_REQUEST, None),
+        (H.INBOX_READING_REQUEST, {"offset": 0, "limit": 10}),
+        (H.INBOX_READING_CHOICE, {"choice": 1}),
+        (H.INBOX_READING_CHOICE, {"choice": 9}),
+        (H.STATS_REQUEST, None),
+    ]
+    for request_id, (header, payload) in enumerate(requetes, start=1):
+        alice.send(header, payload, request_id=request_id)
+    reponses = [alice.receive() for _ in requetes]
+    assert [reponse["request_id"] for reponse in reponses] == [1, 2, 3, 4, 5, 6]
+    assert [reponse["header"] for reponse in reponses] == [
+        H.OK, H.OK, H.OK, H.OK, H.ERROR, H.OK]
+    assert reponses[1]["payload"]["count"] == 1
+    assert reponses[2]["payload"]["total"] == 1
+    assert reponses[3]["payload"]["content"] == "Corps"
+    _assert_alive(alice)
+
+
+@pytest.mark.parametrize("compression", [False, True],
+                         ids=["brut", "compresse"])
+def test_large_body_travels_in_chunks(connect, compression):
+    alice = connect("alice")
+    reponse = alice.request(H.NEGOTIATE, {"formats": list(glocodec.FORMATS),
+                                          "compression": compression,
+                                          "streaming": True})
+    assert reponse["header"] == H.OK and reponse["payload"]["streaming"]
+    corps = "Le rapport est prêt. " * 60000
+    assert len(corps.encode("utf-8")) > gloutils.STREAM_THRESHOLD
+    alice.send(H.EMAIL_SENDING, _email(destination="alice@glo2000.ca",
+                                       content="", chunked=True))
+    taille = gloutils.STREAM_CHUNK_SIZE
+    for debut in range(0, len(corps), taille):
+        alice.send(H.EMAIL_CHUNK, {"data": corps[debut:debut + taille],
+                                   "last": False})
+    assert alice.request(H.EMAIL_CHUNK, {"data": "", "last": True}) == {
+        "header": H.OK}
+    reponse = alice.request(H.STATS_REQUEST)
+    assert reponse["payload"]["count"] == 1
+    assert reponse["payload"]["size"] >= len(corps.encode("utf-8"))
+
+    alice.send(H.INBOX_READING_CHOICE, {"choice": 1}, request_id=7)
+    entete = alice.receive()
+    assert entete["header"] == H.OK and entete["request_id"] == 7
+    assert entete["payload"]["chunked"] is True
+    assert entete["payload"]["content"] == ""
+    morceaux = []
+    while True:
+        trame = alice.receive()
+        assert trame["header"] == H.EMAIL_CHUNK and trame["request_id"] == 7
+        if trame["payload"]["last"]:
+            break
+        morceaux.append(trame["payload"]["data"])
+    assert len(morceaux) > 1
+    assert "".join(morceaux) == corps
+    _assert_alive(alice)
+
+
+@pytest.mark.parametrize("choice", [None, 1.5, True, "1", 0, 2])
+def test_invalid_choice_gets_an_error(connect, choice):
+    alice = connect("alice")
+    assert alice.request(H.EMAIL_SENDING, _email(
+        destination="alice@glo2000.ca")) == {"header": H.OK}
+    reponse = alice.request(H.INBOX_READING_CHOICE, {"choice": choice})
+    assert reponse is not None and reponse["header"] == H.ERROR
+    reponse = alice.request(H.INBOX_READING_CHOICE, {"choice": 1})
+    assert reponse["header"] == H.OK and reponse["payload"]["content"] == "Corps"
+
+
+@pytest.mark.parametrize("page", [
+    {"offset": True, "limit": 10},
+    {"offset": 0, "limit": False},
+    {"offset": "0", "limit": 10},
+    {"offset": 0, "limit": None},
+    {"offset": 0},
+    {"offset": -1, "limit": 10},
+])
+def test_invalid_page_gets_an_error(connect, page):
+    alice = connect("alice")
+    assert alice.request(H.EMAIL_SENDING, _email(
+        destination="alice@glo2000.ca")) == {"header": H.OK}
+    reponse = alice.request(H.INBOX_READING_REQUEST, page)
+    assert reponse is not None and reponse["header"] == H.ERROR
+    reponse = alice.request(H.INBOX_READING_REQUEST, {"offset": 0, "limit": 10})
+    assert reponse["header"] == H.OK and reponse["payload"]["total"] == 1
+
+
+@pytest.mark.parametrize("destination", ["a/b@glo2000.ca", "../x@glo2000.ca",
+                                         "@glo2000.ca"])
+def test_unsafe_recipient_is_invalid(connect, tmp_path, destination):
+    alice = connect("alice")
+    reponse = alice.request(H.EMAIL_SENDING, _email(destination=destination))
+    assert reponse is not None and reponse["header"] == H.ERROR
+    assert not list((tmp_path / gloutils.SERVER_LOST_DIR).iterdir())
+    _assert_alive(alice)
+
+
+@pytest.mark.parametrize("username", ["u0/sous", "..", ".", "a b", "é", "a\0b",
+                                      "../hors"])
+def test_invalid_username_is_refused(connect, tmp_path, username):
+    connect("u0")
+    client = connect()
+    reponse = client.request(H.AUTH_REGISTER, {"username": username,
+                                               "password": PASSWORD})
+    assert reponse is not None and reponse["header"] == H.ERROR
+    assert sorted(chemin.name for chemin in tmp_path.iterdir()) == [
+        gloutils.SERVER_BLOBS_DIR, gloutils.SERVER_LOST_DIR, "u0"]
+    assert not (tmp_path / "u0" / "sous").exists()
+
+
+def test_password_hashing_does_not_block_other_clients(server, connect,
+                                                       monkeypatch):
+    # Hachage retenu jusqu'à la fin du test, dans un pool de fils qui
+    # remplace le pool de processus.
+    libere = threading.Event()
+    libere.set()
+    hash_password = gloauth.hash_password
+
+    def hachage_lent(password: str) -> str:
+        assert libere.wait(10)
+        return hash_password(password)
+
+    monkeypatch.setattr(gloauth, "hash_password", hachage_lent)
+    server._kdf_pool = concurrent.futures.ThreadPoolExecutor(8)
+    try:
+        temoin = connect("temoin")
+        libere.clear()
+        # Plus de créations de compte en cours que de fils dans le pool.
+        en_attente = [connect() for _ in range(5)]
+        for numero, client in enumerate(en_attente):
+            client.send(H.AUTH_REGISTER, {"username": f"lent{numero}",
+                                          "password": PASSWORD})
+        for _ in range(3):
+            _assert_alive(temoin)
+        libere.set()
+        for client in en_attente:
+            assert client.receive() == {"header": H.OK}
+            _assert_alive(client)
+    finally:
+        libere.set()
@@ -0,0 +1,281 @@
+"""
+Tests des stockages du serveur: le stockage SQLite (glosqlite) doit se
+comporter comme le dossier de données (glostorage.DirectoryStorage),
+avec ou sans journal de segments.
+"""
+import pytest
+
+import glosearch
+import glosqlite
+import glostorage
+import gloutils
+
+BACKENDS = ("directory", "segments", "sqlite")
+DATES = ["Mon, 05 Oct 2026 09:00:00 +0000",
+         "Tue, 13 Oct 2026 09:00:00 +0000",
+         "Sun, 18 Oct 2026 09:00:00 +0000"]
+
+
+def _open(backend: str, path, quota: glostorage.Quota = glostorage.NO_QUOTA
+          ) -> glostorage.Storage:
+    if backend == "sqlite":
+        return glosqlite.SQLiteStorage(path / gloutils.SQLITE_FILENAME, quota,
+                                       glostorage.MessageCache(1024 * 1024))
+    return glostorage.DirectoryStorage(path, quota,
+                                       glostorage.MessageCache(1024 * 1024),
+                                       segmented=backend == "segments")
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request, tmp_path):
+    stockage = _open(request.param, tmp_path)
+    yield stockage
+    stockage.close()
+
+
+def _email(destination, subject: str, content: str, date: str = DATES[0]
+           ) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination=destination, subject=subject,
+        date=date, content=content)
+
+
+def _send(storage: glostorage.Storage, payload: gloutils.EmailContentPayload,
+          usernames: list[str]) -> list[glostorage.Delivery]:
+    return storage.deliver(storage.store_email(payload), usernames,
+                           payload["content"])
+
+
+def _summary(record: glostorage.IndexRecord) -> tuple:
+    return (record["sender"], record["subject"], record["date"], record["size"])
+
+
+def _scenario(storage: glostorage.Storage) -> dict:
+    """Suite d'opérations dont les résultats doivent être les mêmes partout."""
+    resultats: dict = {}
+    resultats["add"] = [storage.add_user("alice", "empreinte-a"),
+                        storage.add_user("bob", "empreinte-b"),
+                        storage.add_user("alice", "autre")]
+    storage.set_password("bob", "nouvelle")
+    resultats["passwords"] = [storage.get_password("alice"),
+                              storage.get_password("bob"),
+                              storage.get_password("zed")]
+    storage.load_mailbox("bob")
+    resultats["deliveries"] = [
+        _send(storage, _email("bob@glo2000.ca", "Réunion lundi",
+                              "Ordre du jour: budget", DATES[0]), ["bob"]),
+        _send(storage, _email(["bob@glo2000.ca", "zed@glo2000.ca"],
+                              "Rapport", "Le rapport est prêt " * 50,
+                              DATES[1]), ["bob", "zed"]),
+        _send(storage, _email("bob@glo2000.ca", "Réunion annulée",
+                              "Pas de budget", DATES[2]), ["bob", "bob"]),
+    ]
+    resultats["stats"] = [storage.stats("bob"), storage.stats("alice")]
+    page, total = storage.page("bob", 0, 10)
+    resultats["page"] = ([_summary(record) for record in page], total)
+    page, total = storage.page("bob", 1, 2)
+    resultats["page2"] = ([_summary(record) for record in page], total)
+    resultats["get"] = [_summary(storage.get("bob", numero))
+                        for numero in (1, 2, 3)]
+    resultats["read"] = [storage.read("bob", numero) for numero in (1, 2, 3)]
+    entete, corps = storage.stream("bob", 3, 7)
+    resultats["stream"] = (entete, "".join(corps))
+    resultats["search"] = {
+        termes: [(numero, _summary(record)) for numero, record in
+                 storage.search("bob", glosearch.Query(
+                     gloutils.SearchPayload(terms=termes)))]
+        for termes in ("réunion", "REUNION budget", "rapport", "absent", "")}
+    resultats["search_since"] = [numero for numero, _ in storage.search(
+        "bob", glosearch.Query(gloutils.SearchPayload(
+            terms="", since="2026-10-10")))]
+    return resultats
+
+
+def test_sqlite_matches_directory(tmp_path):
+    resultats = {}
+    for backend in BACKENDS:
+        stockage = _open(backend, tmp_path / backend)
+        try:
+            resultats[backend] = _scenario(stockage)
+        finally:
+            stockage.close()
+    assert resultats["sqlite"] == resultats["directory"]
+    assert resultats["segments"] == resultats["directory"]
+
+
+def test_scenario(storage):
+    resultats = _scenario(storage)
+    assert resultats["add"] == [True, True, False]
+    assert resultats["passwords"] == ["empreinte-a", "nouvelle", None]
+    assert resultats["deliveries"] == [
+        [glostorage.Delivery.DELIVERED],
+        [glostorage.Delivery.DELIVERED, glostorage.Delivery.UNKNOWN],
+        [glostorage.Delivery.DELIVERED, glostorage.Delivery.DELIVERED]]
+    assert resultats["stats"][0]["count"] == 4
+    assert resultats["stats"][1] == {"count": 0, "size": 0}
+    sujets = [sujet for _, sujet, _, _ in resultats["page"][0]]
+    assert sujets == ["Réunion annulée", "Réunion annulée", "Rapport",
+                      "Réunion lundi"]
+    assert resultats["page"][1] == 4
+    assert resultats["page2"] == (resultats["page"][0][1:3], 4)
+    assert resultats["read"][2]["destination"] == ["bob@glo2000.ca",
+                                                   "zed@glo2000.ca"]
+    assert resultats["read"][2]["content"] == "Le rapport est prêt " * 50
+    assert resultats["stream"] == (dict(resultats["read"][2], content=""),
+                                   "Le rapport est prêt " * 50)
+    assert [numero for numero, _ in resultats["search"]["réunion"]] == [1, 2, 4]
+    assert [numero for numero, _ in resultats["search"]["REUNION budget"]] == [1, 2, 4]
+    assert [numero for numero, _ in resultats["search"]["rapport"]] == [3]
+    assert resultats["search"]["absent"] == []
+    assert resultats["search_since"] == [1, 2, 3]
+
+
+def test_missing_email(storage):
+    storage.add_user("bob", "x")
+    _send(storage, _email("bob@glo2000.ca", "s", "c"), ["bob"])
+    for numero in (0, 2):
+        with pytest.raises(IndexError):
+            storage.get("bob", numero)
+        with pytest.raises(IndexError):
+            storage.read("bob", numero)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_quota(backend, tmp_path):
+    stockage = _open(backend, tmp_path, glostorage.Quota(count=2, size=0))
+    try:
+        stockage.add_user("bob", "x")
+        resultats = [_send(stockage, _email("bob@glo2000.ca", f"s{i}", "c"),
+                           ["bob"])[0] for i in range(3)]
+        assert resultats == [glostorage.Delivery.DELIVERED,
+                             glostorage.Delivery.DELIVERED,
+                             glostorage.Delivery.FULL]
+        assert stockage.stats("bob")["count"] == 2
+    finally:
+        stockage.close()
+
+
+def test_chunked_body(storage):
+    storage.add_user("bob", "x")
+    redacteur = storage.body_writer()
+    for morceau in ("Premier morceau ", "puis le budget ", "é" * 10):
+        redacteur.write(morceau.encode("utf-8"))
+    cle = redacteur.commit()
+    entete = _email("bob@glo2000.ca", "Gros", "", DATES[1])
+    fiche = glostorage.make_stored_email(entete, cle, redacteur.size)
+    assert storage.deliver(fiche, ["bob"]) == [glostorage.Delivery.DELIVERED]
+    contenu = "Premier morceau puis le budget " + "é" * 10
+    assert storage.read("bob", 1)["content"] == contenu
+    assert storage.stats("bob")["size"] == fiche["size"]
+    assert [numero for numero, _ in storage.search(
+        "bob", glosearch.Query(gloutils.SearchPayload(terms="budget")))] == [1]
+
+
+def test_invalid_email_is_not_stored(storage):
+    storage.add_user("bob", "x")
+    for champ, valeur in (("subject", 3), ("content", None),
+                          ("destination", [1])):
+        courriel = dict(_email("bob@glo2000.ca", "s", "c"), **{champ: valeur})
+        with pytest.raises(ValueError):
+            storage.store_email(courriel)
+    assert storage.collect_garbage(grace=0) == 0
+    assert storage.stats("bob") == {"count": 0, "size": 0}
+
+
+def test_collect_garbage(storage):
+    storage.add_user("bob", "x")
+    _send(storage, _email("bob@glo2000.ca", "s", "garde"), ["bob"])
+    orphelin = storage.store_email(_email("bob@glo2000.ca", "s", "orphelin"))
+    assert orphelin["blob"]
+    assert storage.collect_garbage(grace=0) == 1
+    assert storage.read("bob", 1)["content"] == "garde"
+
+
+@pytest.mark.parametrize("date, username", [
+    ("../../hors", "bob"),
+    ("2026/10/18", "bob"),
+    ("d", "a/b"),
+    ("d", "../../hors"),
+    (".cache", "bob"),
+    ("x" * 300, "bob"),
+], ids=["date-parent", "date-barres", "nom-barre", "nom-parent", "cache",
+        "trop-long"])
+def test_lost_entries_stay_in_lost(tmp_path, date, username):
+    data_dir = tmp_path / "data"
+    stockage = glostorage.DirectoryStorage(data_dir)
+    try:
+        resultats = _send(stockage, _email(f"{username}@glo2000.ca", "s", "c",
+                                           date), [username])
+    finally:
+        stockage.close()
+    assert resultats == [glostorage.Delivery.UNKNOWN]
+    perdus = list((data_dir / gloutils.SERVER_LOST_DIR).iterdir())
+    assert len(perdus) == 1 and not perdus[0].name.startswith(".")
+    assert sorted(chemin.name for chemin in tmp_path.iterdir()) == ["data"]
+    assert sorted(chemin.name for chemin in data_dir.iterdir()) == [
+        gloutils.SERVER_BLOBS_DIR, gloutils.SERVER_LOST_DIR]
+
+
+@pytest.mark.parametrize("username", ["", ".", "..", "a/b", "../hors", "a\0b"])
+def test_directory_refuses_unsafe_usernames(tmp_path, username):
+    stockage = glostorage.DirectoryStorage(tmp_path / "data")
+    try:
+        assert not stockage.add_user(username, "x")
+        assert stockage.get_password(username) is None
+    finally:
+        stockage.close()
+    assert sorted(chemin.name for chemin in tmp_path.iterdir()) == ["data"]
+
+
+def test_sqlite_ranks_emails_of_an_older_base(tmp_path):
+    chemin = tmp_path / gloutils.SQLITE_FILENAME
+    stockage = glosqlite.SQLiteStorage(chemin)
+    try:
+        stockage.add_user("bob", "x")
+        for sujet in ("un", "deux", "trois"):
+            _send(stockage, _email("bob@glo2000.ca", sujet, sujet), ["bob"])
+        # Base d'avant le rang des courriels.
+        connexion = stockage._connection()
+        connexion.execute("DROP INDEX emails_by_user_seq")
+        connexion.execute("ALTER TABLE emails DROP COLUMN seq")
+        connexion.execute("CREATE INDEX emails_by_user_date"
+                          " ON emails (user, received, id)")
+    finally:
+        stockage.close()
+    stockage = glosqlite.SQLiteStorage(chemin)
+    try:
+        assert [stockage.get("bob", numero)["subject"]
+                for numero in (1, 2, 3)] == ["trois", "deux", "un"]
+        _send(stockage, _email("bob@glo2000.ca", "quatre", "quatre"), ["bob"])
+        page, total = stockage.page("bob", 1, 2)
+        assert ([record["subject"] for record in page], total) == (
+            ["trois", "deux"], 4)
+        plan = " ".join(row[-1] for row in stockage._connection().execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM emails"
+            " WHERE user = 'bob' AND seq = 2"))
+        assert "emails_by_user_seq" in plan
+    finally:
+        stockage.close()
+
+
+def test_lost_duplicates_keep_one_entry_per_reference(tmp_path):
+    data_dir = tmp_path / "data"
+    stockage = glostorage.DirectoryStorage(data_dir)
+    try:
+        courriel = _email("zed@glo2000.ca", "s", "c")
+        fiche = stockage.store_email(courriel)
+        assert stockage.deliver(fiche, ["zed", "zed"]) == [
+            glostorage.Delivery.UNKNOWN] * 2
+        assert _send(stockage, courriel, ["zed"]) == [
+            glostorage.Delivery.UNKNOWN]
+        references = stockage._blobs.refs(fiche["blob"])
+    finally:
+        stockage.close()
+    perdus = sorted(chemin.name for chemin in
+                    (data_dir / gloutils.SERVER_LOST_DIR).iterdir())
+    nom = glostorage.lost_name(courriel["date"], "zed")
+    assert perdus == [nom, f"{nom}-1", f"{nom}-2"]
+    assert references == 3
+    assert glostorage.collect_garbage(data_dir, grace=0) == 0
+    blobs = glostorage.BlobStore(data_dir / gloutils.SERVER_BLOBS_DIR)
+    assert blobs.refs(fiche["blob"]) == 3